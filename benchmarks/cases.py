@@ -0,0 +1,108 @@
+#!usr/bin/python3
+
+"""
+This file contains the benchmark cases. Each case takes a problem size
+and does its setup outside of the timed region, returning a function
+with no arguments that runs the operation being measured.
+"""
+
+import numpy as np
+from tree_tracks.storage import Tree, Bush, makeTree, makeBush, makeVines
+from tree_tracks.decorator import Marker, birth, death
+from tree_tracks.visual import Image, Movie, Raster
+
+# Storage tells the time and object axes apart by their sizes, so
+# the number of snapshots is chosen not to collide with the sizes
+NSNAPS = 97
+
+
+def _hostTrackers(size):
+    # trackers from traversing the largest host of a tree
+    tree, sim = makeTree(size, NSNAPS)
+    trk_list = Tree(tree, sim).traverseTree(0, depth = 2)
+    return trk_list
+
+
+def storageGet(size):
+    tree, sim = makeTree(size, NSNAPS)
+    storage = Tree(tree, sim)
+    oslc = np.arange(0, size, 2)
+    def run():
+        storage.get(['x', 'M200m', 'mask_alive'], slice(None), oslc)
+    return run
+
+
+def createTrack(size):
+    tree, sim = makeTree(size, NSNAPS)
+    storage = Tree(tree, sim)
+    storage.setTrackerCustom(['M200m'])
+    def run():
+        for idx in range(size):
+            storage.createTrack(idx)
+    return run
+
+
+def traverseTree(size):
+    tree, sim = makeTree(size, NSNAPS)
+    storage = Tree(tree, sim)
+    def run():
+        storage.traverseTree(0, depth = 2)
+    return run
+
+
+def trackerBox(size):
+    data, sim = makeBush(size, NSNAPS)
+    bush = Bush(data, sim)
+    center = np.full((NSNAPS, 3), sim.getBox() / 2)
+    def run():
+        bush.trackerBox(center, sim.getBox() / 4, NSNAPS // 5)
+    return run
+
+
+def markerPlot(size):
+    trk_list = _hostTrackers(size)
+    for trk in trk_list:
+        trk.setCustom(['index'])
+    markers = [Marker(birth), Marker(death)]
+    def run():
+        for mrk in markers:
+            mrk.plot(trk_list, NSNAPS - 1)
+    return run
+
+
+def imageGetFig(size):
+    image = Image(_hostTrackers(size))
+    def run():
+        image.getFig()
+    return run
+
+
+def movieCreateFrames(size):
+    trk_list = _hostTrackers(size)
+    movie = Movie(trk_list, [Marker(birth), Marker(death)])
+    movie.includeData(['index'])
+    snapshots = list(range(0, NSNAPS, 5))
+    def run():
+        movie.createFrames(snapshots)
+    return run
+
+
+def rasterDensity(size):
+    tcrs, halos, sim = makeVines(1, size, NSNAPS)
+    raster = Raster(bins = 256, max_len = sim.getBox() / 2)
+    def run():
+        raster.density(tcrs['tjy_x'])
+    return run
+
+
+# name: (case, default sizes)
+CASES = {
+    'Storage.get' : (storageGet, [1000, 4000, 16000]),
+    'createTrack' : (createTrack, [250, 1000, 4000]),
+    'Tree.traverseTree' : (traverseTree, [500, 2000, 8000]),
+    'Bush.trackerBox' : (trackerBox, [2000, 8000, 32000]),
+    'Marker.plot' : (markerPlot, [500, 2000, 8000]),
+    'Image.getFig' : (imageGetFig, [250, 1000, 4000]),
+    'Movie.createFrames' : (movieCreateFrames, [100, 400, 1600]),
+    'Raster.density' : (rasterDensity, [10000, 40000, 160000]),
+}
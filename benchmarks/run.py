@@ -0,0 +1,96 @@
+#!usr/bin/python3
+
+"""
+Runs the benchmark cases over a range of problem sizes and reports
+the scaling of run time and peak memory.
+
+    python -m benchmarks.run
+    python -m benchmarks.run --cases Storage.get Image.getFig --json out.json
+
+The scaling exponent is the slope of log(time) against log(size)
+between the smallest and largest sizes, so linear scaling gives 1.
+"""
+
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+import numpy as np
+from benchmarks.cases import CASES
+
+
+def measure(case, size, repeat):
+    run = case(size)
+    # warm up caches and lazy imports
+    run()
+
+    # time the best of several runs, without tracemalloc since it
+    # slows allocations down
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def slope(sizes, values):
+    if len(sizes) < 2 or min(values) <= 0:
+        return np.nan
+    return np.log(values[-1] / values[0]) / np.log(sizes[-1] / sizes[0])
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('--cases', nargs = '*', default = list(CASES),
+                        help = 'cases to run, defaults to all')
+    parser.add_argument('--scale', type = float, default = 1.0,
+                        help = 'multiply the default sizes by this')
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--json', default = None,
+                        help = 'also write the results to this file')
+    args = parser.parse_args(argv)
+
+    results = {}
+    header = '%-20s %10s %12s %12s' % ('case', 'size', 'time [s]', 'peak [MB]')
+    print(header)
+    print('-' * len(header))
+    for name in args.cases:
+        if name not in CASES:
+            msg = 'unknown case %s, expected one of %s'
+            raise ValueError(msg%(name, list(CASES)))
+        case, sizes = CASES[name]
+        sizes = [max(int(size * args.scale), 1) for size in sizes]
+
+        times, peaks = [], []
+        for size in sizes:
+            t, peak = measure(case, size, args.repeat)
+            times.append(t); peaks.append(peak)
+            print('%-20s %10d %12.4f %12.2f' % (name, size, t, peak / 1e6))
+        print('%-20s %10s %12.2f %12.2f' % ('', 'exponent',
+              slope(sizes, times), slope(sizes, peaks)))
+
+        results[name] = {
+            'sizes' : sizes,
+            'time' : times,
+            'peak_bytes' : peaks,
+            'time_exponent' : slope(sizes, times),
+            'memory_exponent' : slope(sizes, peaks),
+        }
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent = 2)
+    return results
+
+
+if __name__ == '__main__':
+    main()
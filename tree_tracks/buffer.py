@@ -0,0 +1,121 @@
+#!usr/bin/python3
+
+"""
+This file contains a growable array, used to append snapshots to
+data that was loaded or built for a simulation that is still running.
+
+The array is a view of the start of a larger buffer. Appending writes
+into the spare room of the buffer, and only when it is full is a new
+buffer allocated, a constant factor larger, so that appending a
+snapshot at a time costs time proportional to the new data on
+average instead of copying the whole history every time.
+"""
+
+import numpy as np
+
+
+class GrowBuffer(object):
+    """
+    An array that can be appended to along one axis.
+    """
+
+    def __init__(
+        self,
+        arr : np.ndarray,
+        axis : int = 0,
+        growth : float = 2.0
+    ) -> None:
+        """
+        Args:
+            arr (np.ndarray): the initial contents, which are copied.
+            axis (int, optional): the axis to append along. Defaults
+                to 0.
+            growth (float, optional): factor the buffer grows by when
+                it is full. Defaults to 2.0.
+        """
+        if growth <= 1:
+            msg = 'growth must be larger than 1, got %s'
+            raise ValueError(msg%growth)
+        arr = np.asarray(arr)
+        self.axis = axis % arr.ndim
+        self.growth = growth
+        self.length = arr.shape[self.axis]
+        self._buf = self._allocate(arr, self.length)
+        self._index(self._buf, 0, self.length)[...] = arr
+        return
+
+    def _index(self, arr, start, stop):
+        # the part of arr from start to stop along the axis
+        slc = [slice(None)] * arr.ndim
+        slc[self.axis] = slice(start, stop)
+        return arr[tuple(slc)]
+
+    def _allocate(self, arr, length, dtype = None):
+        shape = list(arr.shape)
+        shape[self.axis] = max(int(length * self.growth), length, 1)
+        return np.empty(shape, dtype = dtype or arr.dtype)
+
+    def _fitType(self, new):
+        # type that holds both the contents and new. Values of another
+        # kind, or longer strings, would otherwise be cut when written
+        # into the buffer
+        dtype = self._buf.dtype
+        if not np.can_cast(new.dtype, dtype, 'same_kind'):
+            return np.promote_types(dtype, new.dtype)
+        if dtype.kind in 'SU' and new.dtype.itemsize > dtype.itemsize:
+            return np.promote_types(dtype, new.dtype)
+        return dtype
+
+    def capacity(self) -> int:
+        return self._buf.shape[self.axis]
+
+    def view(self) -> np.ndarray:
+        """
+        The contents, as a view of the buffer.
+        """
+        return self._index(self._buf, 0, self.length)
+
+    def holds(self, arr : np.ndarray) -> bool:
+        """
+        Whether arr is the current view of this buffer, so that it
+        has not been replaced since it was handed out.
+        """
+        return isinstance(arr, np.ndarray) and arr.base is self._buf and \
+            arr.shape == self.view().shape
+
+    def append(self, new : np.ndarray) -> np.ndarray:
+        """
+        Append new along the axis, returns the view of the contents.
+        """
+        new = np.asarray(new)
+        n = new.shape[self.axis]
+        dtype = self._fitType(new)
+        if self.length + n > self.capacity() or dtype != self._buf.dtype:
+            buf = self._allocate(self._buf, self.length + n, dtype)
+            self._index(buf, 0, self.length)[...] = self.view()
+            self._buf = buf
+        self._index(self._buf, self.length, self.length + n)[...] = new
+        self.length += n
+        return self.view()
+
+
+def appendTo(
+    buffers : dict,
+    name : str,
+    arr : np.ndarray,
+    new : np.ndarray,
+    axis : int = 0
+) -> np.ndarray:
+    """
+    Append new to arr along an axis, through the buffer kept for it
+    in buffers under name. A new buffer is made the first time, or if
+    arr is no longer the buffer's view because it was replaced.
+
+    Returns:
+        np.ndarray: the appended array, a view of the buffer.
+    """
+    buf = buffers.get(name)
+    if buf is None or buf.axis != axis % np.ndim(arr) or not buf.holds(arr):
+        buf = GrowBuffer(arr, axis)
+        buffers[name] = buf
+    return buf.append(new)
@@ -1,4 +1,5 @@
 from .marker import *
 from .marker_funcs import *
 from .decorator import *
-from .common_f import *
\ No newline at end of file
+from .common_f import *
+from .event_table import *
@@ -1,10 +1,13 @@
 
-import copy
+from __future__ import annotations
 import numpy as np
-from typing import Callable, Dict, List, Type, Union, Sequence
+from typing import Callable, Dict, List, Type, Union, Sequence, TYPE_CHECKING
 from tree_tracks.tracker import Tracker
-from plotly.basedatatypes import BaseTraceType
-import plotly.graph_objects as go
+from tree_tracks.lazy import go
+from tree_tracks.instrument import profile
+
+if TYPE_CHECKING:
+    from plotly.basedatatypes import BaseTraceType
 
 
 # a decorator function should take a list of tracker objects, 
@@ -17,6 +20,78 @@ import plotly.graph_objects as go
 DECORATOR_FTYPE = Callable[[List[Tracker]], 
     Union[Dict, Sequence[Dict]]]
 
+class FrameColumns(object):
+    """
+    Columnar storage of the per-snapshot output of a decorator
+    function. Array-valued keyword arguments are concatenated over
+    the snapshots into a single array per key, with an offsets array
+    marking where each snapshot starts, so the arguments of one
+    snapshot are a slice of each column. Other values are stored as
+    they are, once if they are the same for every snapshot.
+    """
+
+    def __init__(self, data : Union[Dict, Sequence[Dict]]) -> None:
+        if isinstance(data, dict):
+            data = [data]
+        self.nframes = len(data)
+        self.columns = {}
+        self.offsets = {}
+        self.static = {}
+        self.objects = {}
+
+        keys = []
+        for frame in data:
+            for k in frame:
+                if k not in keys:
+                    keys.append(k)
+
+        for k in keys:
+            vals = [frame.get(k) for frame in data]
+            if all(FrameColumns._isColumn(v) for v in vals):
+                arrs = [np.asarray(v) for v in vals]
+                lens = [len(arr) for arr in arrs]
+                self.offsets[k] = np.concatenate([[0], np.cumsum(lens)])
+                self.columns[k] = np.concatenate(arrs, axis = 0)
+            elif all(v is vals[0] for v in vals):
+                self.static[k] = vals[0]
+            else:
+                self.objects[k] = vals
+        return
+
+    @staticmethod
+    def _isColumn(val) -> bool:
+        if isinstance(val, np.ndarray):
+            return val.ndim >= 1
+        if isinstance(val, (list, tuple)):
+            return len(val) == 0 or not isinstance(val[0], dict)
+        return False
+
+    def __len__(self) -> int:
+        return self.nframes
+
+    def get(self, snap : int) -> Dict:
+        """
+        Get the keyword arguments of one snapshot. Column values are
+        views into the stored arrays.
+        """
+        if self.nframes == 1:
+            snap = 0
+        elif snap < 0:
+            snap += self.nframes
+        out = dict(self.static)
+        for k, col in self.columns.items():
+            off = self.offsets[k]
+            out[k] = col[off[snap]:off[snap + 1]]
+        for k, vals in self.objects.items():
+            if vals[snap] is not None:
+                out[k] = vals[snap]
+        return out
+
+    def nbytes(self) -> int:
+        return sum(col.nbytes for col in self.columns.values()) + \
+            sum(off.nbytes for off in self.offsets.values())
+
+
 class Decorator(object):
     """
     The decorator class provides a way to plot supplementary
@@ -27,6 +102,10 @@ class Decorator(object):
     A decorator object does three tasks:
 
     1. Creates a dataset to plot from a list of Tracker objects.
+
+    The dataset is cached as FrameColumns, keyed on the identity and
+    version of each tracker it was made from. Changing the tracker
+    list or the data of one of its trackers invalidates the cache.
     
     """
     def __init__(
@@ -36,9 +115,14 @@ class Decorator(object):
     ) -> None:
         self.f = f
         self.plot_args = plot_args
-        self._is_decorated = False
         self.data = None
-        self.plotly_constr = go.Scatter3d
+        # resolved when the first trace is built, see getPlotFunc
+        self.plotly_constr = None
+
+        self._cache_key = None
+        # hold on to the decorated trackers so that their ids are
+        # not reused while the cache key refers to them
+        self._cache_trackers = []
         return
     
     def setPlotArgs(
@@ -57,22 +141,57 @@ class Decorator(object):
         self.plotly_constr = plotly_constr
         return
     
-    def decorate(
+    def getPlotFunc(self) -> Type[BaseTraceType]:
+        if self.plotly_constr is None:
+            return go.Scatter3d
+        return self.plotly_constr
+    
+    def _compatible(
         self,
         trackers : List[Tracker]
-    ) -> None:
+    ) -> List[Tracker]:
         # some trackers need to be excluded from
         # decoration
         tmp = []
         for trk in trackers:
             if trk.getMarkerCompatible():
                 tmp.append(trk)
+        return tmp
+    
+    def _cacheKey(
+        self,
+        trackers : List[Tracker]
+    ) -> tuple:
+        return tuple((id(trk), trk.getVersion()) for trk in trackers)
+    
+    def isCached(
+        self,
+        trackers : List[Tracker]
+    ) -> bool:
+        trackers = self._compatible(trackers)
+        return self._cache_key == self._cacheKey(trackers)
+    
+    def clearCache(self) -> None:
+        self.data = None
+        self._cache_key = None
+        self._cache_trackers = []
+        return
+    
+    @profile('decorator.decorate')
+    def decorate(
+        self,
+        trackers : List[Tracker]
+    ) -> None:
+        trackers = self._compatible(trackers)
 
-        if tmp:
-            self.data = self.f(tmp)
-            
-            self._is_decorated = True
-
+        if trackers:
+            data = self.f(trackers)
+            self.data = FrameColumns(data) if data else None
+        else:
+            self.data = None
+        
+        self._cache_key = self._cacheKey(trackers)
+        self._cache_trackers = trackers
         return
     
     def getEmptyTrace(self) -> BaseTraceType:
@@ -89,48 +208,31 @@ class Decorator(object):
                 the exact type dependent on the constructor
                 given.
         """
-        return self.plotly_constr()
+        return self.getPlotFunc()()
 
+    @profile('decorator.plot')
     def plot(
         self,
         snap : int = -1
     ) -> BaseTraceType:
-        # if decorate was never called, return empty trace
-        if self.data is None:
+        # if decorate was never called, or gave no data, return
+        # empty trace
+        if self.data is None or len(self.data) == 0:
             return self.getEmptyTrace()
-        # if data is empty, return empty trace
-        elif not self.data:
-            return self.getEmptyTrace()
-        # otherwise, make plot
-        else:
-            # organize the plotting function's arguments
-            pltkwargs = {}
-            pltkwargs = copy.deepcopy(self.plot_args)
-
-            # if data is a dictionary, intended for use
-            # on every snapshot.
-            if isinstance(self.data, dict):
-
-                pltkwargs.update(self.data)
-                return self.plotly_constr(**self.data)
-            # if snapshot not provided, default to last
-            # snapshot
-            elif snap == -1:
-                pltkwargs.update(self.data[-1])
-                return self.plotly_constr(**self.data)
-            # otherwise, plot given snapshot
-            else:
-                pltkwargs.update(self.data[snap])
-                return self.plotly_constr(**self.data)
+        
+        # otherwise, make plot. A dictionary from the decorator
+        # function is used on every snapshot, and snap = -1 
+        # defaults to the last snapshot. The plotly constructor
+        # copies its arguments, so a shallow copy is enough.
+        pltkwargs = dict(self.plot_args)
+        pltkwargs.update(self.data.get(snap))
+        return self.getPlotFunc()(**pltkwargs)
 
     def decoratePlot(
         self,
         trackers : List[Tracker],
         snap : int
     ) -> BaseTraceType:
-        if self._is_decorated:
-            return self.plot(snap)
-        else:
+        if not self.isCached(trackers):
             self.decorate(trackers)
-            return self.plot(snap)
-    
+        return self.plot(snap)
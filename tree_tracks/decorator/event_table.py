@@ -0,0 +1,118 @@
+#!usr/bin/python3
+
+"""
+This file contains the definitions for an "EventTable" object.
+
+An event table is a compact columnar record of events (births,
+deaths, pericenters, ...) that happen to a set of trackers, sorted by
+the snapshot the event happens at. Since it is sorted, all of the
+events up to a given snapshot are a prefix of the table, which makes
+accumulating markers over the frames of a movie a single slice.
+"""
+
+import numpy as np
+from typing import List, Sequence
+
+
+class EventTable(object):
+    """
+    Columns of an event table, one row per event:
+
+        trk: index of the tracker the event happened to
+        etype: integer code of the event type, see getTypeNames
+        snap: snapshot the event happened at
+        pos: position of the event, shape (nevents, dim)
+        cdata: list of custom data arrays, one per property
+
+    """
+
+    def __init__(
+        self,
+        trk : np.ndarray,
+        etype : np.ndarray,
+        snap : np.ndarray,
+        pos : np.ndarray,
+        cdata : List[np.ndarray] = [],
+        type_names : Sequence[str] = []
+    ) -> None:
+        order = np.argsort(snap, kind = 'stable')
+        self.trk = np.asarray(trk, dtype = int)[order]
+        self.etype = np.asarray(etype, dtype = np.int8)[order]
+        self.snap = np.asarray(snap, dtype = int)[order]
+        self.pos = np.asarray(pos)[order]
+        self.cdata = [np.asarray(arr)[order] for arr in cdata]
+        self.type_names = list(type_names)
+        return
+
+    def __len__(self) -> int:
+        return len(self.snap)
+
+    def getTypeNames(self) -> List[str]:
+        return self.type_names
+
+    def getTypeCode(self, type_name : str) -> int:
+        if type_name not in self.type_names:
+            msg = 'event type %s not in table, available types are %s'
+            raise KeyError(msg%(type_name, self.type_names))
+        return self.type_names.index(type_name)
+
+    def _take(self, idx) -> 'EventTable':
+        # the rows are already sorted, so bypass the constructor
+        out = EventTable.__new__(EventTable)
+        out.trk = self.trk[idx]
+        out.etype = self.etype[idx]
+        out.snap = self.snap[idx]
+        out.pos = self.pos[idx]
+        out.cdata = [arr[idx] for arr in self.cdata]
+        out.type_names = self.type_names
+        return out
+
+    def count(self, snap : int) -> int:
+        """
+        Number of events that have happened at or before snap.
+        """
+        return int(np.searchsorted(self.snap, snap, side = 'right'))
+
+    def upTo(self, snap : int) -> 'EventTable':
+        """
+        Get the events that have happened at or before the given
+        snapshot, as a view of this table.
+        """
+        return self._take(slice(0, self.count(snap)))
+
+    def select(self, type_name : str) -> 'EventTable':
+        """
+        Get the events of a single type.
+        """
+        code = self.getTypeCode(type_name)
+        return self._take(self.etype == code)
+
+    @staticmethod
+    def concat(tables : Sequence['EventTable']) -> 'EventTable':
+        """
+        Combine event tables into one. Event types with the same name
+        are given the same code.
+        """
+        type_names = []
+        for tab in tables:
+            for name in tab.type_names:
+                if name not in type_names:
+                    type_names.append(name)
+
+        etypes = []
+        for tab in tables:
+            remap = np.array([type_names.index(name)
+                              for name in tab.type_names], dtype = int)
+            etypes.append(remap[tab.etype] if len(remap) else tab.etype)
+
+        ncdata = min([len(tab.cdata) for tab in tables])
+        cdata = [np.concatenate([tab.cdata[i] for tab in tables])
+                 for i in range(ncdata)]
+        return EventTable(
+            np.concatenate([tab.trk for tab in tables]),
+            np.concatenate(etypes),
+            np.concatenate([tab.snap for tab in tables]),
+            np.concatenate([tab.pos for tab in tables]),
+            cdata,
+            type_names
+        )
@@ -7,31 +7,49 @@ This file contains the definitions for an "Marker" object.
 """
 
 import numpy as np
-import plotly.graph_objects as go
+from tree_tracks.lazy import go
 from tree_tracks.tracker.tracker_super import Tracker
+from tree_tracks.tracker.stack import TrackerStack
+from tree_tracks.decorator.event_table import EventTable
+from tree_tracks.instrument import profile, PROFILER
+
+# the ways a marker function can be called
+MARK_FTYPES = ('tracker', 'list', 'batch')
 
 class Marker(object):
 
-    def __init__(self, mark_func, name = '', plot_prop = {}):
+    def __init__(self, mark_func, name = '', plot_prop = {}, f_type = None):
         """_summary_
 
         Args:
-            mark_func (function): A function that either takes a list
-                of trackers or a single tracker instance. The type
-                should be declared in function signature, but will
-                default to single tracker.
+            mark_func (function): A function that takes a single
+                tracker ('tracker'), a list of trackers ('list') or a
+                TrackerStack of all trackers ('batch'), along with
+                the current snapshot. Batch functions return the
+                indices of the trackers that have a marker and the
+                marker positions, with shape (nmarkers, dim).
             plot_prop (dict, optional): _description_. Defaults to {}.
+            f_type (str, optional): how mark_func is called. Defaults
+                to the f_type attribute of mark_func if it has one
+                (see batchMarkFunc), otherwise 'tracker'.
         """
-        # arg_spec = inspect.getfullargspec(mark_func)
-        # annot = arg_spec.annotations[arg_spec.args[0]]
-        # TODO check behavior with different types, change ftype as needed,
-        # throw error if types not understood
-        self.f_type = 'tracker'
+        if f_type is None:
+            f_type = getattr(mark_func, 'f_type', 'tracker')
+        self.setFuncType(f_type)
         self.func = mark_func
+        self.events = None
         self.plot_props = plot_prop
         self.name = name
         return
     
+    def setFuncType(self, f_type):
+        if f_type not in MARK_FTYPES:
+            msg = 'marker function type %s not understood, ' + \
+                'expected one of %s'
+            raise ValueError(msg%(f_type, MARK_FTYPES))
+        self.f_type = f_type
+        return
+    
     def setName(self, name):
         self.name = name
         return
@@ -57,71 +75,143 @@ class Marker(object):
         return
         
     
-    def plot(self, trackers, snap):
-        
+    def _dimPlot(self, dim, pos, cdata):
+        with PROFILER.stage('plotly.trace'):
+            return self._dimTrace(dim, pos, cdata)
+    
+    def _dimTrace(self, dim, pos, cdata):
         # helper function, handles whether to make 2D or 3D plot
-        def _dim_plot(dim, pos, plot_kwargs):
-            if dim == 2:
-                plot_kwargs['x'] = pos[:, 0]
-                plot_kwargs['y'] = pos[:, 1]
-                scat = go.Scatter(**plot_kwargs)
-            elif dim == 3:
-                plot_kwargs['x'] = pos[:, 0]
-                plot_kwargs['y'] = pos[:, 1]
-                plot_kwargs['z'] = pos[:, 2]
-                scat = go.Scatter3d(**plot_kwargs)
-            return scat
+        plot_kwargs = dict(
+            mode = 'markers',
+            marker = self.plot_props,
+            name = self.name
+        )
+        if cdata:
+            cdata = Tracker._reshapeCustom(cdata)
+            plot_kwargs['customdata'] = np.stack(cdata, axis = -1)
         
+        if dim == 2:
+            plot_kwargs['x'] = pos[:, 0]
+            plot_kwargs['y'] = pos[:, 1]
+            scat = go.Scatter(**plot_kwargs)
+        elif dim == 3:
+            plot_kwargs['x'] = pos[:, 0]
+            plot_kwargs['y'] = pos[:, 1]
+            plot_kwargs['z'] = pos[:, 2]
+            scat = go.Scatter3d(**plot_kwargs)
+        return scat
+    
+    def _compatible(self, trackers):
         # remove trackers that are not compatible with markers
         tmp = []
         for trk in trackers:
             if trk.getMarkerCompatible():
                 tmp.append(trk)
-        trackers = tmp
+        return tmp
+    
+    def hasEvents(self) -> bool:
+        """
+        Whether the marker function can produce all of its events at
+        once, see eventMarkFunc.
+        """
+        return hasattr(self.func, 'events')
+    
+    @profile('marker.buildEvents')
+    def buildEvents(self, trackers) -> EventTable:
+        """
+        Evaluate the event function of the marker once for all of
+        the trackers and store the result, so that plotEvents can
+        draw the markers of any snapshot by slicing the table.
+
+        Args:
+            trackers (List[Tracker]): the trackers to find events for.
+
+        Returns:
+            EventTable: the events, with customdata taken at the
+                snapshot of each event.
+        """
+        if not self.hasEvents():
+            msg = 'marker function %s does not provide events'
+            raise ValueError(msg%getattr(self.func, '__name__', self.func))
+        self.setEvents(self._eventTable(self._compatible(trackers)))
+        return self.events
+    
+    def _eventTable(self, trackers):
+        # events of the compatible trackers, None if there are none
+        if not trackers:
+            return None
+        stack = TrackerStack(trackers)
+        rows, snaps, pos = self.func.events(stack)
+        return EventTable(
+            rows, np.zeros(len(rows)), snaps,
+            np.reshape(pos, (-1, stack.dim)),
+            stack.getCustom(rows, snaps),
+            [self.name]
+        )
+    
+    def setEvents(self, events : EventTable):
+        self.events = events
+        return
+    
+    def getEvents(self) -> EventTable:
+        return self.events
+    
+    @profile('marker.plot')
+    def plotEvents(self, snap):
+        """
+        Plot every stored event that happened at or before snap.
+        """
+        return self._plotTable(self.events, snap)
+    
+    def _plotTable(self, events, snap):
+        if events is None or len(events) == 0:
+            return self.getEmptyTrace()
+        
+        shown = events.upTo(snap)
+        is_valid = ~np.isnan(shown.pos[:, 0])
+        cdata = [arr[is_valid] for arr in shown.cdata]
+        return self._dimPlot(shown.pos.shape[1], shown.pos[is_valid], cdata)
+    
+    @profile('marker.plot')
+    def plot(self, trackers, snap):
+        trackers = self._compatible(trackers)
 
         # if there are no trackers, return empty scatter plot
         if len(trackers) == 0:
             return self.getEmptyTrace()
         
+        # custom data of events is taken at the snapshot of each
+        # event, as in the tables used by Movie
+        if self.hasEvents():
+            return self._plotTable(self._eventTable(trackers), snap)
+        
+        dim = trackers[0].dim
         if self.f_type == 'list':
             pos, cdata = self.func(trackers, snap)
         
+        elif self.f_type == 'batch':
+            stack = TrackerStack(trackers)
+            rows, pos = self.func(stack, snap)
+            pos = np.reshape(pos, (-1, dim))
+            cdata = stack.getCustom(rows, snap)
+        
         elif self.f_type == 'tracker':
+            pos_list = []
             cdata = []
-            # handle issue out of bounds issue if no trackers
-            # handle out of bounds if too many output positions
-            
-            pos = np.zeros((len(trackers) * 10, trackers[0].dim))
-            pos[:, :] = np.nan
-            pos_idx = 0
             for i in range(len(trackers)):
                 out_arr, trk_cdata = self.func(trackers[i], snap)
-                pos_slc = slice(pos_idx, pos_idx + out_arr.shape[0])
-                pos[pos_slc, :] = out_arr
-                pos_idx += out_arr.shape[0]
-                cdata.append(trk_cdata)
+                out_arr = np.reshape(out_arr, (-1, dim))
+                pos_list.append(out_arr)
+                cdata.extend([trk_cdata] * out_arr.shape[0])
+            pos = np.concatenate(pos_list, axis = 0)
+            if cdata and len(cdata[0]) > 0:
+                cdata = list(np.array(cdata, dtype = object).T)
+            else:
+                cdata = []
                 
         # handle nans
         nan_mask = np.isnan(pos[:, 0])
         pos = pos[~nan_mask, :]
+        cdata = [arr[~nan_mask] for arr in cdata]
 
-        if cdata:
-            cdata = Tracker._reshapeCustom(cdata)
-            plot_kwargs = dict(
-                mode = 'markers',
-                marker = self.plot_props,
-                customdata=np.stack(cdata, axis = -1),
-                name = self.name
-            )
-        else:
-            
-            plot_kwargs = dict(
-                mode = 'markers',
-                marker = self.plot_props,
-                name = self.name
-            )
-        
-        scat = _dim_plot(trackers[0].dim, pos, plot_kwargs)
-            
-        return scat
-    
+        return self._dimPlot(dim, pos, cdata)
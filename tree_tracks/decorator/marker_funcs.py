@@ -4,98 +4,151 @@
 This file contains the definitions for common marker functions
 """
 
-from tree_tracks.tracker.tracker_super import Tracker
+from tree_tracks.tracker.stack import TrackerStack
+from tree_tracks.decorator.event_table import EventTable
 import numpy as np
+import functools
 
 ### HELPER FUNCTIONS ################################################
 
 def _catch_missing_prop(tracker, propname, funcname):
+    # works with both a single Tracker and a TrackerStack
     try:
         val = tracker.getProp(propname)
     except KeyError:
         msg = '%s markfunc requires %s to be stored in tracker data'
-        raise KeyError(msg%(propname, funcname))
+        raise KeyError(msg%(funcname, propname))
     return val
 
-def _make_nan_arr(tracker):
-    arr = np.empty(tracker.dim) # matches 2D or 3D positions
-    arr[:] = np.nan
-    return arr
-
-def _retrieve_custom_data(tracker, snap):
-
-    cdata = tracker.cdata
-    custom_arr = np.zeros(len(cdata))
-    if cdata:
-        for i in range(len(cdata)):
-            tmp = tracker.getProp(cdata[i], snap)
-            if isinstance(tmp, np.ndarray):
-                tmp = tuple(tmp)
-                custom_arr = np.zeros(len(cdata), dtype = object)
-
-            custom_arr[i] = tmp
-            
-    return custom_arr
+def batchMarkFunc(func):
+    """
+    Flag a marker function as a batch function, so that Marker
+    passes it a TrackerStack of all trackers instead of calling it
+    once per tracker.
+    """
+    func.f_type = 'batch'
+    return func
+
+def eventMarkFunc(events_func):
+    """
+    Make a batch marker function from an event function. Event
+    functions take a TrackerStack and return, for every event, the
+    tracker index, the snapshot it happens at and its position. The
+    resulting marker shows every event that happened at or before
+    the current snapshot, and keeps the event function in its events
+    attribute so that Marker can build an EventTable once instead of
+    reevaluating it every frame.
+    """
+    @functools.wraps(events_func)
+    def mark_func(stack, snap):
+        rows, snaps, pos = events_func(stack)
+        shown = snaps <= snap
+        return rows[shown], pos[shown]
+    
+    mark_func.events = events_func
+    return batchMarkFunc(mark_func)
+
+def _first_true(mask):
+    # index of first true value along the snapshot axis, and whether
+    # there was one
+    has_true = np.any(mask, axis = 1)
+    return np.argmax(mask, axis = 1), has_true
+
+def _last_true(mask):
+    has_true = np.any(mask, axis = 1)
+    return mask.shape[1] - 1 - np.argmax(mask[:, ::-1], axis = 1), has_true
+
+def matchIndex(trk_index : np.ndarray, trk : np.ndarray):
+    """
+    Match the trk column of an event table, which holds object
+    indices, to the trackers with those indices.
+
+    Args:
+        trk_index (np.ndarray): the 'index' property of each tracker.
+        trk (np.ndarray): the object index of each event.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: the tracker row of each matched
+            event, and whether each event has a tracker.
+    """
+    trk_index = np.asarray(trk_index)
+    if not len(trk_index):
+        return np.zeros(0, dtype = np.int64), np.zeros(len(trk), dtype = bool)
+    order = np.argsort(trk_index, kind = 'stable')
+    found = np.searchsorted(trk_index[order], trk)
+    found = np.minimum(found, len(order) - 1)
+    match = trk_index[order][found] == trk
+    return order[found[match]], match
 
 ### MARKER FUNCTIONS ################################################
 
-def birth(tracker : Tracker, snap : int):
-    mask = tracker.getAlive()
-    # get first true value
-    birth_snap = np.argmax(mask)
+# The marker functions below are batch functions built from event
+# functions, see eventMarkFunc. Each returns the indices of the 
+# trackers that have the event, the snapshot of the event and its 
+# position.
 
-    cdata = _retrieve_custom_data(tracker, snap)
+@eventMarkFunc
+def birth(stack : TrackerStack):
+    birth_snap, has_birth = _first_true(stack.getAlive())
+    rows = np.where(has_birth)[0]
+    return rows, birth_snap[rows], stack.pos[rows, birth_snap[rows]]
 
-    if snap >= birth_snap:
-        birth_pos = tracker.getPos(birth_snap)
-        return birth_pos, cdata
-    else:
-        return _make_nan_arr(tracker), cdata
+@eventMarkFunc
+def death(stack : TrackerStack):
+    death_snap, has_death = _last_true(stack.getAlive())
     
-def death(tracker : Tracker, snap : int):
-    mask = tracker.getAlive()
-    
-    # get last true value
-    death_snap = np.max(np.where(mask))
-
-    is_last_snap = death_snap == tracker.dim - 1
-    
-    cdata = _retrieve_custom_data(tracker, snap)
-
-    if snap >= death_snap and not is_last_snap:
+    # trackers alive at the last snapshot have not died
+    is_last_snap = death_snap == stack.numSnaps() - 1
+    rows = np.where(has_death & ~is_last_snap)[0]
+    return rows, death_snap[rows], stack.pos[rows, death_snap[rows]]
 
-        death_pos = tracker.getPos(death_snap)
-        return death_pos, cdata
-    
-    else:
-        return _make_nan_arr(tracker), cdata
-    
-
-def infall(trk : Tracker, snap : int):
+@eventMarkFunc
+def infall(stack : TrackerStack):
     fname = 'infall'
-    tinf = _catch_missing_prop(trk, 'ifl_t_infall', fname)[snap]
-    snapt = _catch_missing_prop(trk, 'snap_t', fname)[snap]
-    iflx = _catch_missing_prop(trk, 'ifl_x', fname)[snap]
-    
-    cdata = _retrieve_custom_data(trk, snap)
-
-    if tinf <= snapt:
-        return iflx, cdata
-    else:
-        return _make_nan_arr(trk), cdata
-
-def pericenter(trk : Tracker, snap : int):
+    tinf = _catch_missing_prop(stack, 'ifl_t_infall', fname)
+    snapt = _catch_missing_prop(stack, 'snap_t', fname)
+    iflx = _catch_missing_prop(stack, 'ifl_x', fname)
+
+    # the infall is marked from the first snapshot after it, at the
+    # infall position stored at that snapshot
+    ifl_snap, has_ifl = _first_true(tinf <= snapt)
+    rows = np.where(has_ifl)[0]
+    return rows, ifl_snap[rows], iflx[rows, ifl_snap[rows]]
+
+@eventMarkFunc
+def pericenter(stack : TrackerStack):
     fname = 'pericenter'
-    had_peri = _catch_missing_prop(trk, 'oct_had_pericenter', fname)
+    had_peri = _catch_missing_prop(stack, 'oct_had_pericenter', fname)
 
     # get first true value
-    first_snap = np.argmax(had_peri)
+    first_snap, has_peri = _first_true(had_peri.astype(bool))
+    rows = np.where(has_peri)[0]
+    return rows, first_snap[rows], stack.pos[rows, first_snap[rows]]
+
+
+def tableMarkFunc(table : EventTable, type_name : str = None):
+    """
+    Make a marker function from an event table that was computed for
+    a whole catalogue, like Tree.mergerEventTable, whose trk column
+    holds object indices in the storage. Events are matched to the
+    trackers by their 'index' property, and events of objects without
+    a tracker are left out.
+
+    Args:
+        table (EventTable): the events.
+        type_name (str, optional): only use events of this type.
+            Defaults to None.
+    """
+    if type_name is not None:
+        table = table.select(type_name)
+
+    @eventMarkFunc
+    def table_events(stack : TrackerStack):
+        # an empty stack has no properties to read
+        index = _catch_missing_prop(stack, 'index', 'table')[:, 0] \
+            if stack.numTrackers() else np.zeros(0, dtype = np.int64)
+        rows, match = matchIndex(index, table.trk)
+        return rows, table.snap[match], table.pos[match]
     
-    cdata = _retrieve_custom_data(trk, snap)
-
-    if snap >= first_snap:
-        pos = trk.getPos(first_snap)
-        return pos, cdata
-    else:
-        return _make_nan_arr(trk), cdata
-
+    table_events.__name__ = type_name or 'table'
+    return table_events
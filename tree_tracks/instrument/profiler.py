@@ -0,0 +1,203 @@
+#!usr/bin/python3
+
+"""
+This file contains an opt-in profiler that records the wall time,
+number of calls and peak allocated memory of the stages of building
+trackers and figures.
+
+Stages are marked in the package with the profile decorator or the
+Profiler.stage context manager. While the profiler is disabled, which
+is the default, a stage costs one attribute lookup.
+
+    from tree_tracks.instrument import profiling
+
+    with profiling() as prof:
+        frames = movie.createFrames(snapshots)
+        fig = movie.createMovie(frames)
+        with prof.stage('serialise'):
+            fig.write_html('movie.html')
+    print(prof.summary())
+"""
+
+import contextlib
+import functools
+import json
+import time
+import tracemalloc
+from typing import Dict
+
+
+class _Frame(object):
+    # an open stage
+    __slots__ = ('name', 'start', 'start_mem', 'peak')
+
+    def __init__(self, name, start_mem):
+        self.name = name
+        self.start = time.perf_counter()
+        self.start_mem = start_mem
+        self.peak = start_mem
+
+
+class Profiler(object):
+    """
+    Accumulates per-stage statistics. Nested stages are allowed, the
+    time and memory of a stage include those of the stages it calls.
+    A stage that is already open, as in a recursive call, is only
+    counted once.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.track_memory = False
+        self.stats = {}
+        self._stack = []
+        self._started_tracemalloc = False
+        return
+
+    def enable(self, memory : bool = True) -> None:
+        """
+        Start recording stages.
+
+        Args:
+            memory (bool, optional): also record peak memory with
+                tracemalloc, which slows down allocations. Defaults
+                to True.
+        """
+        self.track_memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        self.enabled = True
+        return
+
+    def disable(self) -> None:
+        self.enabled = False
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+        self._stack = []
+        return
+
+    def reset(self) -> None:
+        self.stats = {}
+        return
+
+    def _record(self, name, wall, peak):
+        stat = self.stats.setdefault(name, 
+            {'calls' : 0, 'wall' : 0.0, 'peak_bytes' : 0})
+        stat['calls'] += 1
+        stat['wall'] += wall
+        stat['peak_bytes'] = max(stat['peak_bytes'], peak)
+        return
+
+    def _enter(self, name):
+        if any(frame.name == name for frame in self._stack):
+            return None
+        start_mem = 0
+        if self.track_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # the open stages keep their peak before it is reset
+            for frame in self._stack:
+                frame.peak = max(frame.peak, peak)
+            tracemalloc.reset_peak()
+            start_mem = current
+        frame = _Frame(name, start_mem)
+        self._stack.append(frame)
+        return frame
+
+    def _exit(self, frame):
+        wall = time.perf_counter() - frame.start
+        self._stack.remove(frame)
+        peak = 0
+        if self.track_memory:
+            frame.peak = max(frame.peak, tracemalloc.get_traced_memory()[1])
+            peak = frame.peak - frame.start_mem
+            if self._stack:
+                parent = self._stack[-1]
+                parent.peak = max(parent.peak, frame.peak)
+        self._record(frame.name, wall, peak)
+        return
+
+    @contextlib.contextmanager
+    def _stage(self, name):
+        frame = self._enter(name)
+        try:
+            yield self
+        finally:
+            if frame is not None:
+                self._exit(frame)
+
+    def stage(self, name : str):
+        """
+        Context manager that records the enclosed code as a stage.
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return self._stage(name)
+
+    def getStats(self) -> Dict[str, Dict]:
+        return self.stats
+
+    def summary(self) -> str:
+        """
+        Summary table of the recorded stages, sorted by wall time.
+        """
+        header = '%-28s %8s %12s %12s' % ('stage', 'calls', 'wall [s]',
+                                          'peak [MB]')
+        lines = [header, '-' * len(header)]
+        ordered = sorted(self.stats.items(), key = lambda kv: -kv[1]['wall'])
+        for name, stat in ordered:
+            lines.append('%-28s %8d %12.4f %12.2f' % (name, stat['calls'],
+                         stat['wall'], stat['peak_bytes'] / 1e6))
+        return '\n'.join(lines)
+
+    def toJSON(self, path : str = None) -> str:
+        """
+        The recorded stages as JSON, also written to path if given.
+        """
+        out = json.dumps(self.stats, indent = 2)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(out)
+        return out
+
+
+_NULL_STAGE = contextlib.nullcontext()
+
+# the profiler used by the package
+PROFILER = Profiler()
+
+
+def profile(name : str):
+    """
+    Decorator that records every call of the function as a stage of
+    the package profiler.
+    """
+    def wrap(func):
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            if not PROFILER.enabled:
+                return func(*args, **kwargs)
+            with PROFILER._stage(name):
+                return func(*args, **kwargs)
+        return inner
+    return wrap
+
+
+@contextlib.contextmanager
+def profiling(memory : bool = True, reset : bool = True):
+    """
+    Enable the package profiler for the enclosed code.
+
+    Args:
+        memory (bool, optional): record peak memory. Defaults to True.
+        reset (bool, optional): clear earlier statistics. Defaults to
+            True.
+    """
+    if reset:
+        PROFILER.reset()
+    PROFILER.enable(memory)
+    try:
+        yield PROFILER
+    finally:
+        PROFILER.disable()
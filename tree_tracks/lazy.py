@@ -0,0 +1,42 @@
+#!usr/bin/python3
+
+"""
+This file contains a lazy module loader, used so that the storage and
+tracker data paths can be imported without importing plotly. The
+plotting backend is imported the first time one of its attributes is
+used, usually when the first trace is built.
+"""
+
+import importlib
+from tree_tracks.instrument import PROFILER
+
+
+class LazyModule(object):
+    """
+    Stands in for a module and imports it on first attribute access.
+    """
+
+    def __init__(self, name : str) -> None:
+        self._name = name
+        self._module = None
+        return
+
+    def _load(self):
+        if self._module is None:
+            with PROFILER.stage('import.' + self._name):
+                self._module = importlib.import_module(self._name)
+        return self._module
+
+    def isLoaded(self) -> bool:
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self) -> str:
+        state = 'loaded' if self.isLoaded() else 'not loaded'
+        return "<lazy module '%s' (%s)>" % (self._name, state)
+
+
+# plotly graph objects, shared by the whole package
+go = LazyModule('plotly.graph_objects')
@@ -1,5 +1,9 @@
+from .simulation import *
+from .storage import *
 from .tree import *
 from .vines import *
-from .simulation import *
 from .bush import *
-from .storage import *
+from .synthetic import *
+from .virtual import *
+from .cache import *
+from .stream import *
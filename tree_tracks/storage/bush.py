@@ -1,6 +1,7 @@
 #!usr/bin/python3
 from typing import Sequence, List
 import numpy as np
+from tree_tracks.instrument import profile
 from tree_tracks.storage import Simulation, Storage
 from tree_tracks.tracker import Trajectory
 from tree_tracks.tracker.tracker_super import Tracker
@@ -35,14 +36,27 @@ class Bush(Storage):
         return trackers
     
 
+    @profile('bush.trackerBox')
     def trackerBox(
         self,
         center : np.ndarray,
         side_length : float,
         snap_count : int
     ) -> List[Tracker]:
+        params = {'center' : np.asarray(center),
+                  'side_length' : float(side_length),
+                  'snap_count' : int(snap_count)}
+        return self._cached('trackerBox', params,
+            lambda : self._trackerBox(center, side_length, snap_count))
+    
+    def _trackerBox(
+        self,
+        center : np.ndarray,
+        side_length : float,
+        snap_count : int
+    ) -> List[Tracker]:
         
-        pos = self.get(self.POS_KEY)
+        pos = np.array(self.get(self.POS_KEY), dtype = float)
         pos = self._setPosNan(pos)
         dif = np.abs(pos[:, :, :] - center[:, np.newaxis, :])
         in_side_mask = dif <= side_length / 2
@@ -0,0 +1,218 @@
+#!usr/bin/python3
+
+"""
+This file contains the definitions for a "TrackerCache" object.
+
+Building trackers from a tree traversal or a box query can take a
+long time, and gives the same trackers every time for the same data
+and query. A TrackerCache saves built tracker sets to disk as a
+directory of .npy files, keyed by a hash of the source data and the
+query parameters, and memory-maps them back on a cache hit.
+"""
+
+import hashlib
+import importlib
+import json
+import os
+import shutil
+import numpy as np
+from typing import Callable, Dict, List
+from tree_tracks.tracker.tracker_super import Tracker
+from tree_tracks.tracker.stack import stackPos
+from tree_tracks.storage.virtual import VirtualField, memmapOffset
+
+
+def _hashArray(h, arr : np.ndarray) -> None:
+    h.update(str((arr.shape, arr.dtype.str, arr.dtype.names)).encode())
+    filename = getattr(arr, 'filename', None)
+    offset = memmapOffset(arr) if filename is not None else None
+    if offset is not None and os.path.exists(filename):
+        # memory-mapped arrays are identified by their file instead of
+        # reading the whole file. Views keep the offset of the mapping,
+        # so the part of the file they cover is given by their own
+        # offset and strides
+        stat = os.stat(filename)
+        h.update(str((filename, stat.st_size, stat.st_mtime_ns, offset,
+                      arr.strides)).encode())
+    else:
+        h.update(np.ascontiguousarray(arr).view(np.uint8).data)
+    return
+
+
+def dataIdentity(*objs) -> str:
+    """
+    Hash the content of arrays, dictionaries of arrays, simulations
+    and plain values into a hex string, used to identify the source
+    data of a tracker set.
+    """
+    h = hashlib.blake2b(digest_size = 16)
+    for obj in objs:
+        if isinstance(obj, np.ndarray):
+            _hashArray(h, obj)
+        elif isinstance(obj, VirtualField):
+            # shards on disk are identified by their files
+            h.update(dataIdentity(*obj.identity()).encode())
+        elif isinstance(obj, dict):
+            for k in sorted(obj):
+                h.update(str(k).encode())
+                h.update(dataIdentity(obj[k]).encode())
+        elif hasattr(obj, 'getBox') and hasattr(obj, 'getTime'):
+            h.update(str(obj.getBox()).encode())
+            _hashArray(h, np.asarray(obj.getTime()))
+        elif isinstance(obj, (list, tuple)):
+            h.update(dataIdentity(*obj).encode())
+        else:
+            h.update(repr(obj).encode())
+    return h.hexdigest()
+
+
+class TrackerCache(object):
+    """
+    Size-bounded on-disk cache of tracker sets. Each entry is a
+    directory holding the stacked positions, one file per stacked
+    property and a meta.json with the tracker constructor and custom
+    data settings. When the total size goes over max_bytes, the least
+    recently used entries are removed.
+    """
+
+    def __init__(self, directory : str, max_bytes : int = 2**32) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok = True)
+        return
+
+    def key(self, source_id : str, query : str, params : Dict = {}) -> str:
+        """
+        Make the key of an entry.
+
+        Args:
+            source_id (str): identity of the source data, for example
+                from Storage.getIdentity.
+            query (str): name of the operation that built the trackers.
+            params (Dict, optional): parameters of the operation.
+                Defaults to {}.
+        """
+        return dataIdentity(source_id, query, params)
+
+    def _path(self, key : str) -> str:
+        return os.path.join(self.directory, key)
+
+    def has(self, key : str) -> bool:
+        return os.path.exists(os.path.join(self._path(key), 'meta.json'))
+
+    def save(self, key : str, trackers : List[Tracker]) -> None:
+        """
+        Save a list of trackers. Only properties that every tracker
+        has, with the same shape, are saved.
+        """
+        if not trackers:
+            return
+        path = self._path(key)
+        tmp = path + '.tmp'
+        shutil.rmtree(tmp, ignore_errors = True)
+        os.makedirs(tmp)
+
+        np.save(os.path.join(tmp, 'pos.npy'), stackPos(trackers))
+        props = []
+        for name in trackers[0].props:
+            vals = [trk.props.get(name) for trk in trackers]
+            if any(not isinstance(v, np.ndarray) for v in vals):
+                continue
+            if any(v.shape != vals[0].shape for v in vals):
+                continue
+            np.save(os.path.join(tmp, 'prop_%d.npy' % len(props)),
+                    np.stack(vals, axis = 0))
+            props.append(name)
+
+        const = type(trackers[0])
+        meta = {
+            'track_const' : const.__module__ + ':' + const.__qualname__,
+            'ntrackers' : len(trackers),
+            'props' : props,
+            'cdata' : list(trackers[0].cdata),
+        }
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        shutil.rmtree(path, ignore_errors = True)
+        os.replace(tmp, path)
+        self._evict(keep = key)
+        return
+
+    def load(self, key : str) -> List[Tracker]:
+        """
+        Load a list of trackers, or None if the key is not cached. The
+        arrays are memory-mapped copy-on-write, so they are only read
+        from disk when used and changing them does not change the
+        cache.
+        """
+        if not self.has(key):
+            return None
+        path = self._path(key)
+        meta_path = os.path.join(path, 'meta.json')
+        with open(meta_path) as f:
+            meta = json.load(f)
+        os.utime(meta_path)
+
+        module, qualname = meta['track_const'].split(':')
+        const = importlib.import_module(module)
+        for attr in qualname.split('.'):
+            const = getattr(const, attr)
+
+        pos = np.load(os.path.join(path, 'pos.npy'), mmap_mode = 'c')
+        props = [np.load(os.path.join(path, 'prop_%d.npy' % i),
+                         mmap_mode = 'c')
+                 for i in range(len(meta['props']))]
+
+        trackers = []
+        for i in range(meta['ntrackers']):
+            trk_props = {name : arr[i]
+                         for name, arr in zip(meta['props'], props)}
+            trk = const(pos[i], trk_props)
+            trk.setCustom(list(meta['cdata']))
+            trackers.append(trk)
+        return trackers
+
+    def fetch(self, key : str, build : Callable[[], List[Tracker]]) -> List[Tracker]:
+        """
+        Load the trackers for key, or build and save them if they are
+        not cached.
+        """
+        trackers = self.load(key)
+        if trackers is None:
+            trackers = build()
+            self.save(key, trackers)
+        return trackers
+
+    def _entries(self) -> List[tuple]:
+        # (last use, size, key) of every entry
+        entries = []
+        for key in os.listdir(self.directory):
+            path = self._path(key)
+            meta_path = os.path.join(path, 'meta.json')
+            if not os.path.exists(meta_path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f))
+                       for f in os.listdir(path))
+            entries.append((os.path.getmtime(meta_path), size, key))
+        return entries
+
+    def nbytes(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self, keep : str = None) -> None:
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._path(key), ignore_errors = True)
+            total -= size
+        return
+
+    def clear(self) -> None:
+        for _, _, key in self._entries():
+            shutil.rmtree(self._path(key), ignore_errors = True)
+        return
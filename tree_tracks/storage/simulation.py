@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 import numpy as np
+from tree_tracks.buffer import appendTo
 
 class Simulation(object):
 
@@ -9,6 +10,7 @@ class Simulation(object):
         ) -> None:
         self.box = boxsize
         self.time = time
+        self._buffers = {}
         return
 
     def getSnaps(self) -> int:
@@ -19,3 +21,29 @@ class Simulation(object):
     
     def getBox(self) -> float:
         return self.box
+    
+    def subset(self, tslc) -> 'Simulation':
+        """
+        Simulation with only the given snapshots.
+        """
+        return Simulation(self.box, np.asarray(self.time)[tslc])
+    
+    def appendSnaps(self, time : np.ndarray) -> None:
+        """
+        Add snapshots at the end, with the given times.
+        """
+        self.time = appendTo(self._buffers, 'time', np.asarray(self.time),
+                             np.atleast_1d(time))
+        return
+    
+    def getDefaults(self) -> dict:
+        # properties given to every tracker, with shape (nsnaps,)
+        return {'snap_t' : self.time}
+    
+    def wrapDelta(self, delta : np.ndarray) -> np.ndarray:
+        """
+        Wrap separations between positions in the periodic box into
+        the range [-box / 2, box / 2).
+        """
+        half = self.box / 2
+        return delta - self.box * np.floor((delta + half) / self.box)
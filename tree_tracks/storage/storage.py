@@ -2,14 +2,37 @@
 
 from tree_tracks.tracker import Trajectory, Tracker
 from tree_tracks.storage.simulation import Simulation
+from tree_tracks.storage.cache import TrackerCache, dataIdentity
+from tree_tracks.storage.virtual import VirtualField
+from tree_tracks.buffer import appendTo
 from typing import Callable, List, Sequence, Union, Dict, Collection
 from abc import abstractmethod
 import numpy as np
 import copy
+from tree_tracks.instrument import profile
 # this type is used often, basically represents various ways of 
 # indexing a numpy array
 ArrIndexTypes = Union[int, slice, Sequence[int], np.ndarray]
-TrackerConstType = Callable[[np.ndarray, Dict[str, np.ndarray]]]
+TrackerConstType = Callable[[np.ndarray, Dict[str, np.ndarray]], Tracker]
+
+
+class _Fields(dict):
+    # the fields of a chunk of objects, normalized by Storage.select
+    # when they are first used
+    def __init__(self, storage, tidx, oidx):
+        super().__init__()
+        self.storage = storage
+        self.tidx = tidx
+        self.oidx = oidx
+        return
+
+    def __missing__(self, key):
+        # a KeyError lets eval look the name up in its globals next
+        if key not in self.storage._getAllProps():
+            msg = 'field %s not found, available fields are %s'
+            raise KeyError(msg%(key, self.storage._getAllProps()))
+        self[key] = self.storage._normalized(key, self.tidx, self.oidx)
+        return self[key]
 
 
 class Storage(object):
@@ -21,7 +44,8 @@ class Storage(object):
         1. Manage a dataset of particles. Storage objects will
         provide methods to access and manipulate the data within
         the dataset. The dataset is assumed
-        to be a dictionary of numpy arrays or a numpy structured
+        to be a dictionary of numpy arrays (or of VirtualFields, for
+        data split across files) or a numpy structured
         array. The arrays should be 2D, with the time and object axes
         in any order, assuming that the size of each axis is
         different. Arrays can also be 1D if the two axes are of
@@ -46,6 +70,10 @@ class Storage(object):
     POS_KEY = 'x'
     ID_KEY = 'id'
 
+    # attributes that hold the dataset, shared with worker processes
+    # by visual.batch
+    DATA_ATTRS = ('data',)
+
     def __init__(
             self,
             data : Union[np.ndarray, Dict[str, np.ndarray]],
@@ -57,14 +85,23 @@ class Storage(object):
         self.track_const = track_const
 
         self.def_props = []
+        self.cache = None
+        self._identity = None
+        # growth buffers of the fields extended by appendSnaps
+        self._buffers = {}
+
+        # object and snapshot indices in the parent storage, set for
+        # storages made by subset
+        self.parent_oidx = None
+        self.parent_tidx = None
 
         # default time and obj axis behavior, using ID array
         self._tax = None
         self._oax = None
         self.nobj = -1
-        if self.ID_KEY in data:
+        if self.ID_KEY in self._getAllProps():
             nsnaps = self.sim.getSnaps()
-            id_shape = data[self.ID_KEY]
+            id_shape = data[self.ID_KEY].shape
             for i in range(len(id_shape)):
                 if id_shape[i] == nsnaps:
                     self._setTimeAx(i)
@@ -96,25 +133,35 @@ class Storage(object):
         shape : Sequence[int]
     ) -> tuple:
         dim = len(shape) # number of dimensions
-        # the axis that has the same length as number of
-        # snapshots is assumed to be the time axis
         nsnaps = self.sim.getSnaps()
-        slc = None
         
-        def _slcHelp(dim_size):
-            if dim_size == nsnaps:
-                return tslc
-            elif dim_size == self.nobj:
-                return oslc
-            else:
-                return slice(None)
+        # arrays laid out like the ID array use the axes found from it,
+        # and any further axes, like the components of positions, are
+        # kept whole even if their size matches an axis
+        tax, oax = self._tax, self._oax
+        if tax is not None and oax is not None and dim > max(tax, oax) \
+                and shape[tax] == nsnaps and shape[oax] == self.nobj:
+            slc_list = [slice(None)] * dim
+            slc_list[tax] = tslc
+            slc_list[oax] = oslc
+            return tuple(slc_list)
         
+        # otherwise the axis that has the same length as the number of
+        # snapshots is assumed to be the time axis, and the one with
+        # the number of objects the object axis. Each is used once, at
+        # the first axis that matches
         slc_list = []
+        has_t = has_o = False
         for i in range(dim):
-            slc_list.append(_slcHelp(shape[i]))
-        slc = tuple(slc_list)
-            
-        return slc
+            if shape[i] == nsnaps and not has_t:
+                slc_list.append(tslc)
+                has_t = True
+            elif shape[i] == self.nobj and not has_o:
+                slc_list.append(oslc)
+                has_o = True
+            else:
+                slc_list.append(slice(None))
+        return tuple(slc_list)
 
     def setPosKey(self, pos_key : str) -> None:
         self.POS_KEY = pos_key
@@ -124,6 +171,7 @@ class Storage(object):
         self.ID_KEY = id_key
         return
     
+    @profile('storage.get')
     def get(
         self,
         prop : Union[str, Sequence[str]] = '',
@@ -161,13 +209,299 @@ class Storage(object):
         return out
     
     def idToIdx(self, obj_id : Union[int, Sequence[int]]):
-        ids = self.data[self.ID_KEY]
+        ids = np.asarray(self.data[self.ID_KEY])
         idxs = np.where(obj_id == ids)
         if not idxs:
             raise ValueError(f'no matches found for ID {obj_id}')
         else:
             return idxs[self._oax]
     
+    def _gather(
+        self,
+        arr : np.ndarray,
+        tidx : np.ndarray,
+        oidx : np.ndarray
+    ) -> np.ndarray:
+        # the selected snapshots and objects of an array, gathered with
+        # a single fancy index. The index arrays are broadcast against
+        # each other, so both axes are selected at once
+        slc = self._getSlc(tidx, oidx, arr.shape)
+        naxes = max([i + 1 for i, s in enumerate(slc)
+                     if not isinstance(s, slice)] + [0])
+        index = []
+        for i in range(naxes):
+            idx = slc[i]
+            if isinstance(idx, slice):
+                idx = np.arange(arr.shape[i])[idx]
+            shape = [1] * naxes
+            shape[i] = -1
+            index.append(np.reshape(idx, shape))
+        return np.ascontiguousarray(arr[tuple(index)])
+    
+    def subset(
+        self,
+        oslc : ArrIndexTypes = slice(None),
+        tslc : ArrIndexTypes = slice(None)
+    ) -> 'Storage':
+        """
+        Make a new storage of the same class that only holds the
+        given objects and snapshots. All fields are gathered once into
+        contiguous arrays, so later work on the subset does not touch
+        the full dataset.
+
+        Args:
+            oslc (ArrIndexTypes, optional): objects to keep. Defaults
+                to slice(None).
+            tslc (ArrIndexTypes, optional): snapshots to keep, in
+                increasing order for the trackers to make sense.
+                Defaults to slice(None).
+
+        Returns:
+            Storage: the subset, with its own Simulation. Its object
+                indices map back to this storage through getParentIdx,
+                and trackers made from it have the parent indices in
+                their 'index' property.
+        """
+        if self.nobj < 0:
+            msg = 'the object axis is not known, so a subset cannot ' + \
+                'be made. Is the ID key %s in the data?'
+            raise ValueError(msg%self.ID_KEY)
+        oidx = np.atleast_1d(np.arange(self.nobj)[oslc])
+        tidx = np.atleast_1d(np.arange(self.sim.getSnaps())[tslc])
+
+        if isinstance(self.data, dict):
+            data = {key : self._gather(arr, tidx, oidx)
+                    for key, arr in self.data.items()}
+        else:
+            # a structured array gathers every field at once
+            data = self._gather(self.data, tidx, oidx)
+
+        sub = copy.copy(self)
+        sub._buffers = {}
+        sub.data = data
+        sub.sim = self.sim.subset(tidx)
+        sub.nobj = len(oidx)
+        sub.def_props = list(self.def_props)
+        sub._identity = None
+        sub.parent_oidx = self.getParentIdx(oidx)
+        sub.parent_tidx = tidx if self.parent_tidx is None \
+            else self.parent_tidx[tidx]
+        return sub
+    
+    def getParentIdx(self, idx : ArrIndexTypes) -> np.ndarray:
+        """
+        Object indices in the storage this one was made from with
+        subset, following subsets of subsets back to the original.
+        Without a parent, the indices are returned unchanged.
+        """
+        if self.parent_oidx is None:
+            return idx
+        return self.parent_oidx[idx]
+    
+    def getParentSnap(self, snap : ArrIndexTypes) -> np.ndarray:
+        """
+        Snapshot indices in the storage this one was made from with
+        subset, see getParentIdx.
+        """
+        if self.parent_tidx is None:
+            return snap
+        return self.parent_tidx[snap]
+    
+    def _normalized(
+        self,
+        prop : str,
+        tidx : np.ndarray,
+        oidx : np.ndarray
+    ) -> np.ndarray:
+        # a field for the given snapshots and objects, with the time
+        # axis first and the object axis second. Fields without one of
+        # the axes get a length one axis in its place
+        arr = self.data[prop]
+        slc = self._getSlc(tidx, oidx, arr.shape)
+        out = self._gather(arr, tidx, oidx)
+        kinds = []
+        for s in slc:
+            if s is tidx:
+                kinds.append('t')
+            elif s is oidx:
+                kinds.append('o')
+            else:
+                kinds.append(None)
+        for kind in ['o', 't']:
+            if kind in kinds:
+                out = np.moveaxis(out, kinds.index(kind), 0)
+                kinds.insert(0, kinds.pop(kinds.index(kind)))
+            else:
+                out = out[np.newaxis]
+                kinds.insert(0, kind)
+        return out
+    
+    @profile('storage.select')
+    def select(
+        self,
+        expr : Union[str, Callable[[Dict[str, np.ndarray]], np.ndarray]],
+        tslc : ArrIndexTypes = slice(None),
+        min_snaps : int = 1,
+        oslc : ArrIndexTypes = slice(None),
+        chunk_size : int = 65536
+    ) -> np.ndarray:
+        """
+        Find the objects that satisfy a condition on their fields.
+
+        The condition is evaluated on every field it uses with the
+        time axis first and the object axis second, so it can be
+        written without knowing how the fields are laid out, for
+        example 'M200m > 1e12' or '(x[..., 0] < 50) & mask_alive'.
+        Numpy is available as np. The objects are processed in chunks,
+        so memory-mapped data is only read a chunk at a time.
+
+        Args:
+            expr (Union[str, Callable]): an expression over the field
+                names, or a function that takes a dictionary of the
+                fields and returns the condition.
+            tslc (ArrIndexTypes, optional): snapshots to evaluate the
+                condition at. Defaults to slice(None).
+            min_snaps (int, optional): number of those snapshots the
+                condition must hold for. Defaults to 1.
+            oslc (ArrIndexTypes, optional): candidate objects, for
+                example the result of another select. Defaults to
+                slice(None).
+            chunk_size (int, optional): objects per chunk. Defaults
+                to 65536.
+
+        Returns:
+            np.ndarray: indices of the selected objects, which can be
+                given to createTrack or subset.
+        """
+        if self.nobj < 0:
+            msg = 'the object axis is not known, so objects cannot ' + \
+                'be selected. Is the ID key %s in the data?'
+            raise ValueError(msg%self.ID_KEY)
+        tidx = np.atleast_1d(np.arange(self.sim.getSnaps())[tslc])
+        cand = np.atleast_1d(np.arange(self.nobj)[oslc])
+        if isinstance(expr, str):
+            code = compile(expr, '<select>', 'eval')
+
+        selected = []
+        for start in range(0, len(cand), chunk_size):
+            oidx = cand[start:start + chunk_size]
+            fields = _Fields(self, tidx, oidx)
+            if isinstance(expr, str):
+                res = eval(code, {'np' : np, '__builtins__' : {}}, fields)
+            else:
+                res = expr(fields)
+            res = np.asarray(res, dtype = bool)
+            if res.ndim == 1:
+                res = res[np.newaxis]
+            if res.ndim != 2:
+                msg = 'the condition must give one value per snapshot ' + \
+                    'and object, got shape %s'
+                raise ValueError(msg%(res.shape,))
+            res = np.broadcast_to(res, (len(tidx), len(oidx)))
+            selected.append(oidx[np.sum(res, axis = 0) >= min_snaps])
+        if not selected:
+            return np.zeros(0, dtype = int)
+        return np.concatenate(selected)
+    
+    def _timeAxis(self, shape : Sequence[int]) -> int:
+        # the time axis of an array of the given shape, or None
+        tmark, omark = object(), object()
+        slc = self._getSlc(tmark, omark, shape)
+        for i, s in enumerate(slc):
+            if s is tmark:
+                return i
+        return None
+    
+    def appendSnaps(
+        self,
+        new_data : Union[np.ndarray, Dict[str, np.ndarray]],
+        time : np.ndarray
+    ) -> None:
+        """
+        Add snapshots at the end of the dataset, for a simulation that
+        is still running. The objects stay the same. Fields grow in
+        place with spare room, so the cost of an update is
+        proportional to the new snapshots. Memory-mapped fields are
+        read into memory the first time; virtual fields split by
+        snapshot get the new data as another shard instead.
+
+        Args:
+            new_data (Union[np.ndarray, Dict[str, np.ndarray]]): the
+                new snapshots of every field that has a time axis,
+                laid out like the existing fields.
+            time (np.ndarray): times of the new snapshots.
+        """
+        if self.parent_tidx is not None:
+            msg = 'snapshots cannot be appended to a subset, append ' + \
+                'them to the full storage and take the subset again'
+            raise ValueError(msg)
+        time = np.atleast_1d(time)
+        if isinstance(self.data, dict):
+            fields = [(key, arr, self._timeAxis(arr.shape))
+                      for key, arr in self.data.items()]
+            missing = [key for key, arr, ax in fields
+                       if ax is not None and key not in new_data]
+            if missing:
+                msg = 'the new snapshots need values for the fields %s'
+                raise ValueError(msg%missing)
+            for key, arr, ax in fields:
+                if ax is None:
+                    continue
+                new = new_data[key]
+                if np.shape(new)[ax] != len(time):
+                    msg = 'got %d snapshots of %s for %d new times'
+                    raise ValueError(msg%(np.shape(new)[ax], key,
+                                          len(time)))
+                if isinstance(arr, VirtualField):
+                    if arr.axis != ax:
+                        msg = 'virtual field %s is not split by snapshot'
+                        raise ValueError(msg%key)
+                    arr.appendShard(new)
+                else:
+                    self.data[key] = appendTo(self._buffers, key, arr,
+                                              new, ax)
+        else:
+            ax = self._timeAxis(self.data.shape)
+            self.data = appendTo(self._buffers, '__data__', self.data,
+                                 new_data, ax)
+        self.sim.appendSnaps(time)
+        self._identity = None
+        return
+    
+    def extendTracks(self, trackers : List[Tracker]) -> List[Tracker]:
+        """
+        Extend trackers made by createTrack to the snapshots added
+        since, in place. Only the new snapshots are read.
+
+        Args:
+            trackers (List[Tracker]): the trackers.
+
+        Returns:
+            List[Tracker]: the same trackers.
+        """
+        nsnaps = self.sim.getSnaps()
+        for trk in trackers:
+            start = len(trk.pos)
+            if start == nsnaps:
+                continue
+            if start > nsnaps:
+                msg = 'tracker has %d snapshots, more than the %d ' + \
+                    'of the storage'
+                raise ValueError(msg%(start, nsnaps))
+            idx = int(trk.getProp('index')[0])
+            tslc = slice(start, nsnaps)
+            pos = np.array(self.get(self.POS_KEY, tslc, idx), dtype = float)
+            props = self.get(self.def_props, tslc, idx)
+            props['index'] = np.zeros((nsnaps - start), dtype = int) + idx
+            props = self._extendProps(trk, props, nsnaps - start)
+            trk.appendSnaps(self._setPosNan(pos), props)
+        return trackers
+    
+    def _extendProps(self, trk : Tracker, props : Dict, nnew : int) -> Dict:
+        # values of the new snapshots for properties that subclasses
+        # add to their trackers, which are not in the data
+        return props
+    
     def getKeynames(self) -> str:
 
         out = 'EXPECTED KEYNAMES'
@@ -177,8 +511,43 @@ class Storage(object):
                 out+='\n'
         return out
 
+    def getIdentity(self) -> str:
+        """
+        Hash of the dataset and simulation, computed once. Used to key
+        cached tracker sets.
+        """
+        if self._identity is None:
+            self._identity = dataIdentity(
+                self.__class__.__name__, self.data, self.sim)
+        return self._identity
+
     ##### CREATING TRACKERS #########################################
     
+    def setCache(self, cache : TrackerCache) -> None:
+        """
+        Set an on-disk cache for the tracker sets built by this
+        storage, or None to turn caching off.
+        """
+        self.cache = cache
+        return
+    
+    def _cached(
+        self,
+        query : str,
+        params : Dict,
+        build : Callable[[], List[Tracker]]
+    ) -> List[Tracker]:
+        # build the trackers, going through the cache if there is one
+        if self.cache is None:
+            return build()
+        const = self.track_const
+        params = dict(params, def_props = list(self.def_props),
+            track_const = getattr(const, '__qualname__', repr(const)),
+            pos_key = self.POS_KEY, id_key = self.ID_KEY)
+        key = self.cache.key(self.getIdentity(), query, params)
+        return self.cache.fetch(key, build)
+    
+    @profile('storage.createTrack')
     def createTrack(
             self,
             idx : int
@@ -189,7 +558,8 @@ class Storage(object):
         pos = copy.deepcopy(self.get(self.POS_KEY, oslc = idx))
         props = copy.deepcopy(self.get(self.def_props, oslc = idx))
         nsnaps = self.sim.getSnaps()
-        props['index'] = np.zeros((nsnaps), dtype = int) + idx
+        props['index'] = np.zeros((nsnaps), dtype = int) + \
+            self.getParentIdx(idx)
 
         # set invalid position values to np.nan instead of -1
         pos = self._setPosNan(pos)
@@ -198,9 +568,10 @@ class Storage(object):
         return self.track_const(pos, props)
     
     def _setPosNan(self, pos : np.ndarray) -> np.ndarray:
-        not_alive = np.all(pos == -1, axis = 1)
-        tslc = self._getSlc(not_alive, slice(None), pos.shape)
-        pos[tslc] = np.nan
+        # the last axis holds the position components, so this
+        # works for one or many objects
+        not_alive = np.all(pos == -1, axis = -1)
+        pos[not_alive] = np.nan
         return pos
     
     def setTrackConst(
@@ -0,0 +1,122 @@
+#!usr/bin/python3
+
+"""
+This file contains helpers to read data ahead of where it is used.
+
+Reading tracer blocks from memory-mapped or per-file arrays is mostly
+waiting on the disk, which does not hold the GIL, so a background
+thread can read the next few blocks while the current one is being
+processed. The read-ahead is bounded by the size of a queue, so the
+memory used stays constant however many blocks there are.
+"""
+
+import os
+import queue
+import threading
+import numpy as np
+from typing import Dict, Iterable, Iterator
+
+
+class _Error(object):
+    # wraps an exception raised in the reading thread
+    def __init__(self, exc):
+        self.exc = exc
+
+
+_DONE = object()
+
+
+def prefetch(items : Iterable, read_ahead : int = 2) -> Iterator:
+    """
+    Iterate over items, evaluating up to read_ahead of them ahead of
+    time in a background thread.
+
+    Args:
+        items (Iterable): the items, usually a generator that reads
+            blocks of data.
+        read_ahead (int, optional): maximum number of items waiting
+            to be used. With 0 the items are evaluated in the calling
+            thread. Defaults to 2.
+
+    Yields:
+        the items, in order. Exceptions raised while evaluating an
+        item are raised here.
+    """
+    if read_ahead <= 0:
+        yield from items
+        return
+
+    buffer = queue.Queue(maxsize = read_ahead)
+    stop = threading.Event()
+
+    def _put(item):
+        # give up if the consumer stopped early
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read():
+        try:
+            for item in items:
+                if not _put(item):
+                    return
+        except BaseException as exc:
+            _put(_Error(exc))
+            return
+        _put(_DONE)
+
+    thread = threading.Thread(target = _read, daemon = True)
+    thread.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is _DONE:
+                break
+            if isinstance(item, _Error):
+                raise item.exc
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+    return
+
+
+def loadDirectory(directory : str, mmap_mode : str = 'r') -> Dict[str, np.ndarray]:
+    """
+    Load a directory with one .npy file per field into a dictionary,
+    memory-mapped so that nothing is read until it is used.
+
+    Args:
+        directory (str): the directory, field names are the file names
+            without the extension.
+        mmap_mode (str, optional): see np.load. None reads the arrays
+            into memory. Defaults to 'r'.
+
+    Returns:
+        Dict[str, np.ndarray]: the fields.
+    """
+    data = {}
+    for fname in sorted(os.listdir(directory)):
+        name, ext = os.path.splitext(fname)
+        if ext == '.npy':
+            data[name] = np.load(os.path.join(directory, fname),
+                                 mmap_mode = mmap_mode)
+    if not data:
+        msg = 'no .npy files found in %s'
+        raise ValueError(msg%directory)
+    return data
+
+
+def saveDirectory(directory : str, data : Dict[str, np.ndarray]) -> None:
+    """
+    Save a dictionary of arrays as one .npy file per field, the
+    layout read by loadDirectory.
+    """
+    os.makedirs(directory, exist_ok = True)
+    for name, arr in data.items():
+        np.save(os.path.join(directory, name + '.npy'), arr)
+    return
@@ -0,0 +1,254 @@
+#!usr/bin/python3
+
+"""
+This file contains a generator of synthetic SPARTA/MORIA-like
+catalogs, used for benchmarks and for trying out the package without
+access to simulation outputs.
+
+The catalogs follow the layouts that Tree, Bush and Vines expect:
+halos are born at a random snapshot, subhalos fall into a host and
+may merge before the last snapshot, and snapshots where an object is
+not alive hold -1 sentinels.
+"""
+
+import numpy as np
+from typing import Dict, Tuple
+from tree_tracks.storage.simulation import Simulation
+
+
+def makeSimulation(
+    nsnaps : int,
+    boxsize : float = 100.0
+) -> Simulation:
+    # scale factor like times, evenly spaced
+    return Simulation(boxsize, np.linspace(0.1, 1.0, nsnaps))
+
+
+def _randomWalk(rng, nobj, nsnaps, step, boxsize):
+    # periodic random walks with shape (nobj, nsnaps, 3)
+    start = rng.uniform(0, boxsize, (nobj, 1, 3))
+    steps = rng.normal(0, step, (nobj, nsnaps, 3))
+    steps[:, 0, :] = 0
+    return np.mod(start + np.cumsum(steps, axis = 1), boxsize)
+
+
+def _orbit(rng, center, rad, first, nsnaps):
+    # decaying orbits of satellites around centers with shape
+    # (nobj, nsnaps, 3), starting at several times rad at snapshot
+    # first
+    nobj = center.shape[0]
+    snaps = np.arange(nsnaps)[np.newaxis, :]
+    tau = np.maximum(snaps - first[:, np.newaxis], 0)
+    period = rng.uniform(8, 30, (nobj, 1))
+    phase = rng.uniform(0, 2 * np.pi, (nobj, 1))
+    r0 = rng.uniform(1.5, 3.0, (nobj, 1))
+    decay = np.exp(-tau / rng.uniform(20, 80, (nobj, 1)))
+    r = rad * r0 * (0.35 + 0.65 * np.abs(np.cos(np.pi * tau / period))) \
+        * (0.3 + 0.7 * decay)
+    angle = 2 * np.pi * tau / period + phase
+    incl = rng.uniform(0, np.pi, (nobj, 1))
+    offset = np.stack([r * np.cos(angle),
+                       r * np.sin(angle) * np.cos(incl),
+                       r * np.sin(angle) * np.sin(incl)], axis = -1)
+    return center + offset
+
+
+def makeTree(
+    nhalos : int,
+    nsnaps : int,
+    boxsize : float = 100.0,
+    sub_frac : float = 0.8,
+    seed : int = 0
+) -> Tuple[np.ndarray, Simulation]:
+    """
+    Make a MORIA-like merger tree.
+
+    Args:
+        nhalos (int): total number of halos, hosts and subhalos.
+        nsnaps (int): number of snapshots.
+        boxsize (float, optional): size of the box. Defaults to 100.
+        sub_frac (float, optional): fraction of halos that fall into
+            another halo. A fifth of the subhalos fall into another
+            subhalo. Defaults to 0.8.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        Tuple[np.ndarray, Simulation]: structured array with shape
+            (nsnaps, nhalos) and fields id, parent_id_cat, mask_alive,
+            x, M200m, R200m, and the matching Simulation.
+    """
+    rng = np.random.default_rng(seed)
+    sim = makeSimulation(nsnaps, boxsize)
+    nsub = int(nhalos * sub_frac)
+    nhost = max(nhalos - nsub, 1)
+    nsub = nhalos - nhost
+    snaps = np.arange(nsnaps)
+
+    # hosts are born early and survive to the last snapshot
+    birth = np.zeros(nhalos, dtype = int)
+    birth[:nhost] = rng.integers(0, max(nsnaps // 4, 1), nhost)
+    death = np.full(nhalos, nsnaps - 1)
+
+    # subhalos pick a host with more weight on the first (largest)
+    # hosts, a fifth of them fall into an earlier subhalo instead
+    host_of = np.full(nhalos, -1)
+    weights = 1 / np.arange(1, nhost + 1)
+    host_of[nhost:] = rng.choice(nhost, nsub, p = weights / weights.sum())
+    is_subsub = rng.random(nsub) < 0.2
+    for i in np.where(is_subsub)[0]:
+        idx = nhost + i
+        if idx > nhost:
+            host_of[idx] = rng.integers(nhost, idx)
+
+    birth[nhost:] = rng.integers(0, max(nsnaps // 2, 1), nsub)
+    infall = birth + rng.integers(1, max(nsnaps // 3, 2), nhalos)
+    infall = np.minimum(infall, nsnaps - 1)
+    merges = rng.random(nhalos) < 0.5
+    merge_snap = infall + rng.integers(5, max(nsnaps // 2, 6), nhalos)
+    death[nhost:] = np.where(merges[nhost:],
+                             np.minimum(merge_snap[nhost:], nsnaps - 1),
+                             nsnaps - 1)
+
+    # a subhalo can only live while its host does, and must fall in
+    # after its host is born
+    for idx in range(nhost, nhalos):
+        hidx = host_of[idx]
+        birth[idx] = max(birth[idx], birth[hidx])
+        infall[idx] = min(max(infall[idx], birth[hidx] + 1), nsnaps - 1)
+        death[idx] = min(death[idx], death[hidx])
+        birth[idx] = min(birth[idx], death[idx])
+        infall[idx] = min(max(infall[idx], birth[idx]), death[idx])
+
+    alive = (snaps[:, np.newaxis] >= birth) & (snaps[:, np.newaxis] <= death)
+
+    # masses grow with time, subhalos lose mass after infall
+    mfinal = 10**rng.uniform(11, 14.5, nhalos)
+    mfinal[:nhost] = np.sort(mfinal[:nhost])[::-1] * 5
+    growth = (sim.getTime()[:, np.newaxis] / sim.getTime()[-1])**1.5
+    mass = mfinal * growth
+    strip = np.exp(-np.maximum(snaps[:, np.newaxis] - infall, 0) / 30)
+    is_sub = np.zeros(nhalos, dtype = bool); is_sub[nhost:] = True
+    mass = np.where(is_sub & (snaps[:, np.newaxis] >= infall),
+                    mass * strip, mass)
+    rad = 0.2 * (mass / 1e12)**(1 / 3)
+
+    # hosts random walk, subhalos orbit their host after infall
+    pos = np.empty((nhalos, nsnaps, 3))
+    pos[:nhost] = _randomWalk(rng, nhost, nsnaps, 0.05, boxsize)
+    for idx in range(nhost, nhalos):
+        hidx = host_of[idx]
+        orbit = _orbit(rng, pos[hidx][np.newaxis], rad[:, hidx][np.newaxis],
+                       np.array([infall[idx]]), nsnaps)[0]
+        pos[idx] = np.mod(orbit, boxsize)
+
+    ids = (snaps[:, np.newaxis] * nhalos + np.arange(nhalos) + 1)
+    parent = np.full((nsnaps, nhalos), -1)
+    for idx in range(nhost, nhalos):
+        sl = slice(infall[idx], death[idx] + 1)
+        parent[sl, idx] = ids[sl, host_of[idx]]
+
+    dtype = [('id', np.int64), ('parent_id_cat', np.int64),
+             ('mask_alive', bool), ('x', np.float64, (3,)),
+             ('M200m', np.float64), ('R200m', np.float64)]
+    tree = np.zeros((nsnaps, nhalos), dtype = dtype)
+    tree['id'] = np.where(alive, ids, -1)
+    tree['parent_id_cat'] = np.where(alive, parent, -1)
+    tree['mask_alive'] = alive
+    tree['x'] = np.where(alive[:, :, np.newaxis],
+                         np.transpose(pos, (1, 0, 2)), -1)
+    tree['M200m'] = np.where(alive, mass, -1)
+    tree['R200m'] = np.where(alive, rad, -1)
+    return tree, sim
+
+
+def makeBush(
+    nobj : int,
+    nsnaps : int,
+    boxsize : float = 100.0,
+    seed : int = 0
+) -> Tuple[Dict[str, np.ndarray], Simulation]:
+    """
+    Make a set of particles for a Bush, as a dictionary of arrays
+    with shape (nsnaps, nobj). Particles random walk through the box
+    and are alive over a random range of snapshots.
+    """
+    rng = np.random.default_rng(seed)
+    sim = makeSimulation(nsnaps, boxsize)
+    snaps = np.arange(nsnaps)[:, np.newaxis]
+    first = rng.integers(0, max(nsnaps // 3, 1), nobj)
+    last = rng.integers(nsnaps // 2, nsnaps, nobj)
+    alive = (snaps >= first) & (snaps <= last)
+
+    pos = _randomWalk(rng, nobj, nsnaps, 0.2, boxsize)
+    pos = np.transpose(pos, (1, 0, 2))
+    data = {
+        'id' : np.where(alive, np.arange(nobj) + 1, -1),
+        'x' : np.where(alive[:, :, np.newaxis], pos, -1),
+        'R200m' : np.where(alive, rng.uniform(0.05, 1, nobj), -1)
+    }
+    return data, sim
+
+
+def makeVines(
+    nhalos : int,
+    ntcrs : int,
+    nsnaps : int,
+    boxsize : float = 100.0,
+    seed : int = 0
+) -> Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray], Simulation]:
+    """
+    Make SPARTA-like tracer and halo data for Vines.
+
+    Args:
+        nhalos (int): number of host halos.
+        ntcrs (int): total number of tracers, split between the hosts
+            with more tracers in the first hosts.
+        nsnaps (int): number of snapshots.
+        boxsize (float, optional): size of the box. Defaults to 100.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        Tuple[Dict, Dict, Simulation]: the tracer dictionary, with
+            arrays of shape (ntcrs, nsnaps, ...), the halo dictionary
+            with the first tracer and tracer count of each halo and
+            arrays of shape (nhalos, nsnaps, ...), and the Simulation.
+    """
+    rng = np.random.default_rng(seed)
+    sim = makeSimulation(nsnaps, boxsize)
+
+    weights = 1 / np.arange(1, nhalos + 1)
+    counts = rng.multinomial(ntcrs, weights / weights.sum())
+    first = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    host_of = np.repeat(np.arange(nhalos), counts)
+
+    halo_pos = _randomWalk(rng, nhalos, nsnaps, 0.05, boxsize)
+    growth = (sim.getTime() / sim.getTime()[-1])**0.5
+    halo_rad = rng.uniform(0.5, 2.0, (nhalos, 1)) * growth
+
+    # tracers are followed from a random snapshot until the end, or
+    # until they are lost for a fraction of them
+    snaps = np.arange(nsnaps)
+    tcr_first = rng.integers(0, max(nsnaps // 2, 1), ntcrs)
+    tcr_last = np.where(rng.random(ntcrs) < 0.1,
+                        rng.integers(nsnaps // 2, nsnaps, ntcrs),
+                        nsnaps - 1)
+    alive = (snaps >= tcr_first[:, np.newaxis]) & \
+        (snaps <= tcr_last[:, np.newaxis])
+
+    infall = tcr_first + rng.integers(0, max(nsnaps // 4, 1), ntcrs)
+    pos = _orbit(rng, halo_pos[host_of], halo_rad[host_of], infall, nsnaps)
+    vel = np.gradient(pos, axis = 1)
+    pos = np.mod(pos, boxsize)
+
+    tcrs = {
+        'tjy_x' : np.where(alive[:, :, np.newaxis], pos, -1),
+        'tjy_v' : np.where(alive[:, :, np.newaxis], vel, -1),
+    }
+    halos = {
+        'sho_tjy_first' : first,
+        'sho_tjy_last' : counts,
+        'x' : halo_pos,
+        'v' : np.gradient(halo_pos, axis = 1),
+        'R200m' : halo_rad,
+    }
+    return tcrs, halos, sim
@@ -11,8 +11,10 @@ will still interact with the rest of the code correctly.
 
 from tree_tracks.tracker import Trajectory, Tracker
 from tree_tracks.storage import Simulation, Storage, TrackerConstType
-from typing import Callable, List
+from tree_tracks.decorator.event_table import EventTable
+from typing import Callable, Dict, List, Sequence, Tuple
 import numpy as np
+from tree_tracks.instrument import profile
 
 
 class Tree(Storage):
@@ -66,18 +68,211 @@ class Tree(Storage):
 
         return np.where(desc_idxs)[0]
 
+    def getAliveMask(self, tslc = slice(None), oslc = slice(None)) -> np.ndarray:
+        """
+        Whether each halo is alive, with shape (nsnaps, nhalos) for
+        the given snapshots and halos. Uses ALIVE_KEY if the tree has
+        it, otherwise the halos with an ID are alive.
+        """
+        tidx = np.atleast_1d(np.arange(self.sim.getSnaps())[tslc])
+        oidx = np.atleast_1d(np.arange(self.nobj)[oslc])
+        if self.ALIVE_KEY in self._getAllProps():
+            alive = self._normalized(self.ALIVE_KEY, tidx, oidx)
+            return alive.astype(bool)
+        return self._normalized(self.ID_KEY, tidx, oidx) != -1
+
+    @profile('tree.mainBranches')
+    def mainBranches(
+        self,
+        idxs : Sequence[int] = None,
+        props : Sequence[str] = [],
+        fill : float = np.nan
+    ) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        """
+        Find the main branch of many halos at once, along with the
+        history of their properties, such as the mass accretion
+        history M200m(t).
+
+        In a MORIA tree each column follows one halo through time,
+        so the main branch of a halo is its own column at every
+        snapshot where it is alive. Progenitors that merge into it
+        are other columns, see getProgenitors.
+
+        Args:
+            idxs (Sequence[int], optional): the halos. Defaults to all
+                halos in the tree.
+            props (Sequence[str], optional): properties to get the
+                histories of. Defaults to [].
+            fill (float, optional): value of the histories where the
+                halo is not alive. None keeps the values stored in the
+                tree. Defaults to np.nan.
+
+        Returns:
+            Tuple[np.ndarray, Dict[str, np.ndarray]]: the halo index
+                of the main branch with shape (nhalos, nsnaps), -1
+                where the halo is not alive, and the property
+                histories with shape (nhalos, nsnaps, ...).
+        """
+        oidx = np.arange(self.nobj) if idxs is None else \
+            np.atleast_1d(np.asarray(idxs, dtype = int))
+        tidx = np.arange(self.sim.getSnaps())
+
+        alive = self.getAliveMask(tidx, oidx).T
+        branch = np.where(alive, oidx[:, np.newaxis], -1)
+
+        histories = {}
+        for prop in props:
+            hist = np.swapaxes(self._normalized(prop, tidx, oidx), 0, 1)
+            hist = np.broadcast_to(hist, alive.shape + hist.shape[2:])
+            if fill is not None:
+                if hist.dtype.kind in 'iub' and not float(fill).is_integer():
+                    hist = hist.astype(float)
+                else:
+                    hist = hist.copy()
+                hist[~alive] = fill
+            histories[prop] = hist
+        return branch, histories
+
+    @profile('tree.mergerEvents')
+    def mergerEvents(
+        self,
+        idxs : Sequence[int] = None,
+        chunk_size : int = 65536
+    ) -> Dict[str, np.ndarray]:
+        """
+        Find when every halo became a subhalo and when it merged into
+        or was disrupted in its host, from the whole tree at once.
+        The halos are processed in chunks, so memory-mapped trees are
+        read a chunk at a time.
+
+        Args:
+            idxs (Sequence[int], optional): the halos. Defaults to all
+                halos in the tree.
+            chunk_size (int, optional): halos per chunk. Defaults to
+                65536.
+
+        Returns:
+            Dict[str, np.ndarray]: one value per halo, -1 where there
+                is none:
+
+                idx: the halo index
+                first_sub_snap: first snapshot it is a subhalo at
+                infall_host_id: ID of its host at that snapshot
+                last_alive_snap: last snapshot it is alive at
+                final_host_id: ID of its host at that snapshot
+                merged: whether it stopped existing as a subhalo
+                    before the last snapshot
+        """
+        oidx_all = np.arange(self.nobj) if idxs is None else \
+            np.atleast_1d(np.asarray(idxs, dtype = int))
+        tidx = np.arange(self.sim.getSnaps())
+        nsnaps = len(tidx)
+
+        cols = {key : [] for key in ['first_sub_snap', 'infall_host_id',
+                                     'last_alive_snap', 'final_host_id']}
+        for start in range(0, len(oidx_all), chunk_size):
+            oidx = oidx_all[start:start + chunk_size]
+            cidx = np.arange(len(oidx))
+            alive = self.getAliveMask(tidx, oidx)
+            host = self._normalized(self.HOST_SUB_KEY, tidx, oidx)
+            host = np.broadcast_to(host, alive.shape)
+            is_sub = alive & (host != -1)
+
+            has_sub = np.any(is_sub, axis = 0)
+            first_sub = np.where(has_sub, np.argmax(is_sub, axis = 0), -1)
+            infall_host = np.where(has_sub, host[first_sub, cidx], -1)
+
+            has_alive = np.any(alive, axis = 0)
+            last = nsnaps - 1 - np.argmax(alive[::-1], axis = 0)
+            last = np.where(has_alive, last, -1)
+            final_host = np.where(has_alive, host[last, cidx], -1)
+
+            cols['first_sub_snap'].append(first_sub)
+            cols['infall_host_id'].append(infall_host)
+            cols['last_alive_snap'].append(last)
+            cols['final_host_id'].append(final_host)
+
+        out = {'idx' : oidx_all}
+        for key, val in cols.items():
+            out[key] = np.concatenate(val) if val else \
+                np.zeros(0, dtype = int)
+        out['merged'] = (out['final_host_id'] != -1) & \
+            (out['last_alive_snap'] >= 0) & \
+            (out['last_alive_snap'] < nsnaps - 1)
+        return out
+
+    def mergerEventTable(self, events : Dict[str, np.ndarray] = None
+                         ) -> EventTable:
+        """
+        The events of mergerEvents as an EventTable, with the types
+        'infall' at the first subhalo snapshot and 'merger' at the
+        last snapshot of halos that merged, positioned where the halo
+        was. The trk column holds the halo index, see tableMarkFunc
+        for showing the events with markers.
+
+        Args:
+            events (Dict[str, np.ndarray], optional): the result of
+                mergerEvents. Defaults to the events of every halo.
+        """
+        if events is None:
+            events = self.mergerEvents()
+        has_infall = events['first_sub_snap'] >= 0
+        idx = np.concatenate([events['idx'][has_infall],
+                              events['idx'][events['merged']]])
+        snap = np.concatenate([events['first_sub_snap'][has_infall],
+                               events['last_alive_snap'][events['merged']]])
+        etype = np.concatenate([np.zeros(np.sum(has_infall)),
+                                np.ones(np.sum(events['merged']))])
+
+        # one position per event, read for the (snapshot, halo) pairs
+        arr = self.data[self.POS_KEY]
+        tax = self._timeAxis(arr.shape)
+        pair = (snap, idx) if tax == 0 else (idx, snap)
+        pos = np.array(arr[pair], dtype = float).reshape(len(idx), -1)
+        pos = self._setPosNan(pos)
+        return EventTable(idx, etype, snap, pos, [], ['infall', 'merger'])
+
+    def _extendProps(self, trk, props, nnew):
+        # traverseTree gives its trackers a depth for every snapshot
+        if 'depth' in trk.props:
+            props['depth'] = np.zeros(nnew)
+        return props
+
+    @profile('tree.traverseTree')
     def traverseTree(
         self,
         halo_idx : int,
         depth : int = 1, 
         include_func : Callable[[np.ndarray], bool] = None
     ) -> List[Tracker]:
+        """
+        Create trackers for a halo and its progenitors, down to the
+        given depth. If a cache is set, the result is cached unless
+        an include_func is given, since functions cannot be hashed
+        reliably.
+        """
+        def _build():
+            return self._traverseTree(halo_idx, depth, include_func)
+        
+        if include_func is not None:
+            return _build()
+        params = {'halo_idx' : int(halo_idx), 'depth' : int(depth),
+                  'host_sub_key' : self.HOST_SUB_KEY,
+                  'alive_key' : self.ALIVE_KEY}
+        return self._cached('traverseTree', params, _build)
+
+    def _traverseTree(
+        self,
+        halo_idx : int,
+        depth : int = 1, 
+        include_func : Callable[[np.ndarray], bool] = None
+    ) -> List[Tracker]:
                 
         # create tracker object for halo
         track = self.createTrack(halo_idx)
 
         # create depth property 
-        track.setProp('depth', np.zeros(self.tree.shape[0]))
+        track.setProp('depth', np.zeros(self.sim.getSnaps()))
 
         # add to list
         track_list = [track]
@@ -99,16 +294,16 @@ class Tree(Storage):
                 # test if progenitor meets inclusion criteria, as
                 # defined by user
                 if include_func is not None:
-                    is_included = include_func(self.get(halo_slc = didx))
+                    is_included = include_func(self.get(oslc = didx))
                 else:
                     is_included = True
                 
                 # if we want to include n order progenitor, 
                 # recursively get n + 1 order progenitors
                 if is_included:
-                    desc_track_list = self.traverseTree(didx, 
-                                                       depth - 1, 
-                                                       include_func)
+                    desc_track_list = self._traverseTree(didx, 
+                                                        depth - 1, 
+                                                        include_func)
                     # update depth of progenitor's progenitors
                     for desc_track in desc_track_list:
                         desc_track_depth = desc_track.getProp('depth')
@@ -2,8 +2,13 @@
 
 from tree_tracks.tracker import Trajectory, Sphere
 from tree_tracks.storage.simulation import Simulation
-from typing import Dict, Callable
+from tree_tracks.storage.cache import TrackerCache, dataIdentity
+from tree_tracks.storage.stream import prefetch, loadDirectory
+from tree_tracks.storage.virtual import VirtualField, openNpyShards
+from tree_tracks.buffer import appendTo
+from typing import Dict, Callable, Iterator, List, Sequence, Tuple, Union
 import numpy as np
+from tree_tracks.instrument import profile
 
 class Vines(object):
     """
@@ -16,6 +21,13 @@ class Vines(object):
     TCR_FIRST_KEY = 'sho_tjy_first'
     TCR_N_KEY = 'sho_tjy_last'
     HOST_RAD_KEY = 'R200m'
+    HOST_POS_KEY = 'x'
+    TCR_VEL_KEY = 'tjy_v'
+    HOST_VEL_KEY = 'v'
+
+    # attributes that hold the dataset, shared with worker processes
+    # by visual.batch
+    DATA_ATTRS = ('tcrs', 'halos')
 
     def __init__(self, tcrs : Dict, halos : Dict, sim : Dict):
         """
@@ -26,24 +38,71 @@ class Vines(object):
             halos (Dict): _description_
             sim (Dict): _description_
         """
+        self._identity = None
         self.setTracers(tcrs) # tracer data, shape (nptls, nsnaps)
         self.setHalos(halos) # halo data
         self.setSim(sim)
         self.track_const = Trajectory
+        self.cache = None
+        # growth buffers of the fields extended by appendSnaps
+        self._buffers = {}
         return
     
     
+    @staticmethod
+    def fromDirectory(tcr_dir : str, halo_dir : str, sim : Simulation,
+                      mmap_mode : str = 'r') -> 'Vines':
+        """
+        Make a Vines from directories with one .npy file per field,
+        see stream.saveDirectory. The tracer arrays are memory-mapped,
+        so they are only read when used, for example block by block
+        with streamBlocks or streamHaloTracks.
+
+        Args:
+            tcr_dir (str): directory of the tracer fields.
+            halo_dir (str): directory of the halo fields.
+            sim (Simulation): the simulation.
+            mmap_mode (str, optional): see np.load. Defaults to 'r'.
+        """
+        tcrs = loadDirectory(tcr_dir, mmap_mode)
+        halos = loadDirectory(halo_dir, None)
+        return Vines(tcrs, halos, sim)
+    
+    @staticmethod
+    def fromShards(tcr_dirs : Sequence[str], halo_dirs : Sequence[str],
+                   sim : Simulation, tcr_axis : int = 0,
+                   halo_axis : int = 0) -> 'Vines':
+        """
+        Make a Vines from data split across many directories, each
+        laid out as for fromDirectory, see virtual.openNpyShards. Only
+        the shards that a query touches are opened and read.
+
+        Args:
+            tcr_dirs (Sequence[str]): the tracer shards, in order.
+            halo_dirs (Sequence[str]): the halo shards, in order.
+            sim (Simulation): the simulation.
+            tcr_axis (int, optional): the axis the tracers are split
+                on, 0 for chunks of tracers. Defaults to 0.
+            halo_axis (int, optional): the axis the halos are split
+                on. Defaults to 0.
+        """
+        tcrs = openNpyShards(tcr_dirs, tcr_axis)
+        halos = openNpyShards(halo_dirs, halo_axis)
+        return Vines(tcrs, halos, sim)
+    
     def setTracers(self, tcrs : Dict):
         if self.POS_KEY not in tcrs:
             msg = 'did not find positions under ' + \
                              'expected key'
             raise ValueError(msg)
         self.tcrs = tcrs
+        self._identity = None
         return
     
     def setSim(self, sim : Simulation):
         # properties that are true everywhere in the box for all halos
         self.sim = sim
+        self._identity = None
         return
     
     def setTracker(self, const : Callable):
@@ -52,8 +111,23 @@ class Vines(object):
     
     def setHalos(self, halos : Dict):
         self.halos = halos
+        self._identity = None
         return
     
+    def setCache(self, cache : TrackerCache):
+        self.cache = cache
+        return
+    
+
+    def getIdentity(self) -> str:
+        """
+        Hash of the tracers, halos and simulation, computed once. Used
+        to key cached tracker sets, see Storage.getIdentity.
+        """
+        if self._identity is None:
+            self._identity = dataIdentity('Vines', self.tcrs, self.halos,
+                                          self.sim)
+        return self._identity
 
     def getAlive(self, ptl_idx):
         pos = self.getPos(ptl_idx)
@@ -95,24 +169,99 @@ class Vines(object):
         else:
             return self.halos[prop][halo_slc, snap_slc]
     
+    def appendSnaps(self, tcrs : Dict, halos : Dict, time : np.ndarray):
+        """
+        Add snapshots at the end, for a simulation that is still
+        running, see Storage.appendSnaps. The tracers and halos stay
+        the same, and every field with a snapshot axis, the second
+        one, needs values for the new snapshots.
+
+        Args:
+            tcrs (Dict): the new snapshots of the tracer fields.
+            halos (Dict): the new snapshots of the halo fields.
+            time (np.ndarray): times of the new snapshots.
+        """
+        time = np.atleast_1d(time)
+        nsnaps = self.sim.getSnaps()
+        for prefix, data, new_data in [('tcrs', self.tcrs, tcrs),
+                                       ('halos', self.halos, halos)]:
+            for key, arr in data.items():
+                if len(arr.shape) < 2 or arr.shape[1] != nsnaps:
+                    continue
+                if key not in new_data:
+                    msg = 'the new snapshots need values for the field %s'
+                    raise ValueError(msg%key)
+                new = new_data[key]
+                if np.shape(new)[1] != len(time):
+                    msg = 'got %d snapshots of %s for %d new times'
+                    raise ValueError(msg%(np.shape(new)[1], key, len(time)))
+                if isinstance(arr, VirtualField) and arr.axis == 1:
+                    arr.appendShard(new)
+                else:
+                    data[key] = appendTo(self._buffers, prefix + '.' + key,
+                                         arr, new, 1)
+        self.sim.appendSnaps(time)
+        self._identity = None
+        return
+    
+    def extendTracks(self, trackers : List) -> List:
+        """
+        Extend trackers made by createTrack or createHaloTracks to
+        the snapshots added since, in place, reading only the new
+        snapshots.
+        """
+        nsnaps = self.sim.getSnaps()
+        for trk in trackers:
+            start = len(trk.pos)
+            if start == nsnaps:
+                continue
+            if start > nsnaps:
+                msg = 'tracker has %d snapshots, more than the %d ' + \
+                    'of the tracers'
+                raise ValueError(msg%(start, nsnaps))
+            idx = int(trk.getProp('index')[0])
+            props = self.get(ptl_slc = idx, snap_slc = slice(start, nsnaps))
+            pos = np.array(props[self.POS_KEY], dtype = float)
+            pos[np.all(pos == -1, axis = 1)] = np.nan
+            for key, val in self.sim.getDefaults().items():
+                props[key] = val[start:]
+            props['index'] = np.zeros((nsnaps - start), dtype = int) + idx
+            trk.appendSnaps(pos, props)
+        return trackers
+    
     def createTrack(self, ptl_idx):
-        pos = np.copy(self.getPos(ptl_idx))
+        return self._trackFromData(ptl_idx, self.get(ptl_slc = ptl_idx))
+    
+    def _trackFromData(self, ptl_idx, prop_dict):
+        # builds a tracker from the tracer properties of one particle
+        pos = np.array(prop_dict[self.POS_KEY], dtype = float)
 
         sim_dict = self.sim.getDefaults()
-
-        prop_dict = self.get(ptl_slc = ptl_idx)
-        
         prop_dict.update(sim_dict)
 
         nsnaps = self.sim.getSnaps()
         prop_dict['index'] = np.zeros((nsnaps), dtype=int) + ptl_idx
 
-        is_alive = self.getAlive(ptl_idx)
+        is_alive = ~np.all(pos == -1, axis = 1)
         pos[~is_alive, :] = np.nan
         return self.track_const(pos, prop_dict)
 
     
+    @profile('vines.createHaloTracks')
     def createHaloTracks(self, halo_idx, include_func = None):
+        # tracker sets are only cached without an include_func, since
+        # functions cannot be hashed reliably
+        if self.cache is None or include_func is not None:
+            return self._createHaloTracks(halo_idx, include_func)
+        
+        const = self.track_const
+        params = {'halo_idx' : int(halo_idx), 'pos_key' : self.POS_KEY,
+                  'track_const' : getattr(const, '__qualname__', repr(const))}
+        key = self.cache.key(self.getIdentity(), 'createHaloTracks', params)
+        return self.cache.fetch(key, 
+            lambda : self._createHaloTracks(halo_idx, include_func))
+    
+    def _createHaloTracks(self, halo_idx, include_func = None):
 
         # get the particles that belong to this halo
         ptl_idxs = self.getHaloPtls(halo_idx)
@@ -132,11 +281,301 @@ class Vines(object):
 
         return trackers
 
-    def createHostSphere(self, halo_idx):
+    def _readBlock(self, ptl_slc : slice, props : List[str]) -> Dict:
+        # copies the block into memory, which is where a memory-mapped
+        # array is actually read
+        return {key : np.array(self.tcrs[key][ptl_slc]) for key in props}
+    
+    def streamBlocks(
+        self,
+        chunk_size : int = 65536,
+        props : List[str] = None,
+        read_ahead : int = 2
+    ) -> Iterator[Tuple[np.ndarray, Dict[str, np.ndarray]]]:
+        """
+        Read the tracers in chunks of particles, reading the next
+        chunks in the background while the current one is used. Only
+        read_ahead + 1 chunks are in memory at a time.
+
+        Args:
+            chunk_size (int, optional): particles per chunk. Defaults
+                to 65536.
+            props (List[str], optional): tracer properties to read.
+                Defaults to all of them.
+            read_ahead (int, optional): number of chunks read ahead.
+                Defaults to 2.
+
+        Yields:
+            Tuple[np.ndarray, Dict[str, np.ndarray]]: the particle
+                indices of the chunk and the tracer properties, with
+                the particle axis first.
+        """
+        if props is None:
+            props = list(self.tcrs.keys())
+        nptls = self.getNptls()
+
+        def _blocks():
+            for start in range(0, nptls, chunk_size):
+                stop = min(start + chunk_size, nptls)
+                yield np.arange(start, stop), \
+                    self._readBlock(slice(start, stop), props)
+
+        return prefetch(_blocks(), read_ahead)
+    
+    def streamHalos(
+        self,
+        halo_idxs : Sequence[int] = None,
+        props : List[str] = None,
+        read_ahead : int = 2
+    ) -> Iterator[Tuple[int, np.ndarray, Dict[str, np.ndarray]]]:
+        """
+        Read the tracers halo by halo, reading the next halos in the
+        background while the current one is used.
+
+        Args:
+            halo_idxs (Sequence[int], optional): halos to read, in
+                order. Defaults to all halos.
+            props (List[str], optional): tracer properties to read.
+                Defaults to all of them.
+            read_ahead (int, optional): number of halos read ahead.
+                Defaults to 2.
+
+        Yields:
+            Tuple[int, np.ndarray, Dict[str, np.ndarray]]: the halo
+                index, the indices of its particles and their tracer
+                properties.
+        """
+        if props is None:
+            props = list(self.tcrs.keys())
+        if halo_idxs is None:
+            halo_idxs = range(len(self.halos[self.TCR_FIRST_KEY]))
+
+        def _blocks():
+            for halo_idx in halo_idxs:
+                # the tracers of a halo are contiguous
+                first = int(self.halos[self.TCR_FIRST_KEY][halo_idx])
+                count = int(self.halos[self.TCR_N_KEY][halo_idx])
+                yield halo_idx, np.arange(first, first + count), \
+                    self._readBlock(slice(first, first + count), props)
+
+        return prefetch(_blocks(), read_ahead)
+    
+    def streamHaloTracks(
+        self,
+        halo_idxs : Sequence[int] = None,
+        include_func : Callable = None,
+        read_ahead : int = 2
+    ) -> Iterator[Tuple[int, list]]:
+        """
+        Create the trackers of each halo in turn, as with
+        createHaloTracks, while the tracers of the next halos are read
+        in the background. Only the trackers of the current halo are
+        kept, so whole-box passes run in constant memory.
+
+        Args:
+            halo_idxs (Sequence[int], optional): halos to create
+                trackers for. Defaults to all halos.
+            include_func (Callable, optional): see createHaloTracks.
+                Defaults to None.
+            read_ahead (int, optional): number of halos read ahead.
+                Defaults to 2.
+
+        Yields:
+            Tuple[int, list]: the halo index and its trackers.
+        """
+        for halo_idx, ptl_idxs, block in self.streamHalos(
+                halo_idxs, read_ahead = read_ahead):
+            trackers = []
+            for i, idx in enumerate(ptl_idxs):
+                prop_dict = {key : arr[i] for key, arr in block.items()}
+                if include_func is not None:
+                    is_alive = ~np.all(prop_dict[self.POS_KEY] == -1, axis = 1)
+                    sub = {key : val[is_alive] 
+                           for key, val in prop_dict.items()}
+                    if not include_func(sub):
+                        continue
+                trackers.append(self._trackFromData(idx, prop_dict))
+            yield halo_idx, trackers
+        return
+
+    def _haloTracers(self, halo_idxs):
+        # particle indices of the halos, and the position of each
+        # particle's halo in halo_idxs
+        firsts = np.asarray(self.halos[self.TCR_FIRST_KEY])[halo_idxs]
+        counts = np.asarray(self.halos[self.TCR_N_KEY])[halo_idxs]
+        host_of = np.repeat(np.arange(len(halo_idxs)), counts)
+        offsets = np.cumsum(counts) - counts
+        ptl_idxs = np.arange(len(host_of)) - offsets[host_of] + firsts[host_of]
+        return ptl_idxs, host_of
+
+    @profile('vines.toHostFrame')
+    def toHostFrame(
+        self,
+        halo_idxs : Union[int, Sequence[int]],
+        normalize : bool = False,
+        velocities : bool = False
+    ) -> Dict[str, np.ndarray]:
+        """
+        Transform the tracers of one or many halos into the rest frame
+        of their host, all at once. Separations are wrapped in the
+        periodic box.
+
+        Args:
+            halo_idxs (Union[int, Sequence[int]]): the halos.
+            normalize (bool, optional): give positions and radii in
+                units of the host R200m at each snapshot. Defaults to
+                False.
+            velocities (bool, optional): also transform the tracer
+                velocities, from TCR_VEL_KEY and HOST_VEL_KEY.
+                Defaults to False.
+
+        Returns:
+            Dict[str, np.ndarray]: with, for the n tracers of the
+                halos,
+                    'x': positions relative to the host, (n, nsnaps, 3)
+                    'r': distance to the host, (n, nsnaps)
+                    'ptl_idx': particle index of each tracer, (n,)
+                    'halo_idx': halo of each tracer, (n,)
+                and if velocities is set
+                    'v': velocities relative to the host, (n, nsnaps, 3)
+                    'vr': radial velocities, (n, nsnaps)
+                Snapshots where the tracer or its host is not alive
+                are np.nan.
+        """
+        halo_idxs = np.atleast_1d(np.asarray(halo_idxs, dtype = int))
+        ptl_idxs, host_of = self._haloTracers(halo_idxs)
+        return self._hostFrame(halo_idxs, ptl_idxs, host_of, normalize,
+                               velocities)
+
+    def iterHostFrame(
+        self,
+        halo_idxs : Union[int, Sequence[int]],
+        chunk_size : int = 65536,
+        normalize : bool = False,
+        velocities : bool = False,
+        read_ahead : int = 2
+    ) -> Iterator[Dict[str, np.ndarray]]:
+        """
+        toHostFrame for chunks of the tracers of the halos, read and
+        transformed in the background while the previous chunk is
+        used, so that halos with too many tracers to transform at once
+        can be processed with bounded memory.
+
+        Args:
+            halo_idxs (Union[int, Sequence[int]]): the halos.
+            chunk_size (int, optional): tracers per chunk. Defaults
+                to 65536.
+            normalize (bool, optional): see toHostFrame. Defaults to
+                False.
+            velocities (bool, optional): see toHostFrame. Defaults to
+                False.
+            read_ahead (int, optional): chunks prepared ahead of time,
+                see stream.prefetch. Defaults to 2.
+
+        Yields:
+            Dict[str, np.ndarray]: the output of toHostFrame for each
+                chunk of tracers.
+        """
+        halo_idxs = np.atleast_1d(np.asarray(halo_idxs, dtype = int))
+        ptl_idxs, host_of = self._haloTracers(halo_idxs)
+
+        def _chunks():
+            for start in range(0, len(ptl_idxs), chunk_size):
+                stop = start + chunk_size
+                yield self._hostFrame(halo_idxs, ptl_idxs[start:stop],
+                                      host_of[start:stop], normalize,
+                                      velocities)
+        return prefetch(_chunks(), read_ahead)
+
+    def _hostFrame(self, halo_idxs, ptl_idxs, host_of, normalize,
+                   velocities):
+        # the host frame of the given tracers, see toHostFrame
+        if len(ptl_idxs) and np.all(np.diff(ptl_idxs) == 1):
+            # contiguous tracers are read with a slice instead of a
+            # fancy index, which matters for memory-mapped data
+            ptl_slc = slice(ptl_idxs[0], ptl_idxs[-1] + 1)
+        else:
+            ptl_slc = ptl_idxs
+
+        # a copy, since the transform is done in place
+        tcr_pos = np.array(self.tcrs[self.POS_KEY][ptl_slc], dtype = float)
+        host_pos = np.asarray(self.halos[self.HOST_POS_KEY])[halo_idxs]
+        host_rad = np.asarray(self.halos[self.HOST_RAD_KEY], 
+                              dtype = float)[halo_idxs]
+
+        out = {'ptl_idx' : ptl_idxs, 'halo_idx' : halo_idxs[host_of]}
+        if len(host_of) and np.all(host_of == host_of[0]):
+            # a chunk of a single halo broadcasts its host instead of
+            # copying it for every tracer
+            host_of = host_of[:1]
+        alive = ~np.all(tcr_pos == -1, axis = -1) & (host_rad[host_of] > 0)
+        pos = tcr_pos
+        pos -= host_pos[host_of]
+        pos = self.sim.wrapDelta(pos)
+        pos[~alive] = np.nan
+        if normalize:
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                pos /= host_rad[host_of][:, :, np.newaxis]
+        rad = np.sqrt(np.einsum('ijk,ijk->ij', pos, pos))
+
+        out['x'] = pos
+        out['r'] = rad
+        if velocities:
+            tcr_vel = np.asarray(self.tcrs[self.TCR_VEL_KEY][ptl_slc],
+                                 dtype = float)
+            host_vel = np.asarray(self.halos[self.HOST_VEL_KEY])[halo_idxs]
+            vel = tcr_vel - host_vel[host_of]
+            vel[~alive] = np.nan
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                out['vr'] = np.einsum('ijk,ijk->ij', vel, pos) / rad
+            out['v'] = vel
+        return out
+    
+    def createHostFrameTracks(self, halo_idx : int, 
+                              normalize : bool = False) -> list:
+        """
+        Create the trackers of a halo's tracers in the rest frame of
+        the host, see toHostFrame. The trackers have the distance to
+        the host as the property 'r'.
+        """
+        frame = self.toHostFrame(halo_idx, normalize)
+        sim_dict = self.sim.getDefaults()
+        nsnaps = self.sim.getSnaps()
+        trackers = []
+        for i, idx in enumerate(frame['ptl_idx']):
+            props = {'r' : frame['r'][i],
+                     'index' : np.zeros((nsnaps), dtype = int) + idx}
+            props.update(sim_dict)
+            trackers.append(self.track_const(frame['x'][i], props))
+        return trackers
+
+    def createHostSphere(self, halo_idx, frame : str = 'host',
+                         normalize : bool = False):
+        """
+        Create a sphere with the host's R200m.
+
+        Args:
+            halo_idx (int): the host halo.
+            frame (str, optional): 'host' puts the host at the origin,
+                to go with toHostFrame, 'box' at its position in the
+                box. Defaults to 'host'.
+            normalize (bool, optional): give the sphere a radius of
+                one, to go with toHostFrame(normalize = True).
+                Defaults to False.
+        """
         host_rad = self.getHaloData(self.HOST_RAD_KEY, halo_idx)
-        pos = np.zeros((host_rad.shape[0], 3))
+        if frame == 'host':
+            pos = np.zeros((host_rad.shape[0], 3))
+        elif frame == 'box':
+            pos = np.array(self.getHaloData(self.HOST_POS_KEY, halo_idx),
+                           dtype = float)
+        else:
+            msg = "frame %s not understood, expected 'host' or 'box'"
+            raise ValueError(msg%frame)
+        not_alive = ~(np.asarray(host_rad) > 0)
+        pos[not_alive] = np.nan
         sphere_props = {
-            'R200m': host_rad,
+            'R200m': np.where(not_alive, np.nan, 1.0) if normalize else host_rad,
             'index' : np.ones_like(host_rad)*halo_idx
         }
         sphere = Sphere(pos, sphere_props)
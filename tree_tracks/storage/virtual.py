@@ -0,0 +1,441 @@
+#!usr/bin/python3
+
+"""
+This file contains a virtual dataset that presents arrays split
+across many files as single fields.
+
+Simulation outputs and derived catalogs are often written in shards,
+by snapshot range or by chunks of halos or tracers. A VirtualField
+stands in for the concatenation of the shards of one field along the
+axis they were split on, without concatenating them: it keeps the
+offset of each shard along that axis, and indexing it only opens and
+reads the shards that the index touches. Since it indexes like a numpy
+array, dictionaries of VirtualFields can be given to Storage, Tree,
+Bush and Vines in place of their data.
+"""
+
+import mmap
+import os
+import numpy as np
+from typing import Dict, List, Sequence, Union
+
+
+def memmapOffset(arr : np.ndarray) -> int:
+    """
+    Byte offset of a memory-mapped array in its file, or None if it
+    is not backed by a mapping. Views of a memmap keep the offset of
+    the mapping they come from, so the offset of the view is found
+    from its address relative to the array that made the mapping.
+    """
+    root = arr
+    while isinstance(root.base, np.memmap):
+        root = root.base
+    if not isinstance(root, np.memmap) or \
+            not isinstance(root.base, mmap.mmap):
+        return None
+    return int(root.offset) + arr.ctypes.data - root.ctypes.data
+
+
+class _NpyShard(object):
+    # a .npy file that is only memory-mapped when it is first read.
+    # The shape and type are read from the header
+    def __init__(self, path, mmap_mode = 'r'):
+        self.path = path
+        self.mmap_mode = mmap_mode
+        with open(path, 'rb') as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                header = np.lib.format.read_array_header_1_0(f)
+            else:
+                header = np.lib.format.read_array_header_2_0(f)
+        self.shape, fortran, self.dtype = header
+        if fortran and len(self.shape) > 1:
+            msg = 'shard %s is in fortran order, which is not supported'
+            raise ValueError(msg%path)
+        self._arr = None
+
+    def open(self):
+        if self._arr is None:
+            self._arr = np.load(self.path, mmap_mode = self.mmap_mode)
+        return self._arr
+
+    def isOpen(self):
+        return self._arr is not None
+
+    def identity(self):
+        stat = os.stat(self.path)
+        return (self.path, stat.st_size, stat.st_mtime_ns)
+
+    def __getitem__(self, key):
+        return self.open()[key]
+
+
+class _H5Shard(object):
+    # a dataset in an HDF5 file, which is opened when it is first read
+    def __init__(self, path, name):
+        import h5py
+        self.path = path
+        self.name = name
+        with h5py.File(path, 'r') as f:
+            self.shape = f[name].shape
+            self.dtype = f[name].dtype
+        self._file = None
+
+    def open(self):
+        if self._file is None:
+            import h5py
+            self._file = h5py.File(self.path, 'r')
+        return self._file[self.name]
+
+    def isOpen(self):
+        return self._file is not None
+
+    def identity(self):
+        stat = os.stat(self.path)
+        return (self.path, self.name, stat.st_size, stat.st_mtime_ns)
+
+    def __getitem__(self, key):
+        return self.open()[key]
+
+
+def _asIndex(key, size : int):
+    # normalize the index of one axis to a slice, an int or an array
+    # of non-negative ints
+    if isinstance(key, slice):
+        return key
+    if isinstance(key, (int, np.integer)):
+        if not -size <= key < size:
+            msg = 'index %d is out of bounds for an axis of size %d'
+            raise IndexError(msg%(key, size))
+        return int(key) % size
+    key = np.asarray(key)
+    if key.size == 0:
+        # an empty list is a float array, numpy takes it as an index
+        return key.astype(int)
+    if key.dtype == bool:
+        if key.shape != (size,):
+            msg = 'boolean index of shape %s does not match an axis ' + \
+                'of size %d'
+            raise IndexError(msg%(key.shape, size))
+        return np.nonzero(key)[0]
+    if key.dtype.kind not in 'iu':
+        msg = 'arrays used as indices must be of integer or boolean type'
+        raise IndexError(msg)
+    if key.size and (key.min() < -size or key.max() >= size):
+        msg = 'index out of bounds for an axis of size %d'
+        raise IndexError(msg%size)
+    return key % size
+
+
+def _readKey(needed : np.ndarray) -> Union[slice, np.ndarray]:
+    # sorted unique indices, as a slice if they are contiguous, which
+    # is a plain read for memory-mapped and HDF5 shards
+    if len(needed) and needed[-1] - needed[0] + 1 == len(needed):
+        return slice(int(needed[0]), int(needed[-1]) + 1)
+    return needed
+
+
+class VirtualField(object):
+    """
+    A field made of shards that are concatenated along one axis.
+    Indexing follows numpy, and returns a numpy array read only from
+    the shards that the index touches.
+    """
+
+    def __init__(self, shards : Sequence, axis : int = 0) -> None:
+        """
+        Args:
+            shards (Sequence): the shards, in order. Each is an array,
+                a memory-mapped array or any object with shape, dtype
+                and numpy style indexing, like an HDF5 dataset.
+            axis (int, optional): the axis the field was split on.
+                Defaults to 0.
+        """
+        if not len(shards):
+            msg = 'a virtual field needs at least one shard'
+            raise ValueError(msg)
+        self.shards = list(shards)
+        ndim = len(self.shards[0].shape)
+        if not -ndim <= axis < ndim:
+            msg = 'axis %d is out of bounds for shards with %d dimensions'
+            raise ValueError(msg%(axis, ndim))
+        self.axis = axis % ndim
+
+        shape = list(self.shards[0].shape)
+        for shard in self.shards:
+            other = list(shard.shape)
+            if len(other) != ndim or \
+                    other[:self.axis] + other[self.axis + 1:] != \
+                    shape[:self.axis] + shape[self.axis + 1:]:
+                msg = 'shard of shape %s does not match shape %s ' + \
+                    'outside of axis %d'
+                raise ValueError(msg%(tuple(other), tuple(shape),
+                                      self.axis))
+        sizes = [shard.shape[self.axis] for shard in self.shards]
+        # shard i holds indices offsets[i] to offsets[i + 1] of the axis
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(int)
+        shape[self.axis] = int(self.offsets[-1])
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(self.shards[0].dtype)
+        return
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def size(self) -> int:
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self) -> int:
+        return self.size * self.dtype.itemsize
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __repr__(self) -> str:
+        return 'VirtualField(shape=%s, dtype=%s, %d shards on axis %d)'%(
+            self.shape, self.dtype, len(self.shards), self.axis)
+
+    def appendShard(self, shard) -> None:
+        """
+        Add a shard at the end of the split axis, for example the
+        file of a new snapshot.
+        """
+        shape, other = list(self.shape), list(shard.shape)
+        if len(other) != self.ndim or \
+                other[:self.axis] + other[self.axis + 1:] != \
+                shape[:self.axis] + shape[self.axis + 1:]:
+            msg = 'shard of shape %s does not match shape %s ' + \
+                'outside of axis %d'
+            raise ValueError(msg%(tuple(other), tuple(shape), self.axis))
+        self.shards.append(shard)
+        end = self.offsets[-1] + shard.shape[self.axis]
+        self.offsets = np.append(self.offsets, end)
+        shape[self.axis] = int(end)
+        self.shape = tuple(shape)
+        return
+
+    def getShards(self, idx : Union[slice, Sequence[int]]) -> np.ndarray:
+        """
+        The shards that hold the given indices of the split axis.
+        """
+        needed = np.arange(self.shape[self.axis])[idx]
+        shard_idx = np.searchsorted(self.offsets, needed, side = 'right') - 1
+        return np.unique(shard_idx)
+
+    def _expandKey(self, key) -> list:
+        # one entry per axis, with the ellipsis filled in
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is None for k in key):
+            msg = 'new axes are not supported when indexing a virtual field'
+            raise IndexError(msg)
+        is_ellipsis = [k is Ellipsis for k in key]
+        if any(is_ellipsis):
+            i = is_ellipsis.index(True)
+            fill = (slice(None),) * (self.ndim - len(key) + 1)
+            key = key[:i] + fill + key[i + 1:]
+        if len(key) > self.ndim:
+            msg = 'too many indices for a virtual field of %d dimensions'
+            raise IndexError(msg%self.ndim)
+        key = key + (slice(None),) * (self.ndim - len(key))
+        return [_asIndex(k, n) for k, n in zip(key, self.shape)]
+
+    def __getitem__(self, key) -> np.ndarray:
+        key = self._expandKey(key)
+
+        # the index of every axis is split into what is read from the
+        # shards and an index into the block that was read. The block
+        # index has the same kind (slice, int or array) as the original
+        # one, so that numpy places the axes of the result the same way
+        read, local = [], []
+        for i, k in enumerate(key):
+            if isinstance(k, slice):
+                needed = np.arange(self.shape[i])[k]
+                if k.step is not None and k.step < 0:
+                    local.append(slice(None, None, -1))
+                    needed = needed[::-1]
+                else:
+                    local.append(slice(None))
+            elif isinstance(k, int):
+                needed = np.array([k])
+                local.append(0)
+            else:
+                needed = np.unique(k)
+                local.append(np.searchsorted(needed, k))
+            read.append(needed)
+
+        block = self._read(read)
+        return block[tuple(local)]
+
+    def _read(self, read : List[np.ndarray]) -> np.ndarray:
+        # the block of the given sorted unique indices of each axis
+        needed = read[self.axis]
+        shard_idx = np.searchsorted(self.offsets, needed, side = 'right') - 1
+        blocks = []
+        for s in np.unique(shard_idx):
+            keys = list(read)
+            keys[self.axis] = needed[shard_idx == s] - self.offsets[s]
+            blocks.append(self._readShard(self.shards[s], keys))
+        if not blocks:
+            shape = [len(k) for k in read]
+            return np.zeros(shape, dtype = self.dtype)
+        return np.concatenate(blocks, axis = self.axis)
+
+    def _readShard(self, shard, keys : List[np.ndarray]) -> np.ndarray:
+        # contiguous indices are read as slices. Shards like HDF5
+        # datasets only take one index array per read, so the first is
+        # read from the shard and the others are taken from the result
+        if any(len(k) == 0 for k in keys):
+            shape = [len(k) for k in keys]
+            return np.zeros(shape, dtype = self.dtype)
+        keys = [_readKey(k) for k in keys]
+        arrays = [i for i, k in enumerate(keys) if not isinstance(k, slice)]
+        first = tuple(k if isinstance(k, slice) or i == arrays[0]
+                      else slice(None) for i, k in enumerate(keys)) \
+            if arrays else tuple(keys)
+        out = np.asarray(shard[first])
+        for i in arrays[1:]:
+            out = np.take(out, keys[i], axis = i)
+        return out
+
+    def __array__(self, dtype = None, copy = None) -> np.ndarray:
+        out = self[...]
+        return out if dtype is None else out.astype(dtype)
+
+    def identity(self) -> tuple:
+        """
+        Parts that identify the data of the field without reading it,
+        used by dataIdentity: the axis, and each shard's file or the
+        shard itself if it is an array in memory.
+        """
+        parts = [self.axis]
+        for shard in self.shards:
+            parts.append(shard.identity() if hasattr(shard, 'identity')
+                         else shard)
+        return tuple(parts)
+
+    def numOpen(self) -> int:
+        """
+        Number of file shards that have been opened so far.
+        """
+        return sum(shard.isOpen() for shard in self.shards
+                   if hasattr(shard, 'isOpen'))
+
+
+def _fieldAxis(axis : Union[int, Dict[str, int]], name : str):
+    if isinstance(axis, dict):
+        return axis.get(name, 0)
+    return axis
+
+
+def virtualFields(
+    shards : Sequence[Dict],
+    axis : Union[int, Dict[str, int]] = 0
+) -> Dict[str, VirtualField]:
+    """
+    Combine the fields of many shards into virtual fields.
+
+    Args:
+        shards (Sequence[Dict]): one dictionary of fields per shard,
+            in order, all with the same fields.
+        axis (Union[int, Dict[str, int]], optional): the axis the
+            shards are split on, or a dictionary with the axis of each
+            field. Fields with axis None are the same in every shard,
+            and are taken from the first. Defaults to 0.
+
+    Returns:
+        Dict[str, VirtualField]: the fields.
+    """
+    if not len(shards):
+        msg = 'no shards were given'
+        raise ValueError(msg)
+    names = list(shards[0].keys())
+    for shard in shards[1:]:
+        if sorted(shard.keys()) != sorted(names):
+            msg = 'shards have different fields, %s and %s'
+            raise ValueError(msg%(sorted(names), sorted(shard.keys())))
+    out = {}
+    for name in names:
+        ax = _fieldAxis(axis, name)
+        if ax is None:
+            out[name] = VirtualField([shards[0][name]], 0)
+        else:
+            out[name] = VirtualField([shard[name] for shard in shards], ax)
+    return out
+
+
+def openNpyShards(
+    directories : Sequence[str],
+    axis : Union[int, Dict[str, int]] = 0,
+    mmap_mode : str = 'r'
+) -> Dict[str, VirtualField]:
+    """
+    Open shards that are each a directory with one .npy file per
+    field, the layout of stream.saveDirectory. Only the headers are
+    read here, and a shard's files are memory-mapped when a query
+    first touches it.
+
+    Args:
+        directories (Sequence[str]): the shard directories, in order.
+        axis (Union[int, Dict[str, int]], optional): see
+            virtualFields. Defaults to 0.
+        mmap_mode (str, optional): see np.load. Defaults to 'r'.
+
+    Returns:
+        Dict[str, VirtualField]: the fields.
+    """
+    shards = []
+    for directory in directories:
+        fields = {}
+        for fname in sorted(os.listdir(directory)):
+            name, ext = os.path.splitext(fname)
+            if ext == '.npy':
+                fields[name] = _NpyShard(os.path.join(directory, fname),
+                                         mmap_mode)
+        if not fields:
+            msg = 'no .npy files found in %s'
+            raise ValueError(msg%directory)
+        shards.append(fields)
+    return virtualFields(shards, axis)
+
+
+def openH5Shards(
+    paths : Sequence[str],
+    axis : Union[int, Dict[str, int]] = 0,
+    fields : Sequence[str] = None,
+    group : str = '/'
+) -> Dict[str, VirtualField]:
+    """
+    Open shards that are each an HDF5 file, with one dataset per field
+    in a group. Needs h5py. Files are opened when a query first
+    touches them, and kept open.
+
+    Args:
+        paths (Sequence[str]): the files, in order.
+        axis (Union[int, Dict[str, int]], optional): see
+            virtualFields. Defaults to 0.
+        fields (Sequence[str], optional): the datasets to use.
+            Defaults to every dataset in the group.
+        group (str, optional): the group holding the datasets.
+            Defaults to '/'.
+
+    Returns:
+        Dict[str, VirtualField]: the fields.
+    """
+    try:
+        import h5py
+    except ImportError:
+        msg = 'reading HDF5 shards needs h5py, which is not installed'
+        raise ImportError(msg)
+    if fields is None:
+        with h5py.File(paths[0], 'r') as f:
+            fields = [name for name, obj in f[group].items()
+                      if isinstance(obj, h5py.Dataset)]
+    shards = []
+    for path in paths:
+        shards.append({name : _H5Shard(path, group.rstrip('/') + '/' + name)
+                       for name in fields})
+    return virtualFields(shards, axis)
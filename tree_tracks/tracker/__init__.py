@@ -1,3 +1,5 @@
 from .trajectory import *
 from .sphere import *
-from .tracker_super import *
\ No newline at end of file
+from .tracker_super import *
+from .stack import *
+from .decimate import *
@@ -0,0 +1,188 @@
+#!usr/bin/python3
+
+"""
+This file contains the polyline simplification used to reduce the
+number of points that trajectories send to plotly.
+
+The simplification is a Ramer-Douglas-Peucker pass that is applied to
+every tracker at once on stacked position arrays. Each iteration
+splits every open segment of every tracker at its farthest point, so
+the number of python-level iterations scales with the depth of the
+recursion rather than with the number of trackers or points.
+"""
+
+import numpy as np
+from typing import List
+from tree_tracks.tracker.tracker_super import Tracker
+from tree_tracks.tracker.stack import stackPos
+
+
+def _segmentDist(p, a, b):
+    # distance of each point p to the segment between a and b
+    ab = b - a
+    ab_sq = np.sum(ab**2, axis = -1)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        frac = np.sum((p - a) * ab, axis = -1) / ab_sq
+    frac = np.where(ab_sq > 0, np.clip(frac, 0, 1), 0)
+    proj = a + frac[:, np.newaxis] * ab
+    return np.sqrt(np.sum((p - proj)**2, axis = -1))
+
+
+def rdpSignificance(pos : np.ndarray, tol : float = 0) -> np.ndarray:
+    """
+    Compute the significance of each point in a set of stacked
+    polylines. A point is kept by the simplification with tolerance
+    t if its significance is greater than t, so a single call can be
+    used for any tolerance at or above the one given here.
+
+    Args:
+        pos (np.ndarray): positions with shape (ntrackers, nsnaps,
+            dim), np.nan where a tracker is not alive. Dead points
+            are skipped, so lines connect across gaps in the same
+            way that Trajectory.plot draws them.
+        tol (float, optional): segments whose farthest point is
+            within tol are not split any further, which stops the
+            pass early. Points inside them are given their distance
+            to the segment, which is at most tol. Defaults to 0, for
+            which every point gets its exact significance.
+
+    Returns:
+        np.ndarray: significance with shape (ntrackers, nsnaps). The
+            first and last alive points of each tracker are np.inf,
+            dead points are -1.
+    """
+    ntrk, nsnaps = pos.shape[:2]
+    alive = ~np.isnan(pos[:, :, 0])
+    sig = np.full((ntrk, nsnaps), -1.0)
+    if nsnaps == 0:
+        return sig
+
+    snap_idx = np.broadcast_to(np.arange(nsnaps), (ntrk, nsnaps))
+    has_alive = np.any(alive, axis = 1)
+    rows = np.where(has_alive)[0]
+    first = np.argmax(alive, axis = 1)
+    last = nsnaps - 1 - np.argmax(alive[:, ::-1], axis = 1)
+
+    keep = np.zeros((ntrk, nsnaps), dtype = bool)
+    keep[rows, first[rows]] = True
+    keep[rows, last[rows]] = True
+    sig[keep] = np.inf
+    done = keep | ~alive
+
+    # dead points are not used as anchors, fill them so that the
+    # distance computation stays finite
+    fpos = np.where(alive[:, :, np.newaxis], pos, 0)
+
+    while True:
+        cand = ~done
+        if not np.any(cand):
+            break
+        left = np.maximum.accumulate(np.where(keep, snap_idx, -1), axis = 1)
+        right = np.where(keep, snap_idx, nsnaps)
+        right = np.minimum.accumulate(right[:, ::-1], axis = 1)[:, ::-1]
+
+        # candidates come out of np.where ordered by tracker and then
+        # snapshot, so the points of each segment are contiguous
+        trk_c, snap_c = np.where(cand)
+        left_c = left[trk_c, snap_c]
+        right_c = right[trk_c, snap_c]
+        dist_c = _segmentDist(fpos[trk_c, snap_c], fpos[trk_c, left_c],
+                              fpos[trk_c, right_c])
+
+        seg_c = trk_c * nsnaps + left_c
+        is_start = np.ones(len(seg_c), dtype = bool)
+        is_start[1:] = seg_c[1:] != seg_c[:-1]
+        starts = np.where(is_start)[0]
+        group = np.cumsum(is_start) - 1
+
+        # farthest point of each open segment
+        seg_max = np.maximum.reduceat(dist_c, starts)
+        is_max = np.where(dist_c == seg_max[group])[0]
+        _, first_max = np.unique(group[is_max], return_index = True)
+        heads = is_max[first_max]
+
+        split = seg_max > tol
+        new = heads[split]
+        trk_n = trk_c[new]; snap_n = snap_c[new]
+        parent = np.minimum(sig[trk_n, left_c[new]],
+                            sig[trk_n, right_c[new]])
+        sig[trk_n, snap_n] = np.minimum(dist_c[new], parent)
+        keep[trk_n, snap_n] = True
+        done[trk_n, snap_n] = True
+
+        # close segments that are already within tolerance
+        closed = ~split[group]
+        sig[trk_c[closed], snap_c[closed]] = dist_c[closed]
+        done[trk_c[closed], snap_c[closed]] = True
+
+    return sig
+
+
+def decimateMask(
+    pos : np.ndarray,
+    tol : float = None,
+    budget : int = None
+) -> np.ndarray:
+    """
+    Find the points of stacked polylines that should be kept when
+    simplifying them.
+
+    Args:
+        pos (np.ndarray): positions with shape (ntrackers, nsnaps,
+            dim), np.nan where a tracker is not alive.
+        tol (float, optional): maximum distance, in the units of pos,
+            between the simplified and the full line. Defaults to
+            None.
+        budget (int, optional): maximum number of points to keep over
+            all trackers. The endpoints of each tracker are always
+            kept, so the budget can be exceeded if it is smaller than
+            twice the number of trackers. Defaults to None.
+
+    Returns:
+        np.ndarray: boolean mask with shape (ntrackers, nsnaps).
+    """
+    if tol is None and budget is None:
+        msg = 'decimation requires a tolerance or a point budget'
+        raise ValueError(msg)
+
+    if budget is None:
+        sig = rdpSignificance(pos, tol)
+        return sig > tol
+
+    sig = rdpSignificance(pos, 0 if tol is None else tol)
+    keep = sig > (0 if tol is None else tol)
+    nkeep = np.sum(keep)
+    if nkeep > budget:
+        ranked = np.sort(sig[keep])[::-1]
+        thresh = ranked[max(budget, 1) - 1]
+        keep &= sig >= thresh
+    return keep
+
+
+def decimate(
+    trackers : List[Tracker],
+    tol : float = None,
+    budget : int = None
+) -> List[Tracker]:
+    """
+    Simplify the trajectories of the given trackers in place by
+    setting their level of detail masks. The positions themselves
+    are not changed, so decimation can be undone with
+    Tracker.setLOD(None).
+
+    Args:
+        trackers (List[Tracker]): the trackers to simplify.
+        tol (float, optional): maximum distance between the
+            simplified and full lines. Defaults to None.
+        budget (int, optional): maximum number of points to keep over
+            all of the trackers. Defaults to None.
+
+    Returns:
+        List[Tracker]: the same trackers.
+    """
+    if not trackers:
+        return trackers
+    masks = decimateMask(stackPos(trackers), tol, budget)
+    for i in range(len(trackers)):
+        trackers[i].setLOD(masks[i], auto = True)
+    return trackers
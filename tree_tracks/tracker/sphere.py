@@ -1,7 +1,8 @@
 from tree_tracks.tracker import Tracker
 import numpy as np
-import plotly.graph_objects as go
+from tree_tracks.lazy import go
 import copy
+from tree_tracks.instrument import profile
 class Sphere(Tracker):
 
     def __init__(self, pos, props, surf_props= {}, cdata_props= []):
@@ -35,6 +36,15 @@ class Sphere(Tracker):
 
         return pos - rad, pos + rad
     
+    def getExtent(self):
+        rad = np.asarray(self.getProp(self.rad_prop), dtype = float)
+        rad = rad[:, np.newaxis]
+        return self.pos - rad, self.pos + rad
+    
+    def isTrail(self):
+        return False
+    
+    @profile('tracker.plot')
     def plot(self, snap_slc = None):
         
         # by default, this will plot only the most recent radius
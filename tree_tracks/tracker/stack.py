@@ -0,0 +1,85 @@
+#!usr/bin/python3
+
+"""
+This file contains helper functions that stack the data held by a
+list of trackers into single arrays, so that operations over many
+trackers can be done with vectorized numpy calls instead of python
+loops over the trackers.
+"""
+
+import numpy as np
+from typing import List
+from tree_tracks.tracker.tracker_super import Tracker
+
+
+def stackPos(trackers : List[Tracker]) -> np.ndarray:
+    """
+    Stack the positions of the given trackers.
+
+    Args:
+        trackers (List[Tracker]): trackers to stack. They must all
+            have the same number of snapshots and dimensions.
+
+    Returns:
+        np.ndarray: positions with shape (ntrackers, nsnaps, dim),
+            np.nan where the tracker is not alive.
+    """
+    if not trackers:
+        return np.zeros((0, 0, 3))
+    return np.stack([trk.pos for trk in trackers], axis = 0)
+
+
+class TrackerStack(object):
+    """
+    Stacked view of the data of a list of trackers. Positions and
+    alive masks are stacked on construction, properties are stacked
+    the first time they are requested. All arrays have the tracker
+    axis first and the snapshot axis second.
+    """
+
+    def __init__(self, trackers : List[Tracker]):
+        self.trackers = trackers
+        self.pos = stackPos(trackers)
+        self.alive = ~np.isnan(self.pos[:, :, 0])
+        self.dim = self.pos.shape[2]
+        self._props = {}
+        return
+    
+    def numTrackers(self) -> int:
+        return self.pos.shape[0]
+    
+    def numSnaps(self) -> int:
+        return self.pos.shape[1]
+    
+    def getPos(self, snap_slc = slice(None)) -> np.ndarray:
+        return self.pos[:, snap_slc]
+    
+    def getAlive(self, snap_slc = slice(None)) -> np.ndarray:
+        return self.alive[:, snap_slc]
+    
+    def getProp(self, prop_name : str, snap_slc = slice(None)) -> np.ndarray:
+        if prop_name not in self._props:
+            arrs = [trk.getProp(prop_name) for trk in self.trackers]
+            self._props[prop_name] = np.stack(arrs, axis = 0)
+        return self._props[prop_name][:, snap_slc]
+    
+    def getCustom(self, rows : np.ndarray, snap) -> List[np.ndarray]:
+        """
+        Get the custom data of the given trackers, in the format used
+        by the trace customdata.
+
+        Args:
+            rows (np.ndarray): tracker indices.
+            snap (Union[int, np.ndarray]): the snapshot to get the
+                values at, either one for all trackers or one per
+                row.
+
+        Returns:
+            List[np.ndarray]: one array per custom data property, empty
+                if the trackers have no custom data.
+        """
+        if not self.trackers or not self.trackers[0].cdata:
+            return []
+        cdata = [self.getProp(prop)[rows, snap] 
+                 for prop in self.trackers[0].cdata]
+        return Tracker._reshapeCustom(cdata)
@@ -9,7 +9,8 @@ This file contains the definitions for a "Trace" object.
 import numpy as np
 from abc import abstractmethod
 import copy
-from typing import List
+from typing import Dict, List
+from tree_tracks.buffer import appendTo
 
 class Tracker(object):
     """
@@ -27,6 +28,15 @@ class Tracker(object):
         self.cdata = cdata_props
         self.dim = pos.shape[1]
         self._is_decoratable = True
+        self._is_marker_compatible = True
+        self.lod = None
+        # whether the level of detail mask was set by decimation
+        self._lod_auto = False
+        # incremented whenever the data changes, so that cached
+        # results computed from this tracker can be invalidated
+        self._version = 0
+        # growth buffers of the arrays extended by appendSnaps
+        self._buffers = {}
         return
     
     @abstractmethod
@@ -67,6 +77,15 @@ class Tracker(object):
             user_snaps = np.zeros_like(is_alive)
             user_snaps[snap_slc] = True
             snap_slc = is_alive & user_snaps
+        
+        if self.lod is not None and np.any(snap_slc):
+            # always keep the ends of the requested range, so that
+            # partial trails still end at the current position
+            in_range = np.where(snap_slc)[0]
+            lod = self.lod & snap_slc
+            lod[in_range[0]] = True
+            lod[in_range[-1]] = True
+            snap_slc = lod
         return snap_slc
     
     @abstractmethod
@@ -105,6 +124,7 @@ class Tracker(object):
         
         if prop_dict:
             self.props.update(prop_dict)
+        self._version += 1
         return
 
     def getProp(self, prop_name, snap_slc = slice(None)):
@@ -114,10 +134,80 @@ class Tracker(object):
     def getPos(self, snap_slc = slice(None)):
         return copy.deepcopy(self.pos[snap_slc, :])
     
+    def setLOD(self, lod_mask, auto = False):
+        """
+        Set the level of detail mask, which removes snapshots
+        from the plotted trace without changing the stored positions.
+
+        Args:
+            lod_mask (np.ndarray): boolean array with shape (nsnaps,),
+                True for snapshots that should be plotted. None turns
+                off decimation.
+            auto (bool, optional): the mask was made by decimate, so
+                that visuals that turn decimation off can remove it
+                without removing masks set by the user. Defaults to
+                False.
+        """
+        self.lod = lod_mask
+        self._lod_auto = auto and lod_mask is not None
+        return
+    
+    def getLOD(self):
+        return self.lod
+    
+    def isAutoLOD(self) -> bool:
+        return self._lod_auto
+    
     def setPos(self, new_pos):
         self.pos = new_pos
+        self._version += 1
+        return
+    
+    def getSnapProps(self) -> List[str]:
+        """
+        The properties that have a value for each snapshot.
+        """
+        nsnaps = len(self.pos)
+        return [name for name, val in self.props.items()
+                if np.ndim(val) >= 1 and len(val) == nsnaps]
+    
+    def appendSnaps(self, pos : np.ndarray, props : Dict = {}) -> None:
+        """
+        Add snapshots at the end of the tracker. The arrays grow in
+        place with spare room, so appending a few snapshots at a time
+        does not copy the whole history every time.
+
+        Args:
+            pos (np.ndarray): positions of the new snapshots, with
+                shape (nnew, dim), np.nan where not alive.
+            props (Dict, optional): values of the new snapshots for
+                every property that has one value per snapshot.
+                Defaults to {}.
+        """
+        pos = np.asarray(pos, dtype = float).reshape(-1, self.dim)
+        snap_props = self.getSnapProps()
+        missing = [name for name in snap_props if name not in props]
+        if missing:
+            msg = 'the new snapshots need values for the properties %s'
+            raise ValueError(msg%missing)
+        for name in snap_props:
+            new = np.asarray(props[name])
+            if len(new) != len(pos):
+                msg = 'got %d snapshots of %s for %d new positions'
+                raise ValueError(msg%(len(new), name, len(pos)))
+            self.props[name] = appendTo(self._buffers, name,
+                                        np.asarray(self.props[name]), new)
+        if self.lod is not None:
+            # new snapshots are plotted until the next decimation
+            self.lod = appendTo(self._buffers, '__lod__', self.lod,
+                                np.ones(len(pos), dtype = bool))
+        self.pos = appendTo(self._buffers, '__pos__', self.pos, pos)
+        self._version += 1
         return
     
+    def getVersion(self) -> int:
+        return self._version
+    
     def getAlive(self):
         is_alive = ~np.isnan(self.pos[:, 0])
         return is_alive
@@ -143,8 +233,24 @@ class Tracker(object):
         visible in the plotly figure
         """
         snap_slc = self._default_snap(snap_slc)
-        pos = self.getPos(snap_slc)
+        pos = self.pos[snap_slc, :]
         return pos.min(axis = 0), pos.max(axis = 0)
+    
+    def getExtent(self):
+        """
+        The region the tracker covers at each snapshot, as arrays of
+        the lower and upper corners with shape (nsnaps, dim), np.nan
+        where the tracker is not alive. Used to find the axis ranges
+        of every frame of a movie at once.
+        """
+        return self.pos, self.pos
+    
+    def isTrail(self) -> bool:
+        """
+        Whether a plot over a range of snapshots shows the whole
+        range, like a trajectory, or only the last snapshot.
+        """
+        return True
 
     def setDecoratable(self, is_decor : bool):
         self._is_decoratable = is_decor
@@ -153,6 +259,13 @@ class Tracker(object):
     def getDecoratable(self):
         return self._is_decoratable
     
+    def setMarkerCompatible(self, is_compat : bool):
+        self._is_marker_compatible = is_compat
+        return
+    
+    def getMarkerCompatible(self):
+        return self._is_marker_compatible
+    
     def getEmptyTrace(self):
         pass
 
@@ -6,9 +6,10 @@ This file contains the definitions for a "Trajectory" object.
 #TODO: description
 """
 
-import plotly.graph_objects as go
+from tree_tracks.lazy import go
 from tree_tracks.tracker.tracker_super import Tracker
 import numpy as np
+from tree_tracks.instrument import profile, PROFILER
 
 class Trajectory(Tracker):
     """
@@ -26,6 +27,7 @@ class Trajectory(Tracker):
     def getEmptyTrace(self):
         return go.Scatter3d()
     
+    @profile('tracker.plot')
     def plot(self, snap_slc = None):
         # helper function, handles whether to make 2D or 3D plot
         def _dim_plot(dim, pos, plot_kwargs):
@@ -55,6 +57,7 @@ class Trajectory(Tracker):
         )
 
 
-        scat = _dim_plot(self.dim, pos, plot_kwargs)
+        with PROFILER.stage('plotly.trace'):
+            scat = _dim_plot(self.dim, pos, plot_kwargs)
         return scat
     
@@ -1,3 +1,9 @@
 from .image.image import *
 from .movie.movie import *
 from .movie.event import *
+from .movie.progressive import *
+from .export import *
+from .raster import *
+from .batch import *
+from .stats import *
+from .plan import *
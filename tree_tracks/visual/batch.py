@@ -0,0 +1,289 @@
+#!usr/bin/python3
+
+"""
+This file contains a driver that renders figures for many halos in
+parallel.
+
+The arrays of a Storage (or Vines) object are placed in shared memory
+once, or passed by file name if they are already memory-mapped, and
+each worker process attaches to them instead of receiving a copy.
+Every halo is a separate task that writes its own output file, so
+throughput scales with the number of processes, and halos that fail
+are retried.
+"""
+
+from __future__ import annotations
+import copy
+import os
+import concurrent.futures as cf
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+from typing import Callable, Dict, List, Sequence, Union
+from tree_tracks.visual.export import writeCompactHTML, writeCompactJSON
+from tree_tracks.storage.virtual import memmapOffset
+
+
+def _shareArray(arr : np.ndarray, blocks : list) -> tuple:
+    # spec that lets another process get the same array
+    filename = getattr(arr, 'filename', None)
+    if filename is not None and arr.flags['C_CONTIGUOUS']:
+        offset = memmapOffset(arr)
+        if offset is not None:
+            return ('memmap', str(filename), offset, arr.shape, arr.dtype)
+    shm = shared_memory.SharedMemory(create = True, size = max(arr.nbytes, 1))
+    blocks.append(shm)
+    view = np.ndarray(arr.shape, dtype = arr.dtype, buffer = shm.buf)
+    view[...] = arr
+    return ('shm', shm.name, 0, arr.shape, arr.dtype)
+
+
+def _attachArray(spec : tuple, blocks : list) -> np.ndarray:
+    kind, name, offset, shape, dtype = spec
+    if kind == 'memmap':
+        return np.memmap(name, dtype = dtype, mode = 'r', offset = offset,
+                         shape = shape)
+    # workers share the resource tracker of the process that made the
+    # blocks, so attaching does not change when they are unlinked
+    shm = shared_memory.SharedMemory(name = name)
+    blocks.append(shm)
+    return np.ndarray(shape, dtype = dtype, buffer = shm.buf)
+
+
+class SharedData(object):
+    """
+    Copies of the data arrays of a storage object in shared memory.
+    The data attributes of the object are given by its DATA_ATTRS
+    class attribute, each either an array or a dictionary of arrays.
+    """
+
+    def __init__(self, storage) -> None:
+        self._blocks = []
+        self.specs = {}
+        for attr in storage.DATA_ATTRS:
+            data = getattr(storage, attr)
+            if isinstance(data, dict):
+                self.specs[attr] = {
+                    key : _shareArray(np.asanyarray(val), self._blocks)
+                    for key, val in data.items()
+                }
+            else:
+                self.specs[attr] = _shareArray(data, self._blocks)
+
+        # the storage object is sent to the workers without its data
+        self.shell = copy.copy(storage)
+        for attr in storage.DATA_ATTRS:
+            setattr(self.shell, attr, None)
+        return
+
+    def nbytes(self) -> int:
+        return sum(shm.size for shm in self._blocks)
+
+    def attach(self) -> tuple:
+        """
+        Rebuild the storage object from the shared arrays, in a
+        worker process.
+
+        Returns:
+            tuple: the storage object and the shared memory handles,
+                which must be kept open while it is used.
+        """
+        blocks = []
+        storage = copy.copy(self.shell)
+        for attr, spec in self.specs.items():
+            if isinstance(spec, dict):
+                data = {key : _attachArray(val, blocks)
+                        for key, val in spec.items()}
+            else:
+                data = _attachArray(spec, blocks)
+            setattr(storage, attr, data)
+        return storage, blocks
+
+    def close(self) -> None:
+        for shm in self._blocks:
+            shm.close()
+            shm.unlink()
+        self._blocks = []
+        return
+
+    def __getstate__(self):
+        # workers only need the specs and the shell
+        return {'specs' : self.specs, 'shell' : self.shell, '_blocks' : []}
+
+    def __enter__(self) -> 'SharedData':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+        return
+
+
+# state of a worker process, set by _initWorker
+_WORKER = {}
+
+# output formats, with the file extension and the writer
+OUTPUT_FORMATS = ('html', 'compact_html', 'compact_json')
+
+
+def _initWorker(shared, render, out_dir, fmt, prefix, write_kwargs):
+    storage, blocks = shared.attach()
+    _WORKER.update(storage = storage, blocks = blocks, render = render,
+                   out_dir = out_dir, fmt = fmt, prefix = prefix,
+                   write_kwargs = write_kwargs)
+    return
+
+
+def _outputPath(out_dir, prefix, fmt, halo_idx):
+    ext = '.json' if fmt == 'compact_json' else '.html'
+    return os.path.join(out_dir, '%s%d%s'%(prefix, halo_idx, ext))
+
+
+def _writeFigure(fig, path, fmt, write_kwargs):
+    # written under a temporary name and moved, so that a halo that
+    # fails halfway does not leave a partial output
+    tmp = path + '.tmp'
+    if fmt == 'html':
+        kwargs = dict(include_plotlyjs = 'cdn')
+        kwargs.update(write_kwargs)
+        fig.write_html(tmp, **kwargs)
+    elif fmt == 'compact_html':
+        writeCompactHTML(fig, tmp, **write_kwargs)
+    else:
+        writeCompactJSON(fig, tmp, **write_kwargs)
+    os.replace(tmp, path)
+    return
+
+
+def _renderHalo(halo_idx):
+    state = _WORKER
+    fig = state['render'](state['storage'], halo_idx)
+    path = _outputPath(state['out_dir'], state['prefix'], state['fmt'],
+                       halo_idx)
+    _writeFigure(fig, path, state['fmt'], state['write_kwargs'])
+    return path
+
+
+class BatchRenderer(object):
+    """
+    Renders a figure for each of many halos with a pool of worker
+    processes that share the data of a storage object.
+
+    The render function is called in the workers as
+    render(storage, halo_idx) and returns a plotly figure, for
+    example by traversing the tree from the halo and calling
+    Image.getFig. It must be importable by the workers, so it should
+    be defined at the top level of a module.
+    """
+
+    def __init__(
+        self,
+        storage,
+        render : Callable,
+        out_dir : str,
+        fmt : str = 'html',
+        prefix : str = 'halo_',
+        workers : int = None,
+        retries : int = 2,
+        write_kwargs : Dict = {},
+        mp_context : Union[str, mp.context.BaseContext] = None
+    ) -> None:
+        """
+        Args:
+            storage (Union[Storage, Vines]): the data to render from.
+            render (Callable): the render function, see above.
+            out_dir (str): directory for the outputs, one file per
+                halo named prefix + halo index.
+            fmt (str, optional): 'html' for plotly's write_html,
+                'compact_html' or 'compact_json' for the compact
+                export. Defaults to 'html'.
+            prefix (str, optional): prefix of the output file names.
+                Defaults to 'halo_'.
+            workers (int, optional): number of processes. Defaults to
+                the number of CPUs.
+            retries (int, optional): number of times a failed halo is
+                tried again. Defaults to 2.
+            write_kwargs (Dict, optional): arguments for the writer.
+                Defaults to {}.
+            mp_context (Union[str, BaseContext], optional): the
+                multiprocessing start method. Defaults to the platform
+                default.
+        """
+        if fmt not in OUTPUT_FORMATS:
+            msg = 'output format %s not understood, expected one of %s'
+            raise ValueError(msg%(fmt, OUTPUT_FORMATS))
+        self.storage = storage
+        self.render = render
+        self.out_dir = out_dir
+        self.fmt = fmt
+        self.prefix = prefix
+        self.workers = workers or os.cpu_count()
+        self.retries = retries
+        self.write_kwargs = write_kwargs
+        if isinstance(mp_context, str):
+            mp_context = mp.get_context(mp_context)
+        self.mp_context = mp_context
+        self.errors = {}
+        return
+
+    def getOutputPath(self, halo_idx : int) -> str:
+        return _outputPath(self.out_dir, self.prefix, self.fmt, halo_idx)
+
+    def run(
+        self,
+        halo_idxs : Sequence[int],
+        overwrite : bool = False
+    ) -> Dict[int, str]:
+        """
+        Render all of the given halos.
+
+        Args:
+            halo_idxs (Sequence[int]): the halos to render.
+            overwrite (bool, optional): render halos whose output
+                already exists, otherwise they are skipped, which lets
+                an interrupted run be resumed. Defaults to False.
+
+        Returns:
+            Dict[int, str]: the output path of each halo that was
+                rendered. Halos that failed after all retries are in
+                the errors attribute, with their last exception.
+        """
+        os.makedirs(self.out_dir, exist_ok = True)
+        todo = [int(idx) for idx in halo_idxs]
+        if not overwrite:
+            todo = [idx for idx in todo
+                    if not os.path.exists(self.getOutputPath(idx))]
+
+        done = {}
+        self.errors = {}
+        with SharedData(self.storage) as shared:
+            for attempt in range(self.retries + 1):
+                if not todo:
+                    break
+                failed = self._runOnce(shared, todo, done)
+                todo = failed
+        return done
+
+    def _runOnce(self, shared : SharedData, todo : List[int],
+                 done : Dict[int, str]) -> List[int]:
+        # one pass over the halos, returns the ones that failed. A
+        # worker that dies breaks the pool, so its halos and the ones
+        # still pending are failed and retried with a new pool
+        failed = []
+        initargs = (shared, self.render, self.out_dir, self.fmt,
+                    self.prefix, self.write_kwargs)
+        with cf.ProcessPoolExecutor(
+            max_workers = min(self.workers, len(todo)),
+            mp_context = self.mp_context,
+            initializer = _initWorker,
+            initargs = initargs
+        ) as pool:
+            futures = {pool.submit(_renderHalo, idx) : idx for idx in todo}
+            for fut in cf.as_completed(futures):
+                idx = futures[fut]
+                try:
+                    done[idx] = fut.result()
+                    self.errors.pop(idx, None)
+                except Exception as exc:
+                    self.errors[idx] = exc
+                    failed.append(idx)
+        return failed
@@ -0,0 +1,509 @@
+#!usr/bin/python3
+
+"""
+This file contains a compact export path for figures made by Image
+and Movie.
+
+Trace arrays are written as base64 typed arrays, in single precision
+by default and optionally rounded to a number of significant digits,
+and arrays that appear more than once (for example the same trail in
+many frames of a movie) are written once and referenced. The HTML
+output contains a small loader that resolves the references before
+handing the figure to plotly.js, which reads typed arrays natively.
+"""
+
+import base64
+import os
+import hashlib
+import json
+import numpy as np
+from typing import Dict, Tuple, Union
+
+# arrays shorter than this are left as JSON lists
+MIN_ENCODE_LEN = 8
+
+# integer types that plotly.js can read, smallest first
+_INT_TYPES = ['i1', 'u1', 'i2', 'u2', 'i4', 'u4']
+
+
+def _decodeSpec(spec : Dict) -> np.ndarray:
+    # plotly typed array spec to numpy array
+    arr = np.frombuffer(base64.b64decode(spec['bdata']),
+                        dtype = np.dtype(spec['dtype']))
+    if 'shape' in spec:
+        shape = [int(n) for n in str(spec['shape']).split(',')]
+        arr = arr.reshape(shape)
+    return arr
+
+
+def _asNumeric(val) -> np.ndarray:
+    # numeric numpy array for val, or None if it is not numeric
+    if isinstance(val, dict) and 'bdata' in val and 'dtype' in val:
+        return _decodeSpec(val)
+    if isinstance(val, np.ndarray) and val.dtype.kind in 'biuf':
+        return val
+    if isinstance(val, (list, tuple, np.ndarray)):
+        if len(val) < MIN_ENCODE_LEN:
+            return None
+        # text, such as frame names and hover text, stays as it is
+        if any(isinstance(v, str) for v in val):
+            return None
+        try:
+            arr = np.array(val.tolist() if isinstance(val, np.ndarray)
+                           else val, dtype = float)
+        except (TypeError, ValueError):
+            return None
+        # nested customdata tuples can give more than 2 dimensions
+        if arr.ndim > 2:
+            arr = arr.reshape(arr.shape[0], -1)
+        return arr
+    return None
+
+
+def quantize(arr : np.ndarray, sig_digits : int) -> np.ndarray:
+    """
+    Round the values of a float array to a number of significant
+    digits, which makes the encoded output much more compressible.
+    """
+    arr = np.asarray(arr, dtype = float)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        mag = np.floor(np.log10(np.abs(arr)))
+    mag = np.where(np.isfinite(mag), mag, 0)
+    scale = 10.0**(sig_digits - 1 - mag)
+    return np.round(arr * scale) / scale
+
+
+def encodeArray(
+    arr : np.ndarray,
+    dtype : Union[str, np.dtype] = np.float32,
+    sig_digits : int = None
+) -> Dict:
+    """
+    Encode a numeric array as a plotly typed array spec.
+
+    Args:
+        arr (np.ndarray): the array, at most 2D.
+        dtype (Union[str, np.dtype], optional): the type to store
+            floats as. Defaults to np.float32.
+        sig_digits (int, optional): if given, floats are rounded to
+            this many significant digits. Defaults to None.
+
+    Returns:
+        Dict: with dtype, bdata and, for 2D arrays, shape.
+    """
+    arr = np.asarray(arr)
+    if arr.dtype.kind == 'b':
+        arr = arr.astype('u1')
+    if arr.dtype.kind in 'iu':
+        lo, hi = (arr.min(), arr.max()) if arr.size else (0, 0)
+        for name in _INT_TYPES:
+            info = np.iinfo(name)
+            if info.min <= lo and hi <= info.max:
+                arr = arr.astype(name)
+                break
+        else:
+            arr = arr.astype('f8')
+    else:
+        # floats that are all integers are stored as integers
+        finite = np.isfinite(arr)
+        if arr.size and np.all(finite) and np.all(arr == np.round(arr)):
+            return encodeArray(arr.astype(np.int64), dtype, sig_digits)
+        if sig_digits is not None:
+            arr = quantize(arr, sig_digits)
+        arr = arr.astype(dtype)
+
+    spec = {
+        'dtype' : arr.dtype.str.lstrip('<>|='),
+        'bdata' : base64.b64encode(np.ascontiguousarray(arr).data).decode()
+    }
+    if arr.ndim > 1:
+        spec['shape'] = ','.join(str(n) for n in arr.shape)
+    return spec
+
+
+class _ArrayTable(object):
+    # unique encoded arrays, referenced from the figure
+
+    def __init__(self, dtype, sig_digits):
+        self.dtype = dtype
+        self.sig_digits = sig_digits
+        self.arrays = []
+        self._index = {}
+        # number of arrays already handed out by flush
+        self._flushed = 0
+
+    def add(self, arr):
+        spec = encodeArray(arr, self.dtype, self.sig_digits)
+        digest = hashlib.blake2b((spec['dtype'] + spec.get('shape', '') +
+                                  spec['bdata']).encode(),
+                                 digest_size = 16).hexdigest()
+        if digest not in self._index:
+            self._index[digest] = self._flushed + len(self.arrays)
+            self.arrays.append(spec)
+        return {'__ref__' : self._index[digest]}
+
+    def flush(self):
+        # the arrays added since the last flush, which are then
+        # dropped. Only their hashes are kept, so that later frames
+        # can still refer to them
+        out = self.arrays
+        self._flushed += len(out)
+        self.arrays = []
+        return out
+
+    def walk(self, obj):
+        arr = _asNumeric(obj)
+        if arr is not None:
+            return self.add(arr)
+        if isinstance(obj, dict):
+            return {k : self.walk(v) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return [self.walk(v) for v in obj]
+        return obj
+
+
+def compactFigure(
+    fig,
+    dtype : Union[str, np.dtype] = np.float32,
+    sig_digits : int = None
+) -> Dict:
+    """
+    Convert a figure to the compact format.
+
+    Args:
+        fig (go.Figure): the figure, with or without frames.
+        dtype (Union[str, np.dtype], optional): the type to store
+            floats as. Defaults to np.float32.
+        sig_digits (int, optional): round floats to this many
+            significant digits. Defaults to None.
+
+    Returns:
+        Dict: with 'arrays', the unique typed array specs, and
+            'figure', the figure dictionary where every array is
+            replaced by {'__ref__' : index into arrays}.
+    """
+    fig_dict = fig if isinstance(fig, dict) else fig.to_dict()
+    table = _ArrayTable(dtype, sig_digits)
+    out = table.walk(fig_dict)
+    return {'arrays' : table.arrays, 'figure' : out}
+
+
+def _dumps(obj) -> str:
+    # json without spaces, numpy scalars and arrays that were too
+    # short to encode are written as plain values
+    def _default(o):
+        if isinstance(o, np.generic):
+            return o.item()
+        if isinstance(o, np.ndarray):
+            return o.tolist()
+        raise TypeError('cannot serialise %s' % type(o))
+    return json.dumps(obj, separators = (',', ':'), default = _default)
+
+
+def writeCompactJSON(
+    fig,
+    path : str,
+    dtype : Union[str, np.dtype] = np.float32,
+    sig_digits : int = None
+) -> None:
+    """
+    Write a figure to a JSON file in the compact format, see
+    compactFigure. The figure can be restored in javascript by
+    replacing every {'__ref__' : i} with arrays[i].
+    """
+    with open(path, 'w') as f:
+        f.write(_dumps(compactFigure(fig, dtype, sig_digits)))
+    return
+
+
+# resolves the array references and draws the figure
+_LOADER = """
+(function() {
+  var payload = %(payload)s;
+  function resolve(o) {
+    if (Array.isArray(o)) { return o.map(resolve); }
+    if (o !== null && typeof o === 'object') {
+      if ('__ref__' in o) { return payload.arrays[o.__ref__]; }
+      var out = {};
+      for (var k in o) { out[k] = resolve(o[k]); }
+      return out;
+    }
+    return o;
+  }
+  var fig = resolve(payload.figure);
+  var div = document.getElementById('%(div_id)s');
+  Plotly.newPlot(div, fig.data, fig.layout || {}, %(config)s).then(function() {
+    if (fig.frames) { return Plotly.addFrames(div, fig.frames); }
+  });
+})();
+"""
+
+
+def _plotlyScript(include_plotlyjs : Union[bool, str]) -> str:
+    if include_plotlyjs is True:
+        from plotly.offline import get_plotlyjs
+        return '<script type="text/javascript">%s</script>' % get_plotlyjs()
+    if include_plotlyjs == 'cdn':
+        from plotly.offline import get_plotlyjs_version
+        url = 'https://cdn.plot.ly/plotly-%s.min.js' % get_plotlyjs_version()
+        return '<script src="%s"></script>' % url
+    if isinstance(include_plotlyjs, str):
+        return '<script src="%s"></script>' % include_plotlyjs
+    return ''
+
+
+def _pageParts(include_plotlyjs, div_id) -> Tuple[str, str]:
+    # the page around the script that draws the figure
+    head = ('<html>\n<head><meta charset="utf-8" /></head>\n<body>\n'
+            '%s\n<div id="%s" style="height:100%%; width:100%%;"></div>\n'
+            '<script type="text/javascript">\n'
+            % (_plotlyScript(include_plotlyjs), div_id))
+    tail = '\n</script>\n</body>\n</html>\n'
+    return head, tail
+
+
+def htmlDocument(
+    payload_js : str,
+    include_plotlyjs : Union[bool, str] = 'cdn',
+    div_id : str = 'tree-tracks-figure',
+    config : Dict = {}
+) -> Tuple[str, str]:
+    """
+    The parts of an HTML page that draws a compact figure, before
+    and after the javascript expression of the payload.
+    """
+    head, tail = _pageParts(include_plotlyjs, div_id)
+    loader = _LOADER % {'payload' : '__PAYLOAD__', 'div_id' : div_id,
+                        'config' : _dumps(config)}
+    before, after = loader.split('__PAYLOAD__')
+    return head + before, after + tail
+
+
+def writeCompactHTML(
+    fig,
+    path : str,
+    dtype : Union[str, np.dtype] = np.float32,
+    sig_digits : int = None,
+    include_plotlyjs : Union[bool, str] = 'cdn',
+    config : Dict = {}
+) -> None:
+    """
+    Write a figure to a standalone HTML file in the compact format.
+
+    Args:
+        fig (go.Figure): the figure, with or without frames.
+        path (str): output file.
+        dtype (Union[str, np.dtype], optional): the type to store
+            floats as. Defaults to np.float32.
+        sig_digits (int, optional): round floats to this many
+            significant digits. Defaults to None.
+        include_plotlyjs (Union[bool, str], optional): True to embed
+            plotly.js, 'cdn' to load it from the plotly CDN, another
+            string to use as the script source, False to leave it
+            out. Defaults to 'cdn'.
+        config (Dict, optional): plotly config options. Defaults to {}.
+    """
+    head, tail = htmlDocument('', include_plotlyjs, config = config)
+    with open(path, 'w') as f:
+        f.write(head)
+        f.write(_dumps(compactFigure(fig, dtype, sig_digits)))
+        f.write(tail)
+    return
+
+
+# draws a streamed movie, frames carry the arrays they add
+_STREAM_LOADER = """
+(function() {
+  var arrays = [];
+  function resolve(o) {
+    if (Array.isArray(o)) { return o.map(resolve); }
+    if (o !== null && typeof o === 'object') {
+      if ('__ref__' in o) { return arrays[o.__ref__]; }
+      var out = {};
+      for (var k in o) { out[k] = resolve(o[k]); }
+      return out;
+    }
+    return o;
+  }
+  function addChunk(chunk) {
+    Array.prototype.push.apply(arrays, chunk.arrays);
+    return resolve(chunk.frame);
+  }
+  var div = document.getElementById('%(div_id)s');
+  %(body)s
+})();
+"""
+
+# the whole movie is in the page
+_INLINE_BODY = """
+  var layout = addChunk(payload.layout);
+  var frames = payload.frames.map(addChunk);
+  Plotly.newPlot(div, frames[0].data, layout, %(config)s).then(function() {
+    return Plotly.addFrames(div, frames);
+  });
+"""
+
+# frames are fetched from a directory, which needs the page to be
+# served over http
+_FETCH_BODY = """
+  fetch('movie.json').then(function(r) { return r.json(); }).then(function(meta) {
+    var layout = addChunk(meta.layout);
+    var chain = Promise.resolve();
+    meta.frames.forEach(function(fname, i) {
+      chain = chain.then(function() {
+        return fetch(fname).then(function(r) { return r.json(); });
+      }).then(function(chunk) {
+        var frame = addChunk(chunk);
+        if (i === 0) {
+          return Plotly.newPlot(div, frame.data, layout, %(config)s).then(
+            function() { return Plotly.addFrames(div, [frame]); });
+        }
+        return Plotly.addFrames(div, [frame]);
+      });
+    });
+  });
+"""
+
+# output formats of MovieWriter
+STREAM_FORMATS = ('html', 'json', 'dir')
+
+
+class MovieWriter(object):
+    """
+    Writes the frames of a movie to disk one at a time, in the
+    compact format of compactFigure, so that only one frame is in
+    memory at a time. Arrays shared between frames are still written
+    once: each frame carries the arrays that appear for the first
+    time in it, and refers to earlier ones by index.
+
+    The formats are
+
+        html: a standalone page, like writeCompactHTML
+        json: a single file {"layout": chunk, "frames": [chunk, ...]}
+            where each chunk is {"arrays": [...], "frame": {...}},
+            with the arrays that the layout or frame adds
+        dir: a directory with movie.json (layout and frame file
+            names), one frame_NNNNN.json chunk per frame, and an
+            index.html that loads the frames as they arrive. The page
+            has to be served over http, for example with
+            python -m http.server.
+
+    """
+
+    DIV_ID = 'tree-tracks-figure'
+
+    def __init__(
+        self,
+        path : str,
+        fmt : str = 'html',
+        dtype : Union[str, np.dtype] = np.float32,
+        sig_digits : int = None,
+        include_plotlyjs : Union[bool, str] = 'cdn',
+        config : Dict = {}
+    ) -> None:
+        """
+        Args:
+            path (str): the output file, or directory for 'dir'.
+            fmt (str, optional): see above. Defaults to 'html'.
+            dtype (Union[str, np.dtype], optional): the type to store
+                floats as. Defaults to np.float32.
+            sig_digits (int, optional): round floats to this many
+                significant digits. Defaults to None.
+            include_plotlyjs (Union[bool, str], optional): see
+                writeCompactHTML. Defaults to 'cdn'.
+            config (Dict, optional): plotly config options. Defaults
+                to {}.
+        """
+        if fmt not in STREAM_FORMATS:
+            msg = 'output format %s not understood, expected one of %s'
+            raise ValueError(msg%(fmt, STREAM_FORMATS))
+        self.path = path
+        self.fmt = fmt
+        self.include_plotlyjs = include_plotlyjs
+        self.config = config
+        self.table = _ArrayTable(dtype, sig_digits)
+        self.nframes = 0
+        self._file = None
+        self._frame_files = []
+        self._layout = None
+        self._tail = ''
+        return
+
+    def open(self, layout) -> 'MovieWriter':
+        """
+        Start the output with the layout of the movie.
+        """
+        layout_js = self._chunk(layout)
+        self._layout = layout_js
+        if self.fmt == 'dir':
+            os.makedirs(self.path, exist_ok = True)
+            return self
+
+        self._file = open(self.path, 'w')
+        if self.fmt == 'html':
+            head, tail = _pageParts(self.include_plotlyjs, self.DIV_ID)
+            self._file.write(head + 'var payload = ')
+            self._tail = ';\n' + self._loader(_INLINE_BODY) + tail
+        self._file.write('{"layout":%s,"frames":[' % layout_js)
+        return self
+
+    def _loader(self, body) -> str:
+        body = body % {'config' : _dumps(self.config)}
+        return _STREAM_LOADER % {'div_id' : self.DIV_ID, 'body' : body}
+
+    def _chunk(self, obj) -> str:
+        # a frame or layout and the arrays it adds, as json
+        obj = obj if isinstance(obj, dict) else obj.to_plotly_json()
+        obj = self.table.walk(obj)
+        return _dumps({'arrays' : self.table.flush(), 'frame' : obj})
+
+    def write(self, frame) -> None:
+        """
+        Write a frame, a go.Frame or its dictionary.
+        """
+        chunk = self._chunk(frame)
+        if self.fmt == 'dir':
+            fname = 'frame_%05d.json' % self.nframes
+            with open(os.path.join(self.path, fname), 'w') as f:
+                f.write(chunk)
+            self._frame_files.append(fname)
+        else:
+            if self.nframes:
+                self._file.write(',')
+            self._file.write(chunk)
+        self.nframes += 1
+        return
+
+    def close(self) -> None:
+        """
+        Finish the output.
+        """
+        if self._layout is None:
+            msg = 'the writer was closed before it was opened'
+            raise ValueError(msg)
+        if self.fmt == 'dir':
+            with open(os.path.join(self.path, 'movie.json'), 'w') as f:
+                f.write('{"layout":%s,"frames":%s}' % (
+                    self._layout, _dumps(self._frame_files)))
+            head, tail = _pageParts(self.include_plotlyjs, self.DIV_ID)
+            with open(os.path.join(self.path, 'index.html'), 'w') as f:
+                f.write(head + self._loader(_FETCH_BODY) + tail)
+            return
+        if self._file is not None:
+            self._file.write(']}')
+            self._file.write(self._tail)
+            self._file.close()
+            self._file = None
+        return
+
+    def __enter__(self) -> 'MovieWriter':
+        return self
+
+    def __exit__(self, exc_type, *args) -> None:
+        # an output that failed halfway is left unfinished
+        if exc_type is None:
+            self.close()
+        elif self._file is not None:
+            self._file.close()
+            self._file = None
+        return
@@ -7,11 +7,13 @@ trajectories of a halo and its descendents
 #TODO: description
 """
     
-import plotly.graph_objects as go
+from __future__ import annotations
+from tree_tracks.lazy import go
 from tree_tracks.tracker.tracker_super import Tracker
 from tree_tracks.decorator import Decorator
 from typing import List, Dict
-from tree_tracks.visual.visual import Visual
+from tree_tracks.visual.visual import Visual, MergedTrails
+from tree_tracks.instrument import profile
 
 class Image(Visual):
 
@@ -31,18 +33,44 @@ class Image(Visual):
     def numTrackers(self) -> int:
         return len(self.trackers)
     
+    def _numExtraTraces(self) -> int:
+        return len(self.decorators)
+    
+    @profile('image.getFig')
     def getFig(self) -> go.Figure:
         data = []
+        layout = self.layout
 
-        for i in range(len(self.trackers)):
-            scat = self.trackers[i].plot()
-            data.append(scat)
+        if self.render_mode == 'raster':
+            # all trackers as a single density heatmap
+            pos = self._rasterPos()
+            extent = self.raster.getExtent(pos)
+            grid = self.raster.density(pos, extent = extent)
+            data.append(self.raster.heatmap(grid, extent))
+            layout = go.Layout(self.raster.layout(extent))
+            layout.update(self.layout)
+        elif self.render_mode == 'merged':
+            self._applyDecimation()
+            merged = MergedTrails(self.trackers)
+            data.append(merged.plot())
+            for trk in merged.others:
+                data.append(trk.plot())
+        else:
+            self._applyDecimation()
+            for i in range(len(self.trackers)):
+                scat = self.trackers[i].plot()
+                data.append(scat)
         
         for i in range(len(self.decorators)):
             lsnap = len(self.trackers[0].getAlive()) - 1
-            scat = self.decorators[i].plot(self.trackers, lsnap)
+            if isinstance(self.decorators[i], Decorator):
+                scat = self.decorators[i].decoratePlot(self.trackers, lsnap)
+            else:
+                scat = self.decorators[i].plot(self.trackers, lsnap)
+            if self.render_mode == 'raster':
+                scat = self.raster.project(scat)
             data.append(scat)
-        fig = go.Figure(data = data, layout=self.layout)
+        fig = go.Figure(data = data, layout=layout)
         return fig
     
 
@@ -1,12 +1,225 @@
 #!usr/bin/python3
 
 """
-This file contains the definitions for an "Event" object. 
+This file contains the definitions for an "Event" object.
 
-#TODO: description
+Events are found for all tracers of a host at once from their
+distance to the host in units of the host's R200m. The results are
+stored in an EventTable, which markers can draw in images and which
+movies can slice frame by frame.
 """
 
+import numpy as np
+from typing import Dict, List, Sequence
+from tree_tracks.decorator.event_table import EventTable
+from tree_tracks.decorator.marker_funcs import eventMarkFunc, matchIndex
+from tree_tracks.storage.simulation import Simulation
+from tree_tracks.instrument import profile
+
+
 class Event(object):
+    """
+    Vectorized detection of orbital events of tracers around a host.
+
+    The detected event types are
+
+        r200m_in: the tracer moves inside R200m
+        r200m_out: the tracer moves outside R200m
+        first_infall: the first r200m_in of the tracer
+        pericenter: local minimum of the distance to the host
+        apocenter: local maximum of the distance to the host
+
+    Crossings are placed at the first snapshot on the new side of
+    R200m, turning points at the snapshot of the extremum. Only
+    snapshots where both the tracer and the host are alive are used.
+    """
+
+    TYPES = ['r200m_in', 'r200m_out', 'first_infall',
+             'pericenter', 'apocenter']
+
+    def __init__(
+        self,
+        tcr_pos : np.ndarray,
+        host_pos : np.ndarray,
+        host_rad : np.ndarray,
+        sim : Simulation = None,
+        index : np.ndarray = None
+    ) -> None:
+        """
+        Args:
+            tcr_pos (np.ndarray): tracer positions with shape
+                (ntracers, nsnaps, 3). Snapshots where a tracer is
+                not alive are np.nan or -1.
+            host_pos (np.ndarray): host positions, shape (nsnaps, 3).
+            host_rad (np.ndarray): host R200m, shape (nsnaps,). Values
+                that are not positive mark the host as not alive.
+            sim (Simulation, optional): if given, separations are
+                wrapped in the periodic box. Defaults to None.
+            index (np.ndarray, optional): the index of each tracer,
+                stored in the trk column of the event table. Defaults
+                to the row of each tracer.
+        """
+        self.pos = tcr_pos
+        self.sim = sim
+        ntcr = tcr_pos.shape[0]
+        self.index = np.arange(ntcr) if index is None else np.asarray(index)
+
+        # positions outside the box are never valid, so the first
+        # component is enough to find the -1 sentinels
+        tcr_x = tcr_pos[:, :, 0]
+        tcr_alive = (tcr_x != -1) & ~np.isnan(tcr_x)
+        host_alive = np.isfinite(host_rad) & (host_rad > 0)
+        self.alive = tcr_alive & host_alive[np.newaxis, :]
+
+        # distances only need single precision, working one component
+        # at a time keeps the temporary arrays small
+        rsq = np.zeros(self.alive.shape, dtype = np.float32)
+        for i in range(tcr_pos.shape[2]):
+            delta = tcr_pos[:, :, i] - host_pos[np.newaxis, :, i]
+            delta = delta.astype(np.float32, copy = False)
+            if sim is not None:
+                delta = sim.wrapDelta(delta)
+            rsq += delta * delta
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            inv_rad = (1 / host_rad).astype(np.float32)
+        self.x = np.sqrt(rsq, out = rsq)
+        self.x *= inv_rad[np.newaxis, :]
+        self.x[~self.alive] = np.nan
+
+        self.table = None
+        self._masks = None
+        return
+
+    @staticmethod
+    def fromVines(vines, halo_idx : int) -> 'Event':
+        """
+        Set up event detection for all of the tracers of a halo in
+        a Vines object.
+
+        Args:
+            vines (Vines): the tracer and halo data.
+            halo_idx (int): index of the host halo.
+
+        Returns:
+            Event: events of the tracers, indexed by tracer index.
+        """
+        ptl_idxs = vines.getHaloPtls(halo_idx)
+        host_pos = vines.getHaloData(vines.HOST_POS_KEY, halo_idx)
+        host_rad = vines.getHaloData(vines.HOST_RAD_KEY, halo_idx)
+        return Event(vines.getPos(ptl_idxs), host_pos, host_rad,
+                     vines.sim, ptl_idxs)
+
+    def getRadius(self) -> np.ndarray:
+        """
+        Distance of each tracer to the host in units of R200m, with
+        shape (ntracers, nsnaps), np.nan where not alive.
+        """
+        return self.x
+
+    def _getMasks(self) -> tuple:
+        # masks shared by the event types, computed once
+        if self._masks is None:
+            both = self.alive[:, :-1] & self.alive[:, 1:]
+            inside = self.x < 1
+            dx = np.diff(self.x, axis = 1)
+            self._masks = (both, inside, dx)
+        return self._masks
+
+    def _find(self, etype : str) -> tuple:
+        # returns the rows and snapshots of all events of one type
+        both, inside, dx = self._getMasks()
+        if etype in ('r200m_in', 'first_infall'):
+            cross = both & ~inside[:, :-1] & inside[:, 1:]
+            if etype == 'first_infall':
+                has_cross = np.any(cross, axis = 1)
+                rows = np.where(has_cross)[0]
+                return rows, np.argmax(cross[rows], axis = 1) + 1
+            rows, snaps = np.where(cross)
+            return rows, snaps + 1
+
+        elif etype == 'r200m_out':
+            rows, snaps = np.where(both & inside[:, :-1] & ~inside[:, 1:])
+            return rows, snaps + 1
+
+        elif etype in ('pericenter', 'apocenter'):
+            # the middle snapshot of three alive snapshots is a
+            # turning point if the radial velocity changes sign
+            valid = both[:, :-1] & both[:, 1:]
+            if etype == 'pericenter':
+                turn = valid & (dx[:, :-1] < 0) & (dx[:, 1:] >= 0)
+            else:
+                turn = valid & (dx[:, :-1] > 0) & (dx[:, 1:] <= 0)
+            rows, snaps = np.where(turn)
+            return rows, snaps + 1
+
+        msg = 'event type %s not understood, expected one of %s'
+        raise ValueError(msg%(etype, self.TYPES))
+
+    @profile('event.detect')
+    def detect(
+        self,
+        types : Sequence[str] = None,
+        cdata : Dict[str, np.ndarray] = {}
+    ) -> EventTable:
+        """
+        Find all events of the given types.
+
+        Args:
+            types (Sequence[str], optional): event types to find.
+                Defaults to all of them.
+            cdata (Dict[str, np.ndarray], optional): properties with
+                shape (ntracers, nsnaps) to store as custom data,
+                taken at the snapshot of each event, for example
+                {'r_r200m' : self.getRadius()}. Defaults to {}.
+
+        Returns:
+            EventTable: the events, also stored in the table attribute.
+        """
+        if types is None:
+            types = self.TYPES
+
+        rows, snaps, codes = [], [], []
+        for code, etype in enumerate(types):
+            r, s = self._find(etype)
+            rows.append(r); snaps.append(s)
+            codes.append(np.full(len(r), code))
+        rows = np.concatenate(rows)
+        snaps = np.concatenate(snaps)
+
+        custom = []
+        for arr in cdata.values():
+            custom.append(arr[rows, snaps])
+
+        self.table = EventTable(self.index[rows], np.concatenate(codes),
+                                snaps, self.pos[rows, snaps], custom,
+                                list(types))
+        return self.table
+
+    def markFunc(self, etype : str):
+        """
+        Make a marker function that draws the events of one type.
+        The tracker that an event belongs to is matched through the
+        'index' property of the trackers, which Vines and Storage
+        set when creating them.
+
+        Args:
+            etype (str): the event type to draw.
+
+        Returns:
+            Callable: a marker function for Marker, see eventMarkFunc.
+        """
+        if self.table is None or etype not in self.table.getTypeNames():
+            self.detect(self.TYPES)
+        events = self.table.select(etype)
+
+        def _events(stack):
+            try:
+                trk_index = stack.getProp('index', 0) \
+                    if stack.numTrackers() else np.zeros(0, dtype = np.int64)
+            except KeyError:
+                trk_index = np.arange(stack.numTrackers())
+            rows, found = matchIndex(trk_index, events.trk)
+            return rows, events.snap[found], events.pos[found]
 
-    def __init__(self) -> None:
-        pass
+        _events.__name__ = etype
+        return eventMarkFunc(_events)
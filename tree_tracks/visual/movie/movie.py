@@ -10,13 +10,38 @@ trajectories of a halo and its descendents
 
 # handle unit conversions
     
-import plotly.graph_objects as go
+from __future__ import annotations
+from tree_tracks.lazy import go
 import numpy as np
-from tree_tracks.decorator import Decorator
+from tree_tracks.decorator import Decorator, Marker
 from tree_tracks.tracker.tracker_super import Tracker
 from tree_tracks.visual.movie.event import Event
 from typing import List, Dict
-from tree_tracks.visual.visual import Visual
+from tree_tracks.visual.visual import Visual, MergedTrails
+from tree_tracks.instrument import profile
+from tree_tracks.buffer import appendTo
+
+# the ways the axis ranges can change between frames
+CAMERA_MODES = ('static', 'frame', 'follow')
+
+# major versions of plotly whose figures keep their frames in
+# _frame_objs, checked by _appendFigFrames
+FRAME_OBJS_PLOTLY = (4, 5, 6, 7)
+
+
+def _appendFigFrames(fig, frames):
+    # setting the frames of a figure validates and copies every frame
+    # again, so with a known plotly only the new ones are validated
+    # and added. Other versions use the public setter
+    import plotly
+    major = int(plotly.__version__.split('.')[0])
+    if major in FRAME_OBJS_PLOTLY and hasattr(fig, '_frame_objs') and \
+            hasattr(fig, '_frames_validator'):
+        new = fig._frames_validator.validate_coerce(frames)
+        fig._frame_objs = tuple(fig._frame_objs) + tuple(new)
+    else:
+        fig.frames = tuple(fig.frames) + tuple(frames)
+    return
 
 class Movie(Visual):
     """
@@ -35,6 +60,13 @@ class Movie(Visual):
         super().__init__(trackers)
         self.layout = go.Layout()
         self.markers = markers
+        # the last snapshot of each frame made so far
+        self._frame_snaps = []
+        # state kept for appendFrames: the tracker extents, what the
+        # camera carries from the last frame and the merged trails
+        self._extents = None
+        self._camera_state = None
+        self._merged = None
 
         # default button needed
         play_button = dict(
@@ -52,6 +84,7 @@ class Movie(Visual):
         #         None
         #     ]
         # )
+        self.setCamera()
         self.setMenu(buttons = [play_button])  
         self.setScene(
             {'aspectratio' : {'x':1, 'y':1, 'z':1}}
@@ -66,6 +99,232 @@ class Movie(Visual):
         self.layout.update(scene = scene_dict)
         return
     
+    def setCamera(self, mode : str = 'static', host : Tracker = None,
+                  padding : float = 0, smoothing : float = 0):
+        """
+        Choose how the axis ranges change between frames.
+
+        Args:
+            mode (str, optional): 'static' uses one range that shows
+                every frame, 'frame' fits the range to each frame, and
+                'follow' keeps the host tracker at the center of a
+                cube that fits the frame. Defaults to 'static'.
+            host (Tracker, optional): the tracker to follow, needed
+                for the 'follow' mode. Defaults to None.
+            padding (float, optional): fraction of the range added on
+                each side. Defaults to 0.
+            smoothing (float, optional): between 0 and 1, how much of
+                the previous frame's range is kept, which stops the
+                camera from jumping between frames. Defaults to 0.
+        """
+        if mode not in CAMERA_MODES:
+            msg = 'camera mode %s not understood, expected one of %s'
+            raise ValueError(msg%(mode, CAMERA_MODES))
+        if mode == 'follow' and host is None:
+            msg = 'a host tracker is needed to follow'
+            raise ValueError(msg)
+        if not 0 <= smoothing < 1:
+            msg = 'smoothing must be in [0, 1), got %s'
+            raise ValueError(msg%smoothing)
+        self.camera = {'mode' : mode, 'host' : host, 'padding' : padding,
+                       'smoothing' : smoothing}
+        return
+    
+    def setTrail(self, window : int = None):
+        """
+        Limit how far back the trails of the trackers reach in each
+        frame, which keeps the frames of long movies small. Not used
+        in raster mode.
+
+        Args:
+            window (int, optional): number of snapshots shown up to
+                the last of each frame. Defaults to None, showing the
+                trails from the first snapshot of the movie.
+        """
+        if window is not None and window < 1:
+            msg = 'the trail window must be at least 1 snapshot, got %s'
+            raise ValueError(msg%window)
+        self.trail = window
+        return
+    
+    def _frameStarts(self, snapshots, trail):
+        # first snapshot shown in each frame
+        ends = np.asarray(snapshots)
+        starts = np.full(len(ends), ends[0] if len(ends) else 0)
+        if trail is not None:
+            starts = np.maximum(starts, ends - trail)
+        return starts
+    
+    def _numExtraTraces(self) -> int:
+        return len(self.markers)
+    
+    def _planFrames(self, snapshots, trail):
+        if snapshots is None:
+            msg = 'the snapshots of the frames are needed to plan a movie'
+            raise ValueError(msg)
+        ends = np.asarray(snapshots)
+        return self._frameStarts(ends, trail), ends, True
+    
+    def applyPlan(self, plan):
+        super().applyPlan(plan)
+        self.setTrail(plan.trail)
+        return
+    
+    def _extendExtents(self, first, rebuild = False):
+        # lower and upper corners of the trail trackers and of the
+        # other trackers at each snapshot, reduced over the trackers,
+        # and the running range of the trails from the first snapshot
+        # of the movie. They are kept between calls, so that only the
+        # snapshots the trackers gained since are stacked
+        state = self._extents
+        if rebuild or state is None or state['first'] != first or \
+                len(state['trackers']) != len(self.trackers) or \
+                any(a is not b for a, b in zip(state['trackers'],
+                                               self.trackers)):
+            state = {'first' : first, 'nsnaps' : 0, 'groups' : {},
+                     'trackers' : list(self.trackers)}
+            self._extents = state
+        start = state['nsnaps']
+        nsnaps = len(self.trackers[0].pos)
+        if start >= nsnaps:
+            return state
+        
+        dim = self.trackers[0].dim
+        for is_trail in [True, False]:
+            trks = [trk for trk in self.trackers if trk.isTrail() == is_trail]
+            if not trks:
+                continue
+            extents = [trk.getExtent() for trk in trks]
+            lo = np.fmin.reduce(np.stack([e[0][start:] for e in extents]),
+                                axis = 0)
+            hi = np.fmax.reduce(np.stack([e[1][start:] for e in extents]),
+                                axis = 0)
+            if is_trail not in state['groups']:
+                empty = np.empty((0, dim))
+                state['groups'][is_trail] = {'buffers' : {}, 'lo' : empty,
+                    'hi' : empty, 'cum_lo' : empty, 'cum_hi' : empty}
+            group = state['groups'][is_trail]
+            buffers = group['buffers']
+            group['lo'] = appendTo(buffers, 'lo', group['lo'], lo)
+            group['hi'] = appendTo(buffers, 'hi', group['hi'], hi)
+            if not is_trail:
+                continue
+            # trails grow, so their ranges are cumulative
+            skip = max(first - start, 0)
+            for key, func, arr in [('cum_lo', np.fmin, lo),
+                                   ('cum_hi', np.fmax, hi)]:
+                prev = group[key][-1:]
+                cum = func.accumulate(np.concatenate([prev, arr[skip:]]),
+                                      axis = 0)[len(prev):]
+                group[key] = appendTo(buffers, key, group[key], cum)
+        state['nsnaps'] = nsnaps
+        return state
+    
+    def _frameExtents(self, snapshots, start_frame = 0):
+        # bounding box of every frame from start_frame, with shape
+        # (nframes, dim). Frame k shows the trails from snapshots[0],
+        # or the start of the trail window, up to snapshots[k] and
+        # the other trackers at the last snapshot before snapshots[k].
+        # The extents of the earlier frames are reused when frames
+        # are appended
+        state = self._extendExtents(snapshots[0], start_frame == 0)
+        first = state['first']
+        ends = np.asarray(snapshots[start_frame:])
+        dim = self.trackers[0].dim
+        mins = np.full((len(ends), dim), np.nan)
+        maxs = np.full((len(ends), dim), np.nan)
+        
+        for is_trail, group in state['groups'].items():
+            lo, hi = group['lo'], group['hi']
+            if is_trail and self.trail is not None:
+                # each frame only shows the trails in its window
+                starts = self._frameStarts(snapshots, self.trail)
+                starts = starts[start_frame:]
+                for k in range(len(ends)):
+                    window = slice(starts[k], min(ends[k], len(lo)))
+                    if window.start >= window.stop:
+                        continue
+                    mins[k] = np.fmin(mins[k], np.fmin.reduce(lo[window]))
+                    maxs[k] = np.fmax(maxs[k], np.fmax.reduce(hi[window]))
+                continue
+            elif is_trail:
+                lo, hi = group['cum_lo'], group['cum_hi']
+                idx = ends - 1 - first
+            else:
+                idx = ends - 1
+            has = ((idx >= 0) & (idx < len(lo)))[:, np.newaxis]
+            idx = np.clip(idx, 0, max(len(lo) - 1, 0))
+            mins = np.fmin(mins, np.where(has, lo[idx], np.nan))
+            maxs = np.fmax(maxs, np.where(has, hi[idx], np.nan))
+        return mins, maxs
+    
+    def _cameraRanges(self, snapshots, start_frame = 0):
+        # axis ranges of every frame from start_frame for the camera
+        # mode, with shape (nframes, dim), np.nan for frames with
+        # nothing to show. What the later frames need from the earlier
+        # ones is kept, so that appended frames continue the camera
+        mins, maxs = self._frameExtents(snapshots, start_frame)
+        if start_frame == 0 or self._camera_state is None:
+            self._camera_state = {'lo' : None, 'hi' : None,
+                                  'center' : None, 'last' : None}
+        state = self._camera_state
+        mode = self.camera['mode']
+        if mode == 'static':
+            lo = np.fmin.reduce(mins, axis = 0)
+            hi = np.fmax.reduce(maxs, axis = 0)
+            if state['lo'] is not None:
+                lo = np.fmin(lo, state['lo'])
+                hi = np.fmax(hi, state['hi'])
+            state['lo'], state['hi'] = lo, hi
+            mins = np.broadcast_to(lo, mins.shape).copy()
+            maxs = np.broadcast_to(hi, maxs.shape).copy()
+        
+        elif mode == 'follow':
+            # cubes centered on the host, big enough for the frame.
+            # While the host is not alive its last position is kept
+            host_pos = self.camera['host'].pos
+            ends = np.clip(np.asarray(snapshots[start_frame:]) - 1, 0,
+                           len(host_pos) - 1)
+            center = host_pos[ends]
+            prev = state['center']
+            for k in range(len(center)):
+                if prev is not None and np.any(np.isnan(center[k])):
+                    center[k] = prev
+                prev = center[k].copy()
+            state['center'] = prev
+            half = np.fmax.reduce(np.fmax(maxs - center, center - mins),
+                                  axis = 1)
+            mins = center - half[:, np.newaxis]
+            maxs = center + half[:, np.newaxis]
+        
+        pad = self.camera['padding'] * (maxs - mins)
+        mins = mins - pad
+        maxs = maxs + pad
+        
+        # exponential smoothing of the ranges between frames. The
+        # frames of a static camera all have the same range
+        alpha = self.camera['smoothing']
+        for k in range(len(mins)):
+            prev = (mins[k - 1], maxs[k - 1]) if k else state['last']
+            if alpha == 0 or mode == 'static' or prev is None or \
+                    not np.all(np.isfinite(prev[0])):
+                continue
+            for arr, last in zip([mins, maxs], prev):
+                arr[k] = np.where(np.isfinite(arr[k]),
+                    alpha * last + (1 - alpha) * arr[k], last)
+        if len(mins):
+            state['last'] = (mins[-1].copy(), maxs[-1].copy())
+        return mins, maxs
+    
+    def _sceneDict(self, mins, maxs):
+        # scene axis ranges, leaving out axes with nothing to show
+        scene_dict = {}
+        for i, ax in enumerate(['xaxis', 'yaxis', 'zaxis'][:len(mins)]):
+            if np.isfinite(mins[i]) and np.isfinite(maxs[i]):
+                scene_dict[ax] = dict(range = (mins[i], maxs[i]),
+                                      autorange = False)
+        return scene_dict
+    
     def setMenu(self, buttons : List[Dict] = [], 
                 sliders : List[Dict] = []):
         
@@ -78,23 +337,82 @@ class Movie(Visual):
         )
         return
     
+    @profile('movie.createFrames')
     def createFrames(self, snapshots):
-        
-        # initialize list of frames
-        frames = []
+        return list(self.iterFrames(snapshots))
+    
+    def iterFrames(self, snapshots, start_frame = 0):
+        """
+        Make the frames of the movie one at a time, as a generator.
+        The scene of the movie is set before the first frame is
+        made, so a figure can be shown while the frames are being
+        built, see buildAsync.
+
+        Args:
+            snapshots (Sequence[int]): the last snapshot of each
+                frame. Frames show the snapshots from snapshots[0].
+            start_frame (int, optional): frames before this one are
+                not made, and what was computed for them by the last
+                call is reused, used by appendFrames. Defaults to 0.
 
-        mins = np.array([np.inf] * 3)
-        maxs = np.array([-np.inf] * 3)
+        Yields:
+            go.Frame: the frames, leaving out frames with no data.
+        """
+        self._frame_snaps = list(snapshots)
+        if self.render_mode == 'raster':
+            yield from self._iterRasterFrames(snapshots)
+            return
+
+        # frames appended to a movie reuse what was computed for the
+        # earlier frames, and the new snapshots are not decimated
+        appending = start_frame > 0
+        if not appending:
+            self._applyDecimation()
+
+        # markers that can give all of their events at once are
+        # evaluated a single time, each frame is then a slice of the
+        # event table. New snapshots can move earlier events, so the
+        # events are found again when frames are appended
+        for mrk in self.markers:
+            if mrk.hasEvents():
+                mrk.buildEvents(self.trackers)
+
+        # axis ranges of all frames, from the stacked tracker extents.
+        # The figure starts with the range of the first frame that
+        # shows something, a static range grows with appended frames
+        moving = self.camera['mode'] != 'static'
+        if self.trackers:
+            mins, maxs = self._cameraRanges(snapshots, start_frame)
+            shown = np.where(np.all(np.isfinite(mins), axis = 1))[0]
+            if len(shown) and not (appending and moving):
+                self.setScene(self._sceneDict(mins[shown[0]], maxs[shown[0]]))
+        starts = self._frameStarts(snapshots, self.trail)
+
+        # in merged mode the trails are drawn as one trace, and only
+        # the other trackers one by one
+        merged = None
+        trackers = self.trackers
+        if self.render_mode == 'merged':
+            if appending and self._merged is not None and \
+                    self._merged.matches(self.trackers):
+                self._merged.extend()
+            else:
+                self._merged = MergedTrails(self.trackers)
+            merged = self._merged
+            trackers = merged.others
             
         # for each snapshot
-        for ss in range(len(snapshots)):
-            snap_slc = slice(snapshots[0], snapshots[ss])
+        for ss in range(start_frame, len(snapshots)):
+            snap_slc = slice(starts[ss], snapshots[ss])
             frame_data = []
             
             # make plots of the trackers for this snapshot
 
             extant_tracks = [] # for markers later
-            for trk in self.trackers: # iterate through trackers
+            if merged is not None:
+                frame_data.append(merged.plot(snap_slc))
+                extant_tracks += merged.extant(snap_slc)
+            for trk in trackers: # iterate through trackers
                 is_alive = trk.getAlive()
                 snaps_existed = np.sum(is_alive[snap_slc])
                 # if trk has existed for at least 1 snaps, make plot
@@ -102,9 +420,6 @@ class Movie(Visual):
                     extant_tracks.append(trk)
                     scat = trk.plot(snap_slc)
                     frame_data.append(scat)
-                    trk_mins, trk_maxs = trk.getAxes(snap_slc)
-                    mins = np.minimum(mins, trk_mins)
-                    maxs = np.maximum(maxs, trk_maxs)
                 else:
                     # create empty scatter plot, so plotly knows
                     # how many traces there are in the animation
@@ -120,43 +435,167 @@ class Movie(Visual):
             # iterate through markers
             for mrk in self.markers:
                 # give the existing tracker plots and current snap
-                if extant_tracks:
+                if extant_tracks and mrk.hasEvents():
+                    scat = mrk.plotEvents(snapshots[ss])
+                    frame_data.append(scat)
+                elif extant_tracks:
                     scat = mrk.plot(extant_tracks, snapshots[ss])
                     frame_data.append(scat)
                 
             
             # create traces list, from each tracker, marker
             
-            # check that each frame has at least one trace
-            for f in range(len(frames)):
-                has_data = False
-                for t in range(len(frames[f].data)):
-                    if frames[f].data[t].x is not None:
-                        has_data = True
-                if not has_data:
-                    del frames[f]
-            
-            if frame_data:
-                frames.append(go.Frame(data = frame_data))
+            # check that the frame has at least one trace
+            has_data = False
+            for scat in frame_data:
+                if scat.x is not None:
+                    has_data = True
+            if not has_data:
+                continue
             
-            # set default scene/annotations
+            if moving:
+                k = ss - start_frame
+                scene = self._sceneDict(mins[k], maxs[k])
+                yield go.Frame(data = frame_data, layout = {'scene' : scene})
+            else:
+                yield go.Frame(data = frame_data)
+        return
+    
+
+    def _iterRasterFrames(self, snapshots):
+        # one density heatmap per frame, all frames are accumulated in
+        # a single pass and share the extent and color range
+        pos = self._rasterPos()
+        extent = self.raster.getExtent(pos)
+        grids = self.raster.frameDensity(pos, snapshots[1:], snapshots[0],
+                                         extent)
+        grids = np.concatenate([np.zeros((1,) + grids.shape[1:]), grids])
+        zrange = self.raster.zRange(grids)
+
+        for mrk in self.markers:
+            if mrk.hasEvents():
+                mrk.buildEvents(self.trackers)
+        
+        alive = np.isfinite(pos[:, :, 0])
+        self.setLayout(self.raster.layout(extent))
         
-        scene_dict = {
-            'xaxis' : dict(range = (mins[0], maxs[0])),
-            'yaxis' : dict(range = (mins[1], maxs[1])),
-            'zaxis' : dict(range = (mins[2], maxs[2]))
-        }
-        for k, axis_dict in scene_dict.items():
-            axis_dict['autorange'] = False
-        self.setScene(scene_dict)
-
-        # pass frames/figs to each event, which will adjust
-        # scenes, annotations, or trace data as desired
+        for ss in range(len(snapshots)):
+            frame_data = [self.raster.heatmap(grids[ss], extent, zrange)]
+            
+            extant = np.any(alive[:, snapshots[0]:snapshots[ss]], axis = 1)
+            extant_tracks = [self.trackers[i] for i in np.where(extant)[0]]
+            for mrk in self.markers:
+                if extant_tracks and mrk.hasEvents():
+                    scat = mrk.plotEvents(snapshots[ss])
+                elif extant_tracks:
+                    scat = mrk.plot(extant_tracks, snapshots[ss])
+                else:
+                    # keep the number of traces the same in every frame
+                    scat = go.Scatter()
+                frame_data.append(self.raster.project(scat))
+            yield go.Frame(data = frame_data)
+        return
+
+    def buildAsync(self, snapshots, on_progress = None, widget = True,
+                   update_interval = 0.5):
+        """
+        Build the frames in a background thread, see MovieBuild. In a
+        notebook, showing the result displays a FigureWidget that is
+        updated as frames finish.
+
+        Args:
+            snapshots (Sequence[int]): see createFrames.
+            on_progress (Callable[[int, int], None], optional): called
+                with the frames done and the total after each frame.
+                Defaults to None.
+            widget (bool, optional): show the newest frame in a
+                FigureWidget, if anywidget is installed. Defaults to
+                True.
+            update_interval (float, optional): minimum time in seconds
+                between widget updates. Defaults to 0.5.
+
+        Returns:
+            MovieBuild: handle with the progress, cancel and the
+                finished frames.
+        """
+        from tree_tracks.visual.movie.progressive import MovieBuild
+        build = MovieBuild(self, snapshots, on_progress, widget, 
+                           update_interval)
+        return build.start()
+
+    @profile('movie.appendFrames')
+    def appendFrames(self, fig, snapshots):
+        """
+        Add frames for new snapshots to a movie made by createMovie,
+        after the trackers were extended, for example with
+        Storage.extendTracks. Only the new frames are made, and the
+        axis ranges are extended to show them. The stacked trails and
+        extents of the earlier frames are kept and extended with the
+        new snapshots, which are drawn in full until the frames are
+        made again with decimation.
+
+        Args:
+            fig (go.Figure): the movie.
+            snapshots (Sequence[int]): the last snapshot of each new
+                frame, after those the movie was made with.
+
+        Returns:
+            List[go.Frame]: the new frames.
+        """
+        if self.render_mode == 'raster':
+            msg = 'raster movies cannot be appended to, since the ' + \
+                'color range depends on every frame'
+            raise ValueError(msg)
+        if not self._frame_snaps:
+            msg = 'the movie has no frames yet, make them with createFrames'
+            raise ValueError(msg)
+        old = self._frame_snaps
+        snapshots = list(snapshots)
+        if snapshots and snapshots[0] <= old[-1]:
+            msg = 'new frames must come after snapshot %d, got %d'
+            raise ValueError(msg%(old[-1], snapshots[0]))
+        if not snapshots:
+            return []
         
-        # set list, return copy    
+        frames = list(self.iterFrames(old + snapshots, len(old)))
+        _appendFigFrames(fig, frames)
+        fig.update_layout(scene = self.layout.scene)
         return frames
     
+    @profile('movie.writeMovie')
+    def writeMovie(self, snapshots, path, fmt = 'html', **writer_kwargs):
+        """
+        Make the frames and write them to disk one at a time, instead
+        of keeping the whole movie in memory, see MovieWriter.
+
+        Args:
+            snapshots (Sequence[int]): see createFrames.
+            path (str): the output file, or directory for fmt 'dir'.
+            fmt (str, optional): 'html', 'json' or 'dir'. Defaults to
+                'html'.
+            **writer_kwargs: dtype, sig_digits, include_plotlyjs and
+                config, see MovieWriter.
+
+        Returns:
+            int: the number of frames written.
+        """
+        from tree_tracks.visual.export import MovieWriter
+        writer = MovieWriter(path, fmt, **writer_kwargs)
+        frames = self.iterFrames(snapshots)
+        # the scene is set when the first frame is made
+        first = next(frames, None)
+        if first is None:
+            msg = 'the movie has no frames with data'
+            raise ValueError(msg)
+        # the layout as a figure would have it, with the default template
+        layout = go.Figure(layout = self.layout).to_dict()['layout']
+        with writer.open(layout):
+            writer.write(first)
+            for frame in frames:
+                writer.write(frame)
+        return writer.nframes
 
+    @profile('movie.createMovie')
     def createMovie(self, frames : List[go.Frame]):
         
         fig = go.Figure(
@@ -0,0 +1,177 @@
+#!usr/bin/python3
+
+"""
+This file contains the definitions for a "MovieBuild" object.
+
+A MovieBuild makes the frames of a Movie in a background thread, so
+that a notebook stays responsive while a long movie is built. If
+plotly's FigureWidget can be used (it needs anywidget), the widget
+is shown right away and updated with the newest frame as frames
+finish. Progress can be polled or reported through a callback, and
+the build can be cancelled between frames.
+"""
+
+from __future__ import annotations
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, List, Sequence, Tuple
+from tree_tracks.lazy import go
+
+if TYPE_CHECKING:
+    from tree_tracks.visual.movie.movie import Movie
+
+
+class MovieBuild(object):
+    """
+    Handle of a movie that is being built in the background.
+    """
+
+    def __init__(
+        self,
+        movie : Movie,
+        snapshots : Sequence[int],
+        on_progress : Callable[[int, int], None] = None,
+        widget : bool = True,
+        update_interval : float = 0.5
+    ) -> None:
+        """
+        Args:
+            movie (Movie): the movie to build.
+            snapshots (Sequence[int]): see Movie.createFrames.
+            on_progress (Callable[[int, int], None], optional): called
+                from the background thread with the number of frames
+                done and the total number of frames after each frame.
+                Defaults to None.
+            widget (bool, optional): make a FigureWidget that shows
+                the newest frame. Defaults to True.
+            update_interval (float, optional): minimum time in seconds
+                between widget updates. Defaults to 0.5.
+        """
+        self.movie = movie
+        self.snapshots = list(snapshots)
+        self.frames = []
+        self.on_progress = on_progress
+        self.update_interval = update_interval
+        self.error = None
+
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+        self._last_update = 0.0
+        self.widget = self._makeWidget() if widget else None
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        return
+
+    def _makeWidget(self):
+        # the widget shows frames one at a time, plotly widgets do not
+        # support animation frames
+        try:
+            widget = go.FigureWidget()
+        except ImportError:
+            return None
+        layout = self.movie.layout.to_plotly_json()
+        layout.pop('updatemenus', None)
+        layout.pop('sliders', None)
+        widget.update_layout(layout)
+        return widget
+
+    def start(self) -> 'MovieBuild':
+        self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            for frame in self.movie.iterFrames(self.snapshots):
+                if self._cancel.is_set():
+                    break
+                with self._lock:
+                    self.frames.append(frame)
+                self._show(frame)
+                if self.on_progress is not None:
+                    self.on_progress(len(self.frames), self.numFrames())
+        except Exception as exc:
+            self.error = exc
+        # the last frame is always shown
+        if self.frames:
+            self._show(self.frames[-1], force = True)
+        return
+
+    def _show(self, frame, force = False):
+        # update the widget with a frame, at most once per interval
+        if self.widget is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_update < self.update_interval:
+            return
+        self._last_update = now
+        with self.widget.batch_update():
+            if len(self.widget.data) == len(frame.data):
+                for trace, new in zip(self.widget.data, frame.data):
+                    trace.update(new.to_plotly_json(), overwrite = True)
+            else:
+                self.widget.data = []
+                self.widget.add_traces(list(frame.data))
+            if frame.layout is not None:
+                self.widget.update_layout(frame.layout.to_plotly_json())
+        return
+
+    def numFrames(self) -> int:
+        return len(self.snapshots)
+
+    def progress(self) -> Tuple[int, int]:
+        """
+        The number of frames done and the total number of frames.
+        Frames without data are left out of the movie, so the build
+        can finish with fewer frames than the total.
+        """
+        return len(self.frames), self.numFrames()
+
+    def cancel(self) -> None:
+        """
+        Stop building after the current frame. The frames that are
+        done are kept.
+        """
+        self._cancel.set()
+        return
+
+    def isCancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def done(self) -> bool:
+        return self._thread.ident is not None and not self._thread.is_alive()
+
+    def wait(self, timeout : float = None) -> bool:
+        """
+        Wait for the build to finish, returns whether it has.
+        """
+        self._thread.join(timeout)
+        return self.done()
+
+    def getFrames(self) -> List[go.Frame]:
+        """
+        The frames that are done, raising the error of the build if
+        it failed.
+        """
+        if self.error is not None:
+            raise self.error
+        with self._lock:
+            return list(self.frames)
+
+    def getFigure(self) -> go.Figure:
+        """
+        The animated figure of the frames that are done so far.
+        """
+        frames = self.getFrames()
+        if not frames:
+            msg = 'no frames have been built yet'
+            raise ValueError(msg)
+        return self.movie.createMovie(frames)
+
+    def _ipython_display_(self):
+        # shows the widget when the build is the last line of a cell
+        from IPython.display import display
+        if self.widget is not None:
+            display(self.widget)
+        else:
+            done, total = self.progress()
+            print('built %d of %d frames'%(done, total))
+        return
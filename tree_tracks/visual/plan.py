@@ -0,0 +1,197 @@
+#!usr/bin/python3
+
+"""
+This file contains the estimates used to plan how trackers are drawn
+before any plotly object is made.
+
+The number of points a tracker adds to a frame only depends on the
+snapshots where it is alive, and on its level of detail mask when it
+is decimated. Both are stacked for all trackers, and the counts of
+every tracker in every frame come from the difference of cumulative
+sums at the first and last snapshot of the frames. The size of the
+figure and the time it takes to build are then linear in the numbers
+of traces and values, with the costs of a CostModel.
+"""
+
+import numpy as np
+from typing import Sequence, Tuple
+
+
+class CostModel(object):
+    """
+    Cost of the parts of a figure, in bytes of the figure JSON and in
+    seconds of building the plotly objects. The defaults were measured
+    on line traces with a few custom data properties, with plotly
+    writing arrays of doubles in base64. They can be adjusted for
+    other setups, for example value_bytes = 16 / 3 for figures
+    exported with compactFigure as float32.
+    """
+
+    def __init__(
+        self,
+        value_bytes : float = 11,
+        trace_bytes : float = 250,
+        pixel_bytes : float = 13,
+        trace_seconds : float = 6e-4,
+        value_seconds : float = 1e-8,
+        segment_seconds : float = 2e-6,
+        pixel_seconds : float = 1e-8,
+        sphere_points : int = 800
+    ) -> None:
+        """
+        Args:
+            value_bytes (float, optional): bytes per number, position
+                component or custom data value. Defaults to 11.
+            trace_bytes (float, optional): bytes per trace, for its
+                type and properties. Defaults to 250.
+            pixel_bytes (float, optional): bytes per heatmap pixel in
+                raster mode. Defaults to 13.
+            trace_seconds (float, optional): time to make and
+                validate a trace. Defaults to 6e-4.
+            value_seconds (float, optional): time per number of a
+                trace. Defaults to 1e-8.
+            segment_seconds (float, optional): time to rasterize one
+                segment of a trajectory. Defaults to 2e-6.
+            pixel_seconds (float, optional): time per heatmap pixel
+                of a raster frame. Defaults to 1e-8.
+            sphere_points (int, optional): points of the surface of a
+                Sphere tracker. Defaults to 800.
+        """
+        self.value_bytes = value_bytes
+        self.trace_bytes = trace_bytes
+        self.pixel_bytes = pixel_bytes
+        self.trace_seconds = trace_seconds
+        self.value_seconds = value_seconds
+        self.segment_seconds = segment_seconds
+        self.pixel_seconds = pixel_seconds
+        self.sphere_points = sphere_points
+        return
+
+
+class RenderPlan(object):
+    """
+    The strategy used to draw trackers, with its estimated size and
+    build time, see Visual.plan and Visual.autoPlan.
+    """
+
+    def __init__(
+        self,
+        mode : str,
+        tol : float,
+        budget : int,
+        trail : int,
+        ntraces : int,
+        points : np.ndarray,
+        nbytes : float,
+        seconds : float
+    ) -> None:
+        """
+        Args:
+            mode (str): the render mode, see Visual.setRenderMode.
+            tol (float): decimation tolerance in position units, None
+                if the trajectories are not simplified by distance.
+            budget (int): decimation point budget, None for no budget.
+            trail (int): snapshots shown behind the current one in
+                movie frames, None for the whole trail.
+            ntraces (int): traces over the figure and its frames.
+            points (np.ndarray): points drawn in each frame that is
+                made, or pixels in raster mode.
+            nbytes (float): estimated size of the figure JSON.
+            seconds (float): estimated time to make the figure.
+        """
+        self.mode = mode
+        self.tol = tol
+        self.budget = budget
+        self.trail = trail
+        self.ntraces = int(ntraces)
+        self.points = np.asarray(points)
+        self.nbytes = float(nbytes)
+        self.seconds = float(seconds)
+        return
+
+    def numFrames(self) -> int:
+        return len(self.points)
+
+    def fits(self, max_bytes : float = None,
+             max_seconds : float = None) -> bool:
+        """
+        Whether the estimates are within the given limits.
+        """
+        if max_bytes is not None and self.nbytes > max_bytes:
+            return False
+        if max_seconds is not None and self.seconds > max_seconds:
+            return False
+        return True
+
+    def summary(self) -> str:
+        strategy = [self.mode]
+        if self.tol is not None:
+            strategy.append('tol %.3g' % self.tol)
+        if self.budget is not None:
+            strategy.append('budget %d' % self.budget)
+        if self.trail is not None:
+            strategy.append('trail %d' % self.trail)
+        peak = self.points.max() if len(self.points) else 0
+        return '%s: %d frames, %d traces, %d points in the largest ' \
+            'frame, %.1f MB, %.1f s' % (', '.join(strategy),
+            self.numFrames(), self.ntraces, peak, self.nbytes / 1e6,
+            self.seconds)
+
+    def __repr__(self) -> str:
+        return 'RenderPlan(%s)' % self.summary()
+
+
+def rangeCounts(
+    mask : np.ndarray,
+    starts : Sequence[int],
+    ends : Sequence[int]
+) -> np.ndarray:
+    """
+    Count the True entries of each row of mask between starts[k] and
+    ends[k], excluding the end, for every k.
+
+    Args:
+        mask (np.ndarray): boolean array with shape (nrows, nsnaps).
+        starts (Sequence[int]): first snapshot of each range.
+        ends (Sequence[int]): snapshot after the last of each range.
+
+    Returns:
+        np.ndarray: counts with shape (nrows, nranges).
+    """
+    nrows, nsnaps = mask.shape
+    cum = np.zeros((nrows, nsnaps + 1), dtype = np.int64)
+    np.cumsum(mask, axis = 1, out = cum[:, 1:])
+    starts = np.clip(np.asarray(starts, dtype = np.int64), 0, nsnaps)
+    ends = np.clip(np.asarray(ends, dtype = np.int64), 0, nsnaps)
+    return cum[:, ends] - cum[:, np.minimum(starts, ends)]
+
+
+def trailPoints(
+    alive : np.ndarray,
+    starts : Sequence[int],
+    ends : Sequence[int],
+    keep : np.ndarray = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Points of trajectories drawn over snapshot ranges, see
+    Tracker._default_snap.
+
+    Args:
+        alive (np.ndarray): alive masks with shape (ntrackers, nsnaps).
+        starts (Sequence[int]): first snapshot of each range.
+        ends (Sequence[int]): snapshot after the last of each range.
+        keep (np.ndarray, optional): level of detail masks with the
+            shape of alive. The ends of each range are always drawn,
+            so the count with a mask is an upper bound. Defaults to
+            None, drawing every alive point.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: the points of each tracker in
+            each range, with shape (ntrackers, nranges), and the alive
+            points they are drawn from.
+    """
+    shown = rangeCounts(alive, starts, ends)
+    if keep is None:
+        return shown, shown
+    kept = rangeCounts(alive & keep, starts, ends)
+    return np.minimum(kept + 2, shown), shown
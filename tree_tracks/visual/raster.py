@@ -0,0 +1,316 @@
+#!usr/bin/python3
+
+"""
+This file contains the definitions for a "Raster" object.
+
+When there are too many trajectories to draw as line traces, they are
+instead accumulated into a 2D density grid on a projection of the
+positions. Every line segment between two consecutive alive snapshots
+is sampled finely enough to touch each pixel it crosses, and the
+samples are added to the grid with a single np.bincount, so the cost
+is linear in the number of segments and independent of how many
+traces plotly would have had to draw.
+"""
+
+from __future__ import annotations
+import numpy as np
+from typing import TYPE_CHECKING, Sequence, Tuple, Union
+from tree_tracks.lazy import go
+from tree_tracks.instrument import profile
+
+if TYPE_CHECKING:
+    from plotly.basedatatypes import BaseTraceType
+
+
+class Raster(object):
+    """
+    Density of trajectories on a 2D grid. Each segment adds the time
+    it spans, one snapshot interval, spread evenly over the pixels it
+    crosses, or its length if by_length is set.
+    """
+
+    def __init__(
+        self,
+        axes : Tuple[int, int] = (0, 1),
+        bins : Union[int, Tuple[int, int]] = 512,
+        extent : Sequence[float] = None,
+        log : bool = True,
+        by_length : bool = False,
+        max_len : float = None,
+        chunk_size : int = 4096,
+        heatmap_props : dict = {}
+    ) -> None:
+        """
+        Args:
+            axes (Tuple[int, int], optional): position components used
+                for the horizontal and vertical axes. Defaults to (0, 1).
+            bins (Union[int, Tuple[int, int]], optional): number of
+                pixels along each axis. Defaults to 512.
+            extent (Sequence[float], optional): (xmin, xmax, ymin, ymax)
+                of the grid. Defaults to the range of the positions.
+            log (bool, optional): plot the log10 of the density.
+                Defaults to True.
+            by_length (bool, optional): weight segments by their length
+                instead of the time they span. Defaults to False.
+            max_len (float, optional): segments longer than this are
+                skipped, for example to avoid drawing across the box
+                when a trajectory wraps around a periodic boundary.
+                Defaults to None.
+            chunk_size (int, optional): number of trajectories that
+                are sampled at once, which bounds the memory used.
+                Defaults to 4096.
+            heatmap_props (dict, optional): extra properties of the
+                go.Heatmap trace. Defaults to {}.
+        """
+        self.axes = tuple(axes)
+        if isinstance(bins, int):
+            bins = (bins, bins)
+        self.bins = tuple(bins)
+        self.extent = None if extent is None else tuple(extent)
+        self.log = log
+        self.by_length = by_length
+        self.max_len = max_len
+        self.chunk_size = chunk_size
+        self.heatmap_props = dict(heatmap_props)
+        return
+
+    def setExtent(self, extent : Sequence[float]) -> None:
+        self.extent = None if extent is None else tuple(extent)
+        return
+
+    def getExtent(self, pos : np.ndarray) -> Tuple[float, ...]:
+        """
+        The extent of the grid, from the range of the projected
+        positions if it was not set.
+        """
+        if self.extent is not None:
+            return self.extent
+        ext = []
+        for ax in self.axes:
+            lo, hi = np.inf, -np.inf
+            for start in range(0, pos.shape[0], self.chunk_size):
+                comp = pos[start:start + self.chunk_size, :, ax]
+                comp = comp[np.isfinite(comp) & (comp != -1)]
+                if comp.size:
+                    lo = min(lo, comp.min()); hi = max(hi, comp.max())
+            if not np.isfinite(lo):
+                lo, hi = 0.0, 1.0
+            if hi <= lo:
+                hi = lo + 1.0
+            ext += [float(lo), float(hi)]
+        return tuple(ext)
+
+    def _samples(self, pos, first, ext):
+        # pixel index, segment start snapshot and weight of the
+        # samples of every segment in a chunk of trajectories
+        nx, ny = self.bins
+        scale = np.array([nx / (ext[1] - ext[0]), ny / (ext[3] - ext[2])],
+                         dtype = np.float32)
+        lo = np.array([ext[0], ext[2]], dtype = np.float32)
+
+        # single precision pixel coordinates are enough here
+        proj = pos[:, :, list(self.axes)].astype(np.float32)
+        proj[np.all(pos == -1, axis = -1)] = np.nan
+        proj -= lo
+        proj *= scale
+
+        finite = np.all(np.isfinite(proj), axis = -1)
+        valid = finite[:, :-1] & finite[:, 1:]
+        start = np.nonzero(valid)[1] + first
+        u0 = proj[:, :-1][valid]
+        du = proj[:, 1:][valid] - u0
+
+        seg_weight = np.ones(len(u0))
+        if self.by_length or self.max_len is not None:
+            length = np.sqrt(np.sum((du / scale)**2, axis = -1))
+            if self.max_len is not None:
+                keep = length <= self.max_len
+                u0 = u0[keep]; du = du[keep]
+                start = start[keep]; length = length[keep]
+                seg_weight = seg_weight[keep]
+            if self.by_length:
+                seg_weight = length
+
+        # the number of samples of a segment is the number of pixels
+        # it crosses along its longer direction
+        nsamp = np.ceil(np.max(np.abs(du), axis = -1)).astype(np.int64) + 1
+        nsamp = np.minimum(nsamp, max(nx, ny))
+        if not len(nsamp):
+            empty = np.zeros(0, dtype = np.int64)
+            return empty, empty, np.zeros(0)
+
+        # index of each sample within its segment, from a cumulative
+        # sum that restarts at every segment
+        seg = np.repeat(np.arange(len(nsamp)), nsamp)
+        step = np.ones(len(seg), dtype = np.float32)
+        step[0] = 0
+        step[np.cumsum(nsamp)[:-1]] = 1 - nsamp[:-1]
+        frac = np.cumsum(step, dtype = np.float32)
+        frac += 0.5
+        frac *= (1 / nsamp).astype(np.float32)[seg]
+
+        ux = u0[:, 0][seg] + du[:, 0][seg] * frac
+        uy = u0[:, 1][seg] + du[:, 1][seg] * frac
+        inside = (ux >= 0) & (ux < nx) & (uy >= 0) & (uy < ny)
+        pix = uy[inside].astype(np.int64) * nx + ux[inside].astype(np.int64)
+        weight = (seg_weight / nsamp)[seg[inside]]
+        return pix, start[seg[inside]], weight
+
+    @profile('raster.density')
+    def density(
+        self,
+        pos : np.ndarray,
+        snap_slc : slice = slice(None),
+        extent : Sequence[float] = None
+    ) -> np.ndarray:
+        """
+        Accumulate the trajectories over a range of snapshots.
+
+        Args:
+            pos (np.ndarray): positions with shape (ntrajectories,
+                nsnaps, dim), np.nan or -1 where not alive. Can be
+                memory-mapped, it is read chunk by chunk.
+            snap_slc (slice, optional): snapshots to use, only
+                segments with both ends in the range are added.
+                Defaults to slice(None).
+            extent (Sequence[float], optional): extent of the grid.
+                Defaults to getExtent(pos).
+
+        Returns:
+            np.ndarray: the density with shape (ny, nx).
+        """
+        return self.frameDensity(pos, [snap_slc.stop], snap_slc.start,
+                                 extent)[0]
+
+    @profile('raster.frames')
+    def frameDensity(
+        self,
+        pos : np.ndarray,
+        snapshots : Sequence[int],
+        first : int = None,
+        extent : Sequence[float] = None
+    ) -> np.ndarray:
+        """
+        Accumulate the trajectories for each frame of a movie, where
+        frame k has the segments between first and snapshots[k], not
+        included, as for the trace-based movie frames. All frames are
+        computed in one pass through the positions.
+
+        Args:
+            pos (np.ndarray): positions with shape (ntrajectories,
+                nsnaps, dim), np.nan or -1 where not alive.
+            snapshots (Sequence[int]): the end snapshot of each frame,
+                in increasing order. None means the last snapshot.
+            first (int, optional): first snapshot of every frame.
+                Defaults to 0.
+            extent (Sequence[float], optional): extent of the grid.
+                Defaults to getExtent(pos).
+
+        Returns:
+            np.ndarray: the density of each frame with shape
+                (nframes, ny, nx).
+        """
+        nsnaps = pos.shape[1]
+        first = 0 if first is None else first
+        ends = np.array([nsnaps if s is None else s for s in snapshots])
+        ext = self.getExtent(pos) if extent is None else extent
+        nx, ny = self.bins
+        npix = nx * ny
+        nframes = len(ends)
+
+        # a segment starting at snapshot i is in frame k if both of
+        # its ends are before ends[k], frames are then cumulative sums
+        # of the segments that appear in them first
+        grid = np.zeros(nframes * npix)
+        last = max(int(ends.max()), first)
+        for start in range(0, pos.shape[0], self.chunk_size):
+            chunk = pos[start:start + self.chunk_size, first:last]
+            if chunk.shape[1] < 2:
+                continue
+            pix, seg_start, weight = self._samples(chunk, first, ext)
+            frame = np.searchsorted(ends - 2, seg_start, side = 'left')
+            keep = frame < nframes
+            grid += np.bincount(frame[keep] * npix + pix[keep],
+                                weights = weight[keep],
+                                minlength = nframes * npix)
+        grid = grid.reshape(nframes, ny, nx)
+        return np.cumsum(grid, axis = 0)
+
+    def _scaled(self, grid : np.ndarray) -> np.ndarray:
+        if not self.log:
+            return grid
+        out = np.full(grid.shape, np.nan)
+        np.log10(grid, out = out, where = grid > 0)
+        return out
+
+    def heatmap(
+        self,
+        grid : np.ndarray,
+        extent : Sequence[float],
+        zrange : Tuple[float, float] = None
+    ) -> go.Heatmap:
+        """
+        Make the heatmap trace of a density grid.
+
+        Args:
+            grid (np.ndarray): density with shape (ny, nx).
+            extent (Sequence[float]): (xmin, xmax, ymin, ymax) of grid.
+            zrange (Tuple[float, float], optional): fixed color range,
+                so that the frames of a movie share a color scale.
+                Defaults to the range of this grid.
+
+        Returns:
+            go.Heatmap: the trace.
+        """
+        nx, ny = self.bins
+        dx = (extent[1] - extent[0]) / nx
+        dy = (extent[3] - extent[2]) / ny
+        kwargs = dict(
+            z = self._scaled(grid),
+            x0 = extent[0] + dx / 2, dx = dx,
+            y0 = extent[2] + dy / 2, dy = dy,
+            colorscale = 'Viridis',
+            hoverongaps = False
+        )
+        if zrange is not None:
+            kwargs['zmin'], kwargs['zmax'] = zrange
+        kwargs.update(self.heatmap_props)
+        return go.Heatmap(**kwargs)
+
+    def zRange(self, grids : np.ndarray) -> Tuple[float, float]:
+        """
+        Color range that covers all of the given grids.
+        """
+        scaled = self._scaled(grids)
+        if not np.any(np.isfinite(scaled)):
+            return (0.0, 1.0)
+        return (float(np.nanmin(scaled)), float(np.nanmax(scaled)))
+
+    def layout(self, extent : Sequence[float]) -> dict:
+        """
+        Axis settings that show the grid with square pixels.
+        """
+        return {
+            'xaxis' : dict(range = extent[:2], autorange = False),
+            'yaxis' : dict(range = extent[2:], autorange = False,
+                           scaleanchor = 'x', scaleratio = 1),
+        }
+
+    def project(self, trace) -> BaseTraceType:
+        """
+        Project a trace onto the axes of the grid, so that markers
+        can be drawn on top of it. 2D traces are returned as they are.
+        """
+        if not isinstance(trace, go.Scatter3d):
+            return trace
+        comps = [trace.x, trace.y, trace.z]
+        kwargs = dict(
+            x = comps[self.axes[0]], y = comps[self.axes[1]],
+            mode = trace.mode, customdata = trace.customdata,
+            name = trace.name, hovertemplate = trace.hovertemplate
+        )
+        if trace.marker is not None:
+            marker = trace.marker.to_plotly_json()
+            marker.pop('line', None)
+            kwargs['marker'] = marker
+        return go.Scatter(**kwargs)
@@ -0,0 +1,376 @@
+#!usr/bin/python3
+
+"""
+This file contains binned statistics of tracer populations, such as
+radial profiles and radius - radial velocity phase space histograms
+of the tracers of a halo at every snapshot.
+
+Values are binned with arithmetic on uniform (or log-uniform) bins,
+and the snapshot and bin of every sample are combined into one index
+so that a chunk of tracers is accumulated with a single np.bincount.
+Tracers are only counted at snapshots where they and their host are
+alive, which toHostFrame marks with np.nan. The results have shape
+(nsnaps, nbins, ...) and can be drawn as heatmaps or movie frames.
+"""
+
+from __future__ import annotations
+import numpy as np
+from typing import TYPE_CHECKING, List, Sequence, Tuple, Union
+from tree_tracks.lazy import go
+from tree_tracks.instrument import profile
+
+if TYPE_CHECKING:
+    from tree_tracks.storage.vines import Vines
+
+
+class Binning(object):
+    """
+    Bins of one quantity, uniform in the value or in its logarithm.
+    """
+
+    def __init__(
+        self,
+        bins : int = 50,
+        range : Tuple[float, float] = (0, 1),
+        log : bool = False,
+        label : str = ''
+    ) -> None:
+        """
+        Args:
+            bins (int, optional): number of bins. Defaults to 50.
+            range (Tuple[float, float], optional): lower and upper
+                edges, positive if log is set. Defaults to (0, 1).
+            log (bool, optional): make the bins uniform in log10 of
+                the value. Defaults to False.
+            label (str, optional): axis title. Defaults to ''.
+        """
+        lo, hi = range
+        if not hi > lo:
+            msg = 'the upper edge must be larger than the lower, got %s'
+            raise ValueError(msg%(range,))
+        if log and lo <= 0:
+            msg = 'log bins need a positive lower edge, got %s'
+            raise ValueError(msg%lo)
+        self.bins = int(bins)
+        self.range = (float(lo), float(hi))
+        self.log = log
+        self.label = label
+        return
+
+    def _scale(self, values):
+        return np.log10(values) if self.log else values
+
+    def getEdges(self) -> np.ndarray:
+        lo, hi = self._scale(np.array(self.range))
+        edges = np.linspace(lo, hi, self.bins + 1)
+        return 10**edges if self.log else edges
+
+    def getCenters(self) -> np.ndarray:
+        edges = self.getEdges()
+        if self.log:
+            return np.sqrt(edges[1:] * edges[:-1])
+        return (edges[1:] + edges[:-1]) / 2
+
+    def index(self, values : np.ndarray) -> np.ndarray:
+        """
+        The bin of each value, -1 for values outside of the range and
+        np.nan.
+        """
+        out = self._padded(values)
+        out -= 1
+        out[out == self.bins] = -1
+        return out
+
+    def _padded(self, values):
+        # the bin of each value plus one, with 0 for values below the
+        # range and np.nan, and bins + 1 for values above it, computed
+        # without masks
+        lo, hi = self._scale(np.array(self.range))
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            pos = self._scale(np.asarray(values, dtype = float)) - lo
+            pos *= self.bins / (hi - lo)
+        # fmax also replaces np.nan
+        np.fmax(pos, -1, out = pos)
+        np.minimum(pos, self.bins, out = pos)
+        out = np.floor(pos, out = pos).astype(np.int64)
+        out += 1
+        return out
+
+
+def _asBinning(bins : Union[int, Binning], range, log, label) -> Binning:
+    if isinstance(bins, Binning):
+        return bins
+    return Binning(bins, range, log, label)
+
+
+def accumulateHist(
+    out : np.ndarray,
+    values : Sequence[np.ndarray],
+    binnings : Sequence[Binning],
+    weights : np.ndarray = None
+) -> np.ndarray:
+    """
+    Add samples to a histogram of shape (nsnaps, nbins, ...) in
+    place, one binning per value.
+
+    Args:
+        out (np.ndarray): the histogram.
+        values (Sequence[np.ndarray]): one array per binned quantity,
+            each with shape (ntracers, nsnaps). np.nan marks
+            snapshots where a tracer is not alive.
+        binnings (Sequence[Binning]): the bins of each quantity.
+        weights (np.ndarray, optional): weight of each sample, with
+            shape (ntracers, nsnaps) or (ntracers,). Defaults to None,
+            counting each sample once.
+
+    Returns:
+        np.ndarray: out.
+    """
+    nsnaps = out.shape[0]
+    shape = out.shape[1:]
+    # samples are binned into padded bins, with one extra bin on
+    # either side for samples outside of the range, which are dropped
+    # after the counting instead of being masked out of every array
+    padded = tuple(n + 2 for n in shape)
+    flat = np.broadcast_to(np.arange(nsnaps, dtype = np.int64),
+                           np.shape(values[0])).copy()
+    for val, binning, nbins in zip(values, binnings, padded):
+        flat *= nbins
+        flat += binning._padded(val)
+    if weights is not None:
+        weights = np.asarray(weights, dtype = float)
+        if weights.ndim == 1:
+            weights = np.broadcast_to(weights[:, np.newaxis], flat.shape)
+        # samples with np.nan weights are not alive, and would spoil
+        # the padded bins they fall in, but not the kept ones
+        weights = np.where(np.isnan(weights), 0, weights).ravel()
+    counts = np.bincount(flat.ravel(), weights = weights,
+                         minlength = nsnaps * np.prod(padded, dtype = int))
+    counts = counts.reshape((nsnaps,) + padded)
+    out += counts[(slice(None),) + (slice(1, -1),) * len(shape)]
+    return out
+
+
+class TracerStats(object):
+    """
+    Binned statistics of the tracers of Vines halos, computed from
+    chunks of tracers in their host frame, see Vines.iterHostFrame.
+    """
+
+    def __init__(
+        self,
+        vines : Vines,
+        chunk_size : int = 65536,
+        read_ahead : int = 2
+    ) -> None:
+        """
+        Args:
+            vines (Vines): the tracers and halos.
+            chunk_size (int, optional): tracers per chunk. Defaults
+                to 65536.
+            read_ahead (int, optional): chunks prepared in the
+                background. Defaults to 2.
+        """
+        self.vines = vines
+        self.chunk_size = chunk_size
+        self.read_ahead = read_ahead
+        return
+
+    def _chunks(self, halo_idxs, normalize, velocities):
+        return self.vines.iterHostFrame(halo_idxs, self.chunk_size,
+                                        normalize, velocities,
+                                        self.read_ahead)
+
+    @profile('stats.radialProfile')
+    def radialProfile(
+        self,
+        halo_idxs : Union[int, Sequence[int]],
+        r_bins : Union[int, Binning] = 50,
+        normalize : bool = True,
+        density : bool = False,
+        weight : str = None
+    ) -> Tuple[np.ndarray, Binning]:
+        """
+        Histogram of the distance of the tracers to their host at
+        every snapshot, stacked over the given halos.
+
+        Args:
+            halo_idxs (Union[int, Sequence[int]]): the halos.
+            r_bins (Union[int, Binning], optional): the radial bins,
+                or their number, in (0, 2) R200m if normalize is set.
+                Defaults to 50.
+            normalize (bool, optional): radii in units of the host
+                R200m. Defaults to True.
+            density (bool, optional): divide by the volume of each
+                shell. Defaults to False.
+            weight (str, optional): 'vr' to sum the radial velocity
+                instead of counting, which divided by the counts gives
+                the mean radial velocity profile. Defaults to None.
+
+        Returns:
+            Tuple[np.ndarray, Binning]: the profile with shape
+                (nsnaps, nbins), and the radial bins.
+        """
+        rmax = 2 if normalize else self.vines.sim.getBox() / 2
+        r_bins = _asBinning(r_bins, (0, rmax), False, 'r')
+        nsnaps = self.vines.sim.getSnaps()
+        out = np.zeros((nsnaps, r_bins.bins))
+        for chunk in self._chunks(halo_idxs, normalize, weight == 'vr'):
+            weights = None if weight is None else chunk[weight]
+            accumulateHist(out, [chunk['r']], [r_bins], weights)
+        if density:
+            edges = r_bins.getEdges()
+            out /= 4 / 3 * np.pi * (edges[1:]**3 - edges[:-1]**3)
+        return out, r_bins
+
+    @profile('stats.phaseSpace')
+    def phaseSpace(
+        self,
+        halo_idxs : Union[int, Sequence[int]],
+        r_bins : Union[int, Binning] = 64,
+        vr_bins : Union[int, Binning] = 64,
+        normalize : bool = True,
+        vr_range : Tuple[float, float] = None
+    ) -> Tuple[np.ndarray, Binning, Binning]:
+        """
+        Histogram of the tracers in radius and radial velocity at
+        every snapshot, stacked over the given halos.
+
+        Args:
+            halo_idxs (Union[int, Sequence[int]]): the halos.
+            r_bins (Union[int, Binning], optional): see radialProfile.
+                Defaults to 64.
+            vr_bins (Union[int, Binning], optional): the radial
+                velocity bins, or their number. Defaults to 64.
+            normalize (bool, optional): radii in units of the host
+                R200m. Defaults to True.
+            vr_range (Tuple[float, float], optional): range of the
+                radial velocity bins if only their number is given.
+                Defaults to a range holding every tracer, found in an
+                extra pass over the chunks.
+
+        Returns:
+            Tuple[np.ndarray, Binning, Binning]: the histogram with
+                shape (nsnaps, n_r, n_vr), and the bins.
+        """
+        rmax = 2 if normalize else self.vines.sim.getBox() / 2
+        r_bins = _asBinning(r_bins, (0, rmax), False, 'r')
+        if not isinstance(vr_bins, Binning):
+            if vr_range is None:
+                vr_range = self._vrRange(halo_idxs, normalize)
+            vr_bins = Binning(vr_bins, vr_range, False, 'v_r')
+        nsnaps = self.vines.sim.getSnaps()
+        out = np.zeros((nsnaps, r_bins.bins, vr_bins.bins))
+        has_tracers = False
+        for chunk in self._chunks(halo_idxs, normalize, True):
+            has_tracers = True
+            accumulateHist(out, [chunk['r'], chunk['vr']], [r_bins, vr_bins])
+        if not has_tracers:
+            msg = 'the halos %s have no tracers'
+            raise ValueError(msg%(halo_idxs,))
+        return out, r_bins, vr_bins
+
+    def _vrRange(self, halo_idxs, normalize):
+        # symmetric range holding the radial velocity of every tracer,
+        # found in a pass over all of the chunks
+        vmax = 0
+        for chunk in self._chunks(halo_idxs, normalize, True):
+            vr = np.abs(chunk['vr']).ravel()
+            vmax = max(vmax, np.fmax.reduce(vr, initial = 0))
+        if not vmax > 0:
+            return (-1, 1)
+        # the upper edge is not part of the last bin
+        vmax *= 1 + 1e-6
+        return (-vmax, vmax)
+
+
+def _scaled(grid : np.ndarray, log : bool) -> np.ndarray:
+    if not log:
+        return grid
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return np.where(grid > 0, np.log10(grid), np.nan)
+
+
+def _axis(binning : Binning) -> dict:
+    axis = {'title' : binning.label}
+    if binning.log:
+        axis['type'] = 'log'
+    return axis
+
+
+def profileHeatmap(
+    grid : np.ndarray,
+    binning : Binning,
+    times : np.ndarray = None,
+    log : bool = True,
+    heatmap_props : dict = {}
+) -> go.Heatmap:
+    """
+    Draw a profile with shape (nsnaps, nbins) as a heatmap of bin
+    against time.
+
+    Args:
+        grid (np.ndarray): the profile.
+        binning (Binning): its bins.
+        times (np.ndarray, optional): the time of each snapshot.
+            Defaults to the snapshot numbers.
+        log (bool, optional): color by log10 of the values. Defaults
+            to True.
+        heatmap_props (dict, optional): extra go.Heatmap arguments.
+            Defaults to {}.
+    """
+    if times is None:
+        times = np.arange(grid.shape[0])
+    kwargs = dict(x = binning.getCenters(), y = times,
+                  z = _scaled(grid, log))
+    kwargs.update(heatmap_props)
+    return go.Heatmap(**kwargs)
+
+
+def histLayout(x_bins : Binning, y_bins : Binning) -> dict:
+    """
+    Layout for heatmaps of a 2D histogram, with axis titles and log
+    axes for log bins.
+    """
+    return {'xaxis' : _axis(x_bins), 'yaxis' : _axis(y_bins)}
+
+
+def histFrames(
+    grids : np.ndarray,
+    x_bins : Binning,
+    y_bins : Binning,
+    snapshots : Sequence[int] = None,
+    log : bool = True,
+    heatmap_props : dict = {}
+) -> List[go.Frame]:
+    """
+    One heatmap frame per snapshot of a histogram with shape
+    (nsnaps, n_x, n_y), sharing one color range, to be given to
+    Movie.createMovie along with histLayout.
+
+    Args:
+        grids (np.ndarray): the histogram.
+        x_bins (Binning): bins of the second axis, drawn along x.
+        y_bins (Binning): bins of the third axis, drawn along y.
+        snapshots (Sequence[int], optional): the snapshots to make
+            frames of. Defaults to all.
+        log (bool, optional): color by log10 of the values. Defaults
+            to True.
+        heatmap_props (dict, optional): extra go.Heatmap arguments.
+            Defaults to {}.
+    """
+    if snapshots is None:
+        snapshots = range(grids.shape[0])
+    scaled = _scaled(grids[list(snapshots)], log)
+    finite = scaled[np.isfinite(scaled)]
+    zrange = (finite.min(), finite.max()) if finite.size else (0, 1)
+    x, y = x_bins.getCenters(), y_bins.getCenters()
+
+    frames = []
+    for grid, snap in zip(scaled, snapshots):
+        kwargs = dict(x = x, y = y, z = grid.T, zmin = zrange[0],
+                      zmax = zrange[1])
+        kwargs.update(heatmap_props)
+        frames.append(go.Frame(data = [go.Heatmap(**kwargs)],
+                               name = str(snap)))
+    return frames
@@ -1,12 +1,162 @@
 #!usr/bin/python3
 
+from __future__ import annotations
 from typing import List, Dict, Callable, Union # to handle deprecated behavior
-import plotly.graph_objects as go
+from tree_tracks.lazy import go
 from tree_tracks.tracker.tracker_super import Tracker
 from tree_tracks.decorator import Decorator
+from tree_tracks.tracker.decimate import decimate, decimateMask, \
+    rdpSignificance
+from tree_tracks.tracker.stack import stackPos
+from tree_tracks.buffer import appendTo
+from tree_tracks.visual.raster import Raster
+from tree_tracks.visual.plan import CostModel, RenderPlan, rangeCounts, \
+    trailPoints
+from tree_tracks.storage.simulation import Simulation
+from tree_tracks.instrument import profile
 import numpy as np
 from abc import abstractclassmethod
 
+# the ways the trackers can be drawn
+RENDER_MODES = ('traces', 'merged', 'raster')
+
+# decimation tolerances tried by autoPlan, in units of the box size
+PLAN_TOLS = (1e-4, 3e-4, 1e-3, 3e-3, 1e-2)
+
+
+class MergedTrails(object):
+    """
+    The trail trackers of a visual drawn as a single trace, with a gap
+    between consecutive trackers. Plotly handles one long trace much
+    faster than many short ones, but the trackers share the line
+    properties of the first one, and can not be told apart by
+    setColor, setName or setHover.
+    """
+
+    def __init__(self, trackers : List[Tracker]):
+        self.trackers = [trk for trk in trackers if trk.isTrail()]
+        # trackers that are not trails are still drawn one by one
+        self.others = [trk for trk in trackers if not trk.isTrail()]
+        # growth buffers of the stacks, see extend
+        self._buffers = {}
+        # custom data of the gap after each tracker, set by _stackSnaps
+        self._custom_gap = None
+        self.pos, self.lod, self.custom = self._stackSnaps(0)
+        self.alive = ~np.isnan(self.pos[:, :, 0])
+        self.dim = self.pos.shape[2]
+        return
+    
+    def _stackSnaps(self, start):
+        # positions, level of detail masks and custom data of the
+        # trackers from snapshot start, stacked with the tracker axis
+        # first and the snapshot axis second
+        if not self.trackers:
+            return stackPos([]), np.zeros((0, 0), dtype = bool), None
+        pos = np.stack([trk.pos[start:] for trk in self.trackers], axis = 0)
+        ntrk, nsnaps = pos.shape[:2]
+        lod = np.ones((ntrk, nsnaps), dtype = bool)
+        for i, trk in enumerate(self.trackers):
+            if trk.getLOD() is not None:
+                lod[i] = trk.getLOD()[start:]
+        custom = None
+        if self.trackers[0].cdata:
+            cols = [np.stack([np.asarray(trk.getProp(prop)[start:])
+                              for trk in self.trackers])
+                    .reshape(ntrk, nsnaps, -1)
+                    for prop in self.trackers[0].cdata]
+            # numbers are kept as floats, with np.nan in the gaps between
+            # trackers. Other properties, like strings, are stored as
+            # objects as in Tracker.plot, with None in the gaps
+            numeric = [col.dtype.kind in 'biuf' for col in cols]
+            dtype = float if all(numeric) else object
+            custom = np.concatenate([col.astype(dtype) for col in cols],
+                                    axis = -1)
+            if start == 0:
+                self._custom_gap = np.concatenate(
+                    [np.full(col.shape[-1], np.nan if num else None,
+                             dtype = dtype)
+                     for col, num in zip(cols, numeric)])
+        return pos, lod, custom
+    
+    def numSnaps(self) -> int:
+        return self.pos.shape[1]
+    
+    def matches(self, trackers : List[Tracker]) -> bool:
+        """
+        Whether these are the merged trails of the given trackers.
+        """
+        trails = [trk for trk in trackers if trk.isTrail()]
+        return len(trails) == len(self.trackers) and \
+            all(a is b for a, b in zip(trails, self.trackers))
+    
+    def extend(self) -> None:
+        """
+        Add the snapshots the trackers gained since the trails were
+        stacked, for example with Tracker.appendSnaps. Only the new
+        snapshots are stacked, and the stacks grow in place.
+        """
+        start = self.numSnaps()
+        if not self.trackers or len(self.trackers[0].pos) <= start:
+            return
+        pos, lod, custom = self._stackSnaps(start)
+        self.pos = appendTo(self._buffers, 'pos', self.pos, pos, axis = 1)
+        self.alive = appendTo(self._buffers, 'alive', self.alive,
+                              ~np.isnan(pos[:, :, 0]), axis = 1)
+        self.lod = appendTo(self._buffers, 'lod', self.lod, lod, axis = 1)
+        if custom is not None:
+            if custom.dtype != self.custom.dtype:
+                # a numeric property got values of another type
+                self.custom = self.custom.astype(object)
+                self._custom_gap = self._custom_gap.astype(object)
+                custom = custom.astype(object)
+            self.custom = appendTo(self._buffers, 'custom', self.custom,
+                                   custom, axis = 1)
+        return
+    
+    def extant(self, snap_slc = slice(None)) -> List[Tracker]:
+        """
+        The trackers alive at some snapshot of snap_slc.
+        """
+        rows = np.where(np.any(self.alive[:, snap_slc], axis = 1))[0]
+        return [self.trackers[i] for i in rows]
+    
+    @profile('visual.mergedTrace')
+    def plot(self, snap_slc = slice(None)):
+        if not self.trackers:
+            return go.Scatter3d()
+        # only the snapshots of the range are looked at, so the cost
+        # does not grow with the snapshots outside of it
+        alive = self.alive[:, snap_slc]
+        rows = np.where(np.any(alive, axis = 1))[0]
+        if not len(rows):
+            return self.trackers[0].getEmptyTrace()
+        
+        # the ends of the range are always drawn, see
+        # Tracker._default_snap
+        alive = alive[rows]
+        nsnaps = alive.shape[1]
+        first = np.argmax(alive, axis = 1)
+        last = nsnaps - 1 - np.argmax(alive[:, ::-1], axis = 1)
+        keep = alive & self.lod[rows, snap_slc]
+        keep[np.arange(len(rows)), first] = True
+        keep[np.arange(len(rows)), last] = True
+        # np.nan after the points of each tracker breaks the line
+        gaps = np.cumsum(np.sum(keep, axis = 1))
+
+        pos = np.insert(self.pos[rows, snap_slc][keep], gaps, np.nan,
+                        axis = 0)
+        plot_kwargs = dict(mode = 'lines', line = self.trackers[0].plot_args,
+                           x = pos[:, 0], y = pos[:, 1])
+        if self.custom is not None:
+            plot_kwargs['customdata'] = np.insert(
+                self.custom[rows, snap_slc][keep], gaps, self._custom_gap,
+                axis = 0)
+        if self.dim == 3:
+            plot_kwargs['z'] = pos[:, 2]
+            return go.Scatter3d(**plot_kwargs)
+        return go.Scatter(**plot_kwargs)
+
+
 class Visual(object):
     """
     A class that handles interactions between trackers and 
@@ -17,6 +167,292 @@ class Visual(object):
     """
     def __init__(self, trackers : List[Tracker] = []):
         self.trackers = trackers
+        self.lod_tol = None
+        self.lod_budget = None
+        self.render_mode = 'traces'
+        self.raster = None
+        # snapshots of the trails shown behind the current one in
+        # movie frames, see Movie.setTrail
+        self.trail = None
+        return
+    
+    def setRenderMode(self, mode : str = 'traces', **raster_kwargs):
+        """
+        Choose how the trackers are drawn.
+
+        Args:
+            mode (str, optional): 'traces' draws one line trace per
+                tracker, 'merged' draws all of the trajectories as a
+                single trace, see MergedTrails, and 'raster'
+                accumulates them into a single heatmap, see Raster.
+                Defaults to 'traces'.
+            **raster_kwargs: arguments of Raster, used in raster mode.
+        """
+        if mode not in RENDER_MODES:
+            msg = 'render mode %s not understood, expected one of %s'
+            raise ValueError(msg%(mode, RENDER_MODES))
+        self.render_mode = mode
+        self.raster = Raster(**raster_kwargs) if mode == 'raster' else None
+        return
+    
+    def getRenderMode(self) -> str:
+        return self.render_mode
+    
+    def _rasterPos(self) -> np.ndarray:
+        # all of the snapshots are rasterized, so decimation does not
+        # apply here
+        return stackPos(self.trackers)
+    
+    def setDecimation(self, sim : Simulation = None, tol : float = None,
+                      budget : int = None):
+        """
+        Simplify the trajectories before their traces are built, so
+        that nearly straight parts of an orbit are drawn with fewer
+        points. Calling with no tolerance and no budget turns
+        decimation off.
+
+        Args:
+            sim (Simulation, optional): simulation the trackers come
+                from, needed to convert tol into positions units.
+                Defaults to None.
+            tol (float, optional): maximum distance between the
+                simplified and full trajectories, in units of the box
+                size given by sim.getBox(). Defaults to None.
+            budget (int, optional): maximum number of points to plot
+                over all trackers. Defaults to None.
+        """
+        if tol is not None:
+            if sim is None:
+                msg = "a Simulation is needed to convert the " + \
+                    "tolerance from box units"
+                raise ValueError(msg)
+            self.lod_tol = tol * sim.getBox()
+        else:
+            self.lod_tol = None
+        self.lod_budget = budget
+        return
+    
+    @profile('visual.decimate')
+    def _applyDecimation(self):
+        if self.lod_tol is None and self.lod_budget is None:
+            # masks set by the user are kept
+            for trk in self.trackers:
+                if trk.isAutoLOD():
+                    trk.setLOD(None)
+        else:
+            decimate(self.trackers, self.lod_tol, self.lod_budget)
+        return
+    
+    def _numExtraTraces(self) -> int:
+        # traces drawn next to the trackers, by decorators or markers
+        return 0
+    
+    def _planFrames(self, snapshots, trail):
+        # first and last (excluded) snapshot shown in each frame, and
+        # whether the first frame is also the data of the figure
+        nsnaps = len(self.trackers[0].pos)
+        return np.array([0]), np.array([nsnaps]), False
+    
+    def _estimate(self, snapshots, mode, tol, budget, trail, keep, costs):
+        # the plan of a strategy, keep is the level of detail mask of
+        # the trail trackers or None
+        if costs is None:
+            costs = CostModel()
+        starts, ends, repeat_first = self._planFrames(snapshots, trail)
+        alive = np.stack([trk.getAlive() for trk in self.trackers])
+        is_trail = np.array([trk.isTrail() for trk in self.trackers],
+                            dtype = bool)
+        nextra = self._numExtraTraces()
+
+        if mode == 'raster':
+            raster = self.raster if self.raster is not None else Raster()
+            npix = int(np.prod(raster.bins))
+            nframes = len(ends)
+            nfig = nframes + int(repeat_first)
+            segments = np.sum(alive[:, 1:] & alive[:, :-1])
+            nbytes = nfig * (npix * costs.pixel_bytes + 
+                             (1 + nextra) * costs.trace_bytes)
+            seconds = segments * costs.segment_seconds + nframes * \
+                (npix * costs.pixel_seconds + (1 + nextra) * costs.trace_seconds)
+            return RenderPlan(mode, None, None, None, nfig * (1 + nextra),
+                              np.full(nframes, npix), nbytes, seconds)
+
+        # numbers per point, the position and the custom data
+        trk = self.trackers[0]
+        ncustom = sum(np.size(trk.getProp(prop, 0)) for prop in trk.cdata)
+        nvals = trk.dim + ncustom
+        points, shown = trailPoints(alive[is_trail], starts, ends, keep)
+        other_shown = rangeCounts(alive[~is_trail], starts, ends)
+
+        # frames where nothing is alive are not made
+        made = np.any(shown > 0, axis = 0) | np.any(other_shown > 0, axis = 0)
+        points = points.sum(axis = 0)
+        if mode == 'merged':
+            # the gap after each tracker
+            points += np.sum(shown > 0, axis = 0)
+            ntraces = 1 + np.sum(~is_trail) + nextra
+        else:
+            ntraces = len(self.trackers) + nextra
+        values = points * nvals + other_shown.sum(axis = 0) * ncustom + \
+            np.sum(other_shown > 0, axis = 0) * 3 * costs.sphere_points
+        points = points[made]
+        values = values[made]
+
+        nframes = len(values)
+        if repeat_first and nframes:
+            nfig = nframes + 1
+            fig_values = values.sum() + values[0]
+        else:
+            nfig = nframes
+            fig_values = values.sum()
+        nbytes = fig_values * costs.value_bytes + \
+            nfig * ntraces * costs.trace_bytes
+        seconds = values.sum() * costs.value_seconds + \
+            nframes * ntraces * costs.trace_seconds
+        return RenderPlan(mode, tol, budget, trail, nfig * ntraces, points,
+                          nbytes, seconds)
+    
+    def plan(self, snapshots = None, costs : CostModel = None) -> RenderPlan:
+        """
+        Estimate the size of the figure and the time it takes to make
+        with the current settings, from the snapshots where the
+        trackers are alive, without making any traces. Decimation is
+        computed if it is set, which is much faster than making the
+        traces.
+
+        Args:
+            snapshots (Sequence[int], optional): the frames of a
+                movie, see Movie.createFrames. Not used for images.
+                Defaults to None.
+            costs (CostModel, optional): the costs of the parts of a
+                figure. Defaults to CostModel().
+
+        Returns:
+            RenderPlan: the estimates.
+        """
+        if not self.trackers:
+            msg = 'there are no trackers to plan for'
+            raise ValueError(msg)
+        keep = None
+        if self.render_mode != 'raster' and \
+                (self.lod_tol is not None or self.lod_budget is not None):
+            is_trail = [trk.isTrail() for trk in self.trackers]
+            keep = decimateMask(stackPos(self.trackers), self.lod_tol,
+                                self.lod_budget)[is_trail]
+        return self._estimate(snapshots, self.render_mode, self.lod_tol,
+                              self.lod_budget, self.trail, keep, costs)
+    
+    @profile('visual.autoPlan')
+    def autoPlan(
+        self,
+        max_bytes : float = None,
+        max_seconds : float = None,
+        snapshots = None,
+        sim : Simulation = None,
+        tols : List[float] = PLAN_TOLS,
+        trails : List[int] = (),
+        modes : List[str] = RENDER_MODES,
+        costs : CostModel = None,
+        apply : bool = True
+    ) -> RenderPlan:
+        """
+        Choose how to draw the trackers so that the figure stays
+        within a size and build time budget, from the estimates of
+        plan. Strategies are tried from the most to the least detailed:
+        one trace per tracker, then merged traces, each first in full
+        and then decimated with increasing tolerances, then shorter
+        trails for movies, and finally rasterizing. The first that
+        fits is chosen, or the one closest to the budget if none do,
+        which can be checked with RenderPlan.fits.
+
+        Args:
+            max_bytes (float, optional): largest size of the figure
+                JSON. Defaults to None.
+            max_seconds (float, optional): longest time to make the
+                figure. Defaults to None.
+            snapshots (Sequence[int], optional): the frames of a
+                movie. Defaults to None.
+            sim (Simulation, optional): simulation the trackers come
+                from, needed to try decimation. Defaults to None.
+            tols (List[float], optional): decimation tolerances to
+                try, in units of the box size. Defaults to PLAN_TOLS.
+            trails (List[int], optional): trail lengths to try for
+                movies, in snapshots, see Movie.setTrail. Defaults to
+                (), keeping whole trails.
+            modes (List[str], optional): render modes that may be
+                chosen. Defaults to RENDER_MODES.
+            costs (CostModel, optional): the costs of the parts of a
+                figure. Defaults to CostModel().
+            apply (bool, optional): change the settings to the chosen
+                strategy, see applyPlan. Defaults to True.
+
+        Returns:
+            RenderPlan: the chosen strategy and its estimates.
+        """
+        if max_bytes is None and max_seconds is None:
+            msg = 'a budget in bytes or seconds is needed'
+            raise ValueError(msg)
+        for mode in modes:
+            if mode not in RENDER_MODES:
+                msg = 'render mode %s not understood, expected one of %s'
+                raise ValueError(msg%(mode, RENDER_MODES))
+        if not self.trackers:
+            msg = 'there are no trackers to plan for'
+            raise ValueError(msg)
+        
+        abs_tols = [] if sim is None else \
+            [tol * sim.getBox() for tol in sorted(tols)]
+        line_modes = [mode for mode in ('traces', 'merged') if mode in modes]
+        candidates = []
+        for mode in line_modes:
+            candidates += [(mode, tol, None) for tol in [None] + abs_tols]
+        if line_modes:
+            for trail in sorted(trails, reverse = True):
+                candidates += [(line_modes[-1], tol, trail) 
+                               for tol in [None] + abs_tols]
+        if 'raster' in modes:
+            candidates.append(('raster', None, None))
+        
+        # the significance of every point gives the decimation masks
+        # of all of the tolerances at once
+        sig = None
+        if abs_tols:
+            trails_pos = stackPos([trk for trk in self.trackers 
+                                   if trk.isTrail()])
+            sig = rdpSignificance(trails_pos, abs_tols[0])
+        
+        best = None
+        best_excess = np.inf
+        for mode, tol, trail in candidates:
+            keep = None if tol is None else sig > tol
+            plan = self._estimate(snapshots, mode, tol, None, trail, keep,
+                                  costs)
+            if plan.fits(max_bytes, max_seconds):
+                best = plan
+                break
+            # how far over the budget the plan is
+            excess = max(plan.nbytes / max_bytes if max_bytes else 0,
+                         plan.seconds / max_seconds if max_seconds else 0)
+            if excess < best_excess:
+                best = plan
+                best_excess = excess
+        if apply:
+            self.applyPlan(best)
+        return best
+    
+    def applyPlan(self, plan : RenderPlan):
+        """
+        Change the render mode, decimation and trail length to those
+        of a plan.
+        """
+        if plan.mode == 'raster' and self.raster is not None:
+            # keep the raster settings
+            self.render_mode = 'raster'
+        else:
+            self.setRenderMode(plan.mode)
+        self.lod_tol = plan.tol
+        self.lod_budget = plan.budget
+        self.trail = plan.trail
         return
     
     def includeData(self, props : Union[List[str], str]):